@@ -0,0 +1,288 @@
+import contextvars
+import heapq
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+import requests
+
+from log import logger
+from metrics import metrics
+from tracing import tracer
+
+# Priority of the actions submitted without one, set with ActionDispatcher.priority
+_priority = contextvars.ContextVar("haspde_action_priority", default=0)
+
+
+class GraphAction:
+    """A pending hide, unhide or delete of one comment."""
+
+    HIDE = "hide"
+    UNHIDE = "unhide"
+    DELETE = "delete"
+
+    __slots__ = ("kind", "comment_id", "access_token", "page_id", "callback", "future", "enqueued_at",
+                 "span", "context")
+
+    def __init__(self, kind, comment_id, access_token, page_id=None, callback=None):
+        self.kind = kind
+        self.comment_id = comment_id
+        self.access_token = access_token
+        self.page_id = page_id
+        self.callback = callback
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        # The span stays open until the result is in; the callback runs in the submitter's trace
+        self.span = tracer.span(f"graph.{kind}", comment_id=comment_id)
+        self.context = tracer.context()
+
+    def method(self):
+        return "DELETE" if self.kind == self.DELETE else "POST"
+
+    def params(self):
+        if self.kind == self.DELETE:
+            return None
+        hidden = "true" if self.kind == self.HIDE else "false"
+        return {"is_hidden": hidden, "hide": hidden}  # Facebook and Instagram parameter names
+
+    def to_batch_item(self):
+        """Returns the action as an item of a Graph API batch request."""
+        params = self.params()
+        relative_url = self.comment_id + (f"?{urlencode(params)}" if params else "")
+        return {"method": self.method(), "relative_url": relative_url}
+
+
+class ActionDispatcher:
+    """
+    Coalesces moderation actions into Graph API batch requests.
+
+    Actions are queued per access token and sent through the batch endpoint,
+    up to MAX_BATCH_SIZE per HTTP request. A queue is flushed when it is full
+    or when its oldest action has waited `flush_interval` seconds, so a single
+    action is delayed by at most that long. Each action's result is passed to
+    its callback as ``callback(ok, status_code, body)`` and set on the Future
+    returned by `submit`.
+
+    Batches are only taken from the queues while fewer than
+    `max_concurrent_batches` are being sent, so a backlog waits in the queues,
+    where the most urgent actions go first: each queue is ordered as in
+    ActionScheduler, by `enqueued / aging - priority`, with the priority of the
+    verdict the action carries out (MODERATION_PRIORITY). The queue holding the
+    most urgent action is sent first.
+    """
+
+    MAX_BATCH_SIZE = 50  # Graph API limit for one batch request
+
+    def __init__(self, graph_client, flush_interval=0.05, max_concurrent_batches=4, aging=10.0):
+        """
+        Initializes the dispatcher and starts its flush thread.
+
+        Args:
+            graph_client (GraphClient): Client used to send the requests.
+            flush_interval (float): Longest time in seconds an action waits for others to join its batch.
+            max_concurrent_batches (int): Number of batch requests that may be in flight at once.
+            aging (float): Seconds of waiting that raise a queued action by one priority level.
+        """
+        self.graph_client = graph_client
+        self.flush_interval = flush_interval
+        self.max_concurrent_batches = max_concurrent_batches
+        self.aging = aging
+        self._queues = {}  # access token -> heap of (key, order, GraphAction)
+        self._oldest = {}  # access token -> enqueued_at of its longest waiting action
+        self._order = itertools.count()  # Keeps equal keys in submission order
+        self._sending = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches,
+                                            thread_name_prefix="graph-batch")
+        self._thread = threading.Thread(target=self._run, name="action-dispatcher", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    @contextmanager
+    def priority(priority):
+        """Gives the actions submitted in this context, also by callees, `priority`."""
+        token = _priority.set(priority)
+        try:
+            yield
+        finally:
+            _priority.reset(token)
+
+    def submit(self, kind, comment_id, access_token, page_id=None, callback=None, priority=None):
+        """
+        Queues an action.
+
+        Args:
+            kind (str): GraphAction.HIDE, GraphAction.UNHIDE or GraphAction.DELETE.
+            comment_id (str): The comment to act on.
+            access_token (str): Token the action is sent with.
+            page_id (str, optional): Page used for rate limiting.
+            callback (callable, optional): Called with (ok, status_code, body) when the action is done.
+            priority (int, optional): Higher is sent first; defaults to that of the enclosing
+                `priority()` block, or 0.
+
+        Returns:
+            Future: Resolves to (ok, status_code, body).
+        """
+        priority = _priority.get() if priority is None else priority
+        action = GraphAction(kind, comment_id, access_token, page_id, callback)
+        key = action.enqueued_at / self.aging - priority
+        with self._cond:
+            heapq.heappush(self._queues.setdefault(access_token, []), (key, next(self._order), action))
+            self._oldest.setdefault(access_token, action.enqueued_at)
+            self._cond.notify()
+        return action.future
+
+    def pending(self):
+        """Returns the number of queued actions."""
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def flush(self):
+        """Sends every queued action now and waits for the results."""
+        with self._cond:
+            ready = self._take_ready(force=True)
+        for access_token, actions in ready:
+            self._send(access_token, actions)
+
+    def stop(self):
+        """Stops the flush thread after sending every queued action."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+    def _take_ready(self, force=False, limit=None):
+        """
+        Removes up to `limit` batches that are due from the queues, the most urgent first.
+        The caller must hold the lock.
+        """
+        now = time.monotonic()
+        due = {access_token for access_token, queue in self._queues.items()
+               if force or len(queue) >= self.MAX_BATCH_SIZE
+               or now - self._oldest[access_token] >= self.flush_interval}
+        ready = []
+        while due and (limit is None or len(ready) < limit):
+            access_token = min(due, key=lambda token: self._queues[token][0][:2])
+            queue = self._queues[access_token]
+            ready.append((access_token, [heapq.heappop(queue)[2] for _ in range(min(len(queue), self.MAX_BATCH_SIZE))]))
+            if not queue:
+                del self._queues[access_token], self._oldest[access_token]
+                due.discard(access_token)
+                continue
+            self._oldest[access_token] = min(action.enqueued_at for _, _, action in queue)
+            if not (force or len(queue) >= self.MAX_BATCH_SIZE
+                    or now - self._oldest[access_token] >= self.flush_interval):
+                due.discard(access_token)
+        return ready
+
+    def _next_wait(self):
+        """Seconds until the oldest queued action is due. The caller must hold the lock."""
+        if not self._oldest:
+            return None
+        return max(0.0, min(self._oldest.values()) + self.flush_interval - time.monotonic())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                free = self.max_concurrent_batches - self._sending
+                ready = self._take_ready(limit=free) if free > 0 else []
+                if not ready:
+                    if self._stopped:
+                        return
+                    # With every sender busy, wait for one to finish
+                    self._cond.wait(self._next_wait() if free > 0 else None)
+                    continue
+                self._sending += len(ready)
+
+            for access_token, actions in ready:
+                self._executor.submit(self._send_counted, access_token, actions)
+
+    def _send_counted(self, access_token, actions):
+        try:
+            self._send(access_token, actions)
+        finally:
+            with self._cond:
+                self._sending -= 1
+                self._cond.notify()
+
+    def _send(self, access_token, actions):
+        """Sends one batch and reports the result of every action in it."""
+        if len(actions) == 1:
+            self._send_single(actions[0])
+            return
+
+        for action in actions:
+            action.span.set(batch_size=len(actions), queued_ms=round((time.monotonic() - action.enqueued_at) * 1000, 3))
+
+        pages = {action.page_id for action in actions}
+        page_id = pages.pop() if len(pages) == 1 else None
+        data = {'batch': json.dumps([action.to_batch_item() for action in actions])}
+
+        try:
+            response = self.graph_client.post("", access_token=access_token, page_id=page_id, data=data)
+        except requests.RequestException as e:
+            logger.error(f"Graph API batch of {len(actions)} actions failed: {e}")
+            for action in actions:
+                self._complete(action, False, None, str(e))
+            return
+
+        if response.status_code != 200:
+            logger.error(f"Graph API batch of {len(actions)} actions failed. "
+                         f"Status code: {response.status_code}, Response: {response.text}")
+            for action in actions:
+                self._complete(action, False, response.status_code, response.text)
+            return
+
+        try:
+            results = response.json()
+        except ValueError:
+            results = []
+
+        for index, action in enumerate(actions):
+            item = results[index] if index < len(results) else None
+            if not item:
+                # The batch ended before this item was processed
+                self._complete(action, False, None, "No result in batch response")
+                continue
+            code = item.get('code')
+            self._complete(action, code == 200, code, item.get('body'))
+
+    def _send_single(self, action):
+        action.span.set(batch_size=1, queued_ms=round((time.monotonic() - action.enqueued_at) * 1000, 3))
+        try:
+            response = self.graph_client.request(action.method(), action.comment_id,
+                                                 access_token=action.access_token,
+                                                 page_id=action.page_id, params=action.params())
+        except requests.RequestException as e:
+            self._complete(action, False, None, str(e))
+            return
+        self._complete(action, response.status_code == 200, response.status_code, response.text)
+
+    @classmethod
+    def _complete(cls, action, ok, status_code, body):
+        # Time from submit to result, including the wait for the batch
+        metrics.observe("graph_action", time.monotonic() - action.enqueued_at)
+        metrics.counter("haspde_graph_actions_total", "Graph API actions by kind and result",
+                        kind=action.kind, result="ok" if ok else "failed").inc()
+        action.span.set(ok=ok, status_code=status_code)
+        if action.context is not None:
+            action.context.run(cls._finish, action, ok, status_code, body)
+        else:
+            cls._finish(action, ok, status_code, body)
+
+    @staticmethod
+    def _finish(action, ok, status_code, body):
+        with action.span:
+            if action.callback is not None:
+                try:
+                    action.callback(ok, status_code, body)
+                except Exception as e:
+                    logger.error(f"Error handling the result of {action.kind} for comment {action.comment_id}: {e}")
+        action.future.set_result((ok, status_code, body))
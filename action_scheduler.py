@@ -0,0 +1,92 @@
+"""
+Runs the actions of moderation verdicts on worker threads, most severe first.
+
+Under a backlog, a comment to remove should not wait behind thousands of
+approvals. Actions are taken from a heap ordered by the verdict's priority
+(MODERATION_PRIORITY: BAN highest, ACCEPT lowest), and every `aging` seconds
+an action waits counts as one level more, so routine actions are delayed
+but never starved. Because all actions age at the same rate, the order is
+fixed when an action is queued: its key is `queued / aging - priority`.
+
+The time each action waited is recorded per label (the verdict name) in
+the `haspde_action_queue_seconds` summary.
+
+    scheduler = ActionScheduler(workers=2, aging=10)
+    scheduler.submit(MODERATION_PRIORITY[result], "HIDE", hide_comment, comment_id)
+"""
+import heapq
+import itertools
+import threading
+import time
+from collections import Counter
+
+from log import logger
+from metrics import metrics
+
+
+class ActionScheduler:
+    """A priority queue of actions with aging, run by a pool of worker threads."""
+
+    def __init__(self, workers=2, aging=10.0, name="actions"):
+        """
+        Starts the worker threads.
+
+        Args:
+            workers (int): Number of worker threads.
+            aging (float): Seconds of waiting that raise an action by one priority level.
+            name (str): Prefix of the worker thread names.
+        """
+        self.aging = aging
+        self._heap = []
+        self._order = itertools.count()  # Keeps equal keys in submission order
+        self._depth = Counter()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = [threading.Thread(target=self._run, name=f"{name}-{index}", daemon=True)
+                         for index in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, priority, label, func, *args):
+        """
+        Queues `func(*args)`.
+
+        Args:
+            priority (int): Higher runs first.
+            label (str): Name the queue time and depth are reported under.
+        """
+        queued = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._heap, (queued / self.aging - priority, next(self._order), queued, label, func, args))
+            self._depth[label] += 1
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    if self._stopped:
+                        return
+                    self._cond.wait()
+                _, _, queued, label, func, args = heapq.heappop(self._heap)
+                self._depth[label] -= 1
+
+            metrics.histogram("haspde_action_queue_seconds", "Time moderation actions waited to run",
+                              result=label).observe(time.monotonic() - queued)
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error("Error running the %s action: %s", label, e)
+
+    def depth(self, label=None):
+        """Returns the number of queued actions, of one label or in total."""
+        with self._cond:
+            return self._depth[label] if label is not None else len(self._heap)
+
+    def stop(self):
+        """Stops the workers once the queued actions have run."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
@@ -1,24 +1,66 @@
-from bson.objectid  import ObjectId
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
-import requests
+import logging
+import queue
+import time
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime
-from flask import Flask, request, jsonify, render_template, redirect, url_for
-from moderation_model import ModerationModel
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, stream_with_context
+from moderation_model import MODERATION_PRIORITY, ModerationModel
 from database_manager import DatabaseManager
+from action_dispatcher import ActionDispatcher, GraphAction
+from action_scheduler import ActionScheduler
+from comment_feed import CommentFeed
+from comment_pipeline import APPROVE, HIDE, REMOVE, REVIEW, action_for, comment_document
+from comment_listing import CommentListing
+from graph_client import GraphClient
+from load_governor import DEFER_TELEMETRY, LoadGovernor
+from inference_pool import InferencePool, InferenceUnavailable
+from media_owner_cache import MediaOwnerCache
+from moderation_counters import ModerationCounters
+from page_token_store import PageTokenStore
+from partitioned_queue import PartitionedQueue
+from profiling import ProfilingAdmin
+from results import ModerationResult
+from retry_sweeper import RetrySweeper
+from review_queue import ReviewQueue
 
 from status_package import Status
 
+import log
 from log import logger
+from metrics import metrics, timed
+from tracing import tracer, traced
 from config import Config
 
 # Initialization
 config = Config()
 processed_comments = set()
+recent_comments = OrderedDict()  # comment ID -> (media_id, platform) of recently stored comments
+RECENT_COMMENTS_MAX = 10000
 app = Flask(__name__)
 
+# Logging level, format and sampling of high-volume records
+log.configure(config.LOG_LEVEL, config.LOG_FORMAT, config.LOG_SAMPLE_RATE)
+
+# Load models that we need
+moderation_model = ModerationModel(config.IMPROVE, config.HUMAN_REVIEW, certainty_needed=config.CERTAINTY_NEEDED,
+                                   updates_url=config.UPDATES_URL)
+
+# Inference in worker processes sharing the loaded model, so it is not serialized by the GIL. Started
+# before the MongoDB clients, the scheduler and the other background threads, so it forks a process with one thread
+inference_pool = None
+if config.INFERENCE_PROCESSES and not config.HUMAN_REVIEW:
+    inference_pool = InferencePool(moderation_model, config.INFERENCE_PROCESSES,
+                                   max_pending=config.INFERENCE_QUEUE, max_batch=config.INFERENCE_BATCH,
+                                   request_timeout=config.INFERENCE_TIMEOUT * 3).start()
+
 Status(app, config.MONGO_URI)
 
+# Head-sampled request tracing, off unless trace_sample_rate is set
+tracer.configure(config.TRACE_SAMPLE_RATE, config.TRACE_FILE, config.TRACE_OTLP_ENDPOINT)
+
 # MongoDB setup
 client = DatabaseManager().get_instance()
 db = client.get_db()
@@ -26,6 +68,25 @@ comments_collection = db['comments']
 
 db_2 = client.get_db("HaSpDeDash")
 
+# Human review queue with atomic, leased claims
+review_queue = ReviewQueue(comments_collection, lease_seconds=config.REVIEW_LEASE_SECONDS)
+
+# Live feed of new comments and status changes for the dashboard
+comment_feed = CommentFeed(comments_collection)
+
+# Comment counts per status, platform and owner, updated on every status change
+moderation_counters = ModerationCounters(db['moderation_counters'], comments_collection)
+
+# Paginated, projected comment listing for the dashboard
+comment_listing = CommentListing(comments_collection, max_limit=config.COMMENTS_PAGE_MAX)
+
+# Reviewer decisions submitted in batches are logged for training in the background
+telemetry_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="telemetry")
+MAX_REVIEW_BATCH = 20
+
+# Facebook page access tokens, kept in memory and keyed by page ID
+page_tokens = PageTokenStore(db_2.users)
+
 # Use configurations from config
 INSTAGRAM_ACCESS_TOKEN = config.INSTAGRAM_ACCESS_TOKEN
 INSTAGRAM_API_VERSION = config.INSTAGRAM_API_VERSION
@@ -34,27 +95,117 @@ IMPROVE = config.IMPROVE
 HUMAN_REVIEW = config.HUMAN_REVIEW
 ERROR_STATUS = json.dumps({'status': 'error'}), 200
 
-# Load models that we need
-moderation_model = ModerationModel(IMPROVE, HUMAN_REVIEW, certainty_needed=config.CERTAINTY_NEEDED)
+# Shared Graph API client with connection pooling, retries and rate limiting
+graph_client = GraphClient(
+    INSTAGRAM_API_VERSION,
+    base_url=config.GRAPH_API_URL,
+    timeout=config.GRAPH_TIMEOUT,
+    max_retries=config.GRAPH_MAX_RETRIES,
+    app_rate=config.GRAPH_APP_RATE,
+    page_rate=config.GRAPH_PAGE_RATE
+)
+
+# Hide/unhide/delete actions are coalesced into Graph API batch requests
+action_dispatcher = ActionDispatcher(graph_client, flush_interval=config.GRAPH_BATCH_WINDOW, aging=config.ACTION_AGING)
+
+# Instagram media -> owner lookups, cached in memory and in MongoDB
+media_owner_cache = MediaOwnerCache(db['media_owners'], graph_client, INSTAGRAM_ACCESS_TOKEN)
 
 def update_skipped_comments():
     """Update comments with status 'skipped' to 'PENDING_REVIEW'."""
     logger.info("Checking for comments with status 'skipped' to update to 'PENDING_REVIEW'.")
 
     try:
-        result = comments_collection.update_many(
-            {'status': 'SKIPPED'},
-            {'$set': {'status': 'PENDING_REVIEW', 'updated_at': datetime.utcnow()}}
+        updated = moderation_counters.transition_all(
+            {'status': 'SKIPPED'}, 'PENDING_REVIEW',
+            {'$set': {'updated_at': datetime.utcnow()}}
         )
-        logger.info(f"Updated {result.modified_count} comments from 'skipped' to 'PENDING_REVIEW'.")
+        logger.info("Updated %d comments from 'skipped' to 'PENDING_REVIEW'.", updated)
     except Exception as e:
-        logger.error(f"Error updating comments: {e}")
+        logger.error("Error updating comments: %s", e)
+
+# Failed Graph API actions are retried with backoff by the sweeper, each run within half the interval between runs
+retry_sweeper = RetrySweeper(
+    comments_collection,
+    retry_action=lambda doc: retry_failed_action(doc),
+    max_attempts=config.RETRY_MAX_ATTEMPTS,
+    base_delay=config.RETRY_BASE_DELAY,
+    action_timeout=config.GRAPH_TIMEOUT * 2,
+    run_timeout=config.RETRY_INTERVAL * 30
+)
+retry_sweeper.adopt_legacy_failures()
+
+# Actions of moderation verdicts run most severe first, so removals do not wait behind approvals
+action_scheduler = None
+if config.ACTION_WORKERS:
+    action_scheduler = ActionScheduler(config.ACTION_WORKERS, aging=config.ACTION_AGING, name="moderation-actions")
+
+# Webhook comments are moderated in order per owner, each owner's partition on one worker thread
+comment_queue = None
+if config.COMMENT_WORKERS:
+    comment_queue = PartitionedQueue(config.COMMENT_WORKERS, config.COMMENT_PARTITIONS,
+                                     max_items=config.COMMENT_QUEUE_MAX, name="moderation")
+
+def apply_shed_level(old, new):
+    """Defers telemetry from the first load shedding step on, and sends what was deferred when it is left."""
+    moderation_model.defer_telemetry = new >= DEFER_TELEMETRY
+    if old >= DEFER_TELEMETRY > new:
+        telemetry_executor.submit(moderation_model.send_deferred_telemetry)
+
+# Moderation degrades in steps when webhooks arrive faster than they are handled
+load_governor = LoadGovernor(
+    config.SHED_THRESHOLDS,
+    {'depth': lambda: (comment_queue.size() if comment_queue is not None else 0)
+                      + (action_scheduler.depth() if action_scheduler is not None else 0)},
+    cooldown=config.SHED_COOLDOWN,
+    on_change=apply_shed_level
+)
 
 # Set up the scheduler
 scheduler = BackgroundScheduler()
 scheduler.add_job(func=update_skipped_comments, trigger="interval", minutes=15)
+scheduler.add_job(func=retry_sweeper.run_once, trigger="interval", minutes=config.RETRY_INTERVAL)
+scheduler.add_job(func=review_queue.release_expired, trigger="interval", minutes=1)
+scheduler.add_job(func=moderation_counters.reconcile, trigger="interval", hours=config.STATS_RECONCILE_HOURS)
+scheduler.add_job(func=moderation_counters.reconcile_if_missing)
 scheduler.start()
 
+# Gauges are read only when /metrics is scraped
+metrics.gauge("haspde_graph_actions_pending", "Hide/unhide/delete actions waiting for a batch", action_dispatcher.pending)
+metrics.gauge("haspde_retry_backlog", "Failed actions waiting for a retry", lambda: retry_sweeper.stats()['backlog'])
+metrics.gauge("haspde_dead_letter_backlog", "Failed actions given up on", lambda: retry_sweeper.stats()['dead_letter_backlog'])
+metrics.gauge("haspde_review_pending", "Comments waiting for human review", review_queue.pending_count)
+metrics.gauge("haspde_feed_subscribers", "Open live comment feed connections", comment_feed.subscriber_count)
+if inference_pool is not None:
+    metrics.gauge("haspde_inference_pending", "Comments queued for or in inference workers", inference_pool.pending)
+    metrics.gauge("haspde_inference_workers", "Running inference worker processes", inference_pool.alive)
+    metrics.gauge("haspde_inference_restarts", "Inference worker processes restarted", lambda: inference_pool.restarts)
+if comment_queue is not None:
+    metrics.gauge("haspde_comment_queue_size", "Comments waiting for moderation", comment_queue.size)
+    metrics.gauge("haspde_comment_queue_steals", "Partition items run by a worker other than their owner",
+                  lambda: comment_queue.stolen)
+    for partition in range(config.COMMENT_PARTITIONS):
+        metrics.gauge("haspde_partition_lag_seconds", "Age of the oldest comment waiting in a partition",
+                      lambda p=partition: comment_queue.lag(p), partition=str(partition))
+        metrics.gauge("haspde_partition_depth", "Comments waiting in a partition",
+                      lambda p=partition: comment_queue.depth(p), partition=str(partition))
+if action_scheduler is not None:
+    for result in MODERATION_PRIORITY:
+        label = ModerationResult.RESULT_MAPPING[result]
+        metrics.gauge("haspde_actions_queued", "Moderation actions waiting to run, by moderation result",
+                      lambda r=label: action_scheduler.depth(r), result=label)
+metrics.gauge("haspde_load_shed_level", "Load shedding step, 0 (normal) to 4 (rejecting webhooks)",
+              lambda: load_governor.level)
+metrics.gauge("haspde_telemetry_deferred", "Telemetry records deferred under load", moderation_model.deferred_telemetry)
+
+# On-demand profiling under /admin/profile, registered only when an admin token is configured
+ProfilingAdmin(app, config.ADMIN_TOKEN, watched={
+    'processed_comments': lambda: len(processed_comments),
+    'recent_comments': lambda: len(recent_comments),
+    'feed_subscribers': comment_feed.subscriber_count,
+    'graph_actions_pending': action_dispatcher.pending,
+})
+
 @app.route('/webhook', methods=['GET', 'POST'])
 def webhook():
     """
@@ -62,18 +213,20 @@ def webhook():
     Returns:
     Response: JSON response based on the request type.
     """
-    data = "\n=== New Request ==="
-    data += f"Request Method: {request.method}\n"
-    data += f"Request Headers: {request.headers}\n"
-    data += f"Request Args: {request.args}\n"
-    data += f"Request Data (raw): {request.data.decode('utf-8')}\n"
-    logger.debug(data)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Webhook request: method=%s headers=%s args=%s body=%.4000s", request.method,
+                     dict(request.headers), request.args.to_dict(), request.get_data(as_text=True))
 
     if request.method == 'GET':
         return handle_verification(request)
 
     elif request.method == 'POST':
-        return handle_webhook_event(request)
+        # Meta delivers rejected webhooks again later
+        if load_governor.rejecting():
+            metrics.counter("haspde_webhooks_rejected_total", "Webhooks answered 503 under load").inc()
+            return jsonify({'error': 'Overloaded, retry later'}), 503, {'Retry-After': str(config.SHED_RETRY_AFTER)}
+        with load_governor.request(), tracer.start_trace("webhook", traceparent=request.headers.get('traceparent')):
+            return handle_webhook_event(request)
 
     # If the request method is neither GET nor POST
     return method_not_allowed()
@@ -110,16 +263,19 @@ def handle_webhook_event(request):
     Response: A JSON response indicating the status of the operation.
     """
     # Parse JSON data from the request
-    data = request.json
-    logger.debug("Received webhook data:")
-    logger.debug(json.dumps(data, indent=2))  # Pretty-print the received data for debugging
+    with metrics.stage("parse"):
+        data = request.json
+    metrics.counter("haspde_webhook_events_total", "Webhook events received", object=str(data.get('object'))).inc()
+    if tracer.active():
+        tracer.current().set(object=str(data.get('object')),
+                             entries=",".join(str(entry.get('id')) for entry in data.get('entry', [])))
+    logger.debug("Received webhook data: %s", data)
 
     # Process Facebook Page events
     if data.get("object") == "page":
-        logger.info("The comment is facebook")
+        logger.debug("The comment is facebook")
 
         for entry in data.get("entry", []):
-            print(entry)
             if 'changes' in entry and isinstance(entry['changes'], list):
                 for change in entry['changes']:
                     if change.get('field') == 'feed' and 'value' in change:
@@ -132,7 +288,16 @@ def handle_webhook_event(request):
 
     # Process Instagram events
     elif data.get('object') == 'instagram':
-        logger.info("The comment is instagram")
+        logger.debug("The comment is instagram")
+
+        # Resolve the owners of every media in the payload with one lookup
+        with tracer.span("owner_lookup"):
+            media_owner_cache.get_many(
+                change['value'].get('media', {}).get('id')
+                for entry in data.get('entry', [])
+                for change in entry.get('changes', []) or []
+                if change.get('field') == 'comments' and isinstance(change.get('value'), dict)
+            )
 
         for entry in data.get('entry', []):
             if 'changes' in entry and isinstance(entry['changes'], list):
@@ -145,6 +310,7 @@ def handle_webhook_event(request):
         logger.error("CRITICAL ERROR")
 
     return jsonify({'status': 'ok'}), 200
+@traced("process_comment")
 def process_facebook_comment(comment_data):
     """
     Process a Facebook comment and store it in the database.
@@ -160,6 +326,7 @@ def process_facebook_comment(comment_data):
         user_id = comment_data['from']['id']
         user_name = comment_data['from'].get('name', 'Unknown User')
         platform = 'facebook'
+        tracer.current().set(comment_id=comment_id, platform=platform)
 
         # Extract owner ID from the post_id (i.e., the part before the underscore)
         owner_id = post_id.split('_')[0] if post_id else None
@@ -167,16 +334,19 @@ def process_facebook_comment(comment_data):
         # Ensure comment_id is present before proceeding
         if comment_id:
             # Store comment in MongoDB if it doesn't already exist
-            if not comments_collection.find_one({'id': comment_id}):
-                comment_to_db(comment_id, comment_text, platform, user_id, user_name, post_id)
+            with metrics.stage("dedup"):
+                exists = comments_collection.find_one({'id': comment_id}, {'_id': 1})
+            if not exists:
+                comment_to_db(comment_id, comment_text, platform, user_id, user_name, post_id, owner_id)
 
             # Pass the owner_id to the moderation model
             if not HUMAN_REVIEW:
-                handle_comment(comment_data, owner_id)
+                dispatch_comment(comment_data, owner_id)
         else:
             logger.error("Comment ID is missing in the comment data.")
 
 
+@traced("process_comment")
 def process_instagram_comment(comment_data):
     """
     Process an Instagram comment and store it in the database.
@@ -191,22 +361,26 @@ def process_instagram_comment(comment_data):
     user_name = comment_data['from'].get('username', 'Unknown User')
     media_id = comment_data['media']['id']
     platform = 'instagram'
+    tracer.current().set(comment_id=comment_id, platform=platform)
 
     # Ensure comment_id is present before proceeding
     if comment_id:
         owner_id = get_instagram_owner_id(media_id)
         # Store comment in MongoDB if it doesn't already exist
-        if not comments_collection.find_one({'id': comment_id}):
-            comment_to_db(comment_id, comment_text, platform, user_id, user_name, media_id)
+        with metrics.stage("dedup"):
+            exists = comments_collection.find_one({'id': comment_id}, {'_id': 1})
+        if not exists:
+            comment_to_db(comment_id, comment_text, platform, user_id, user_name, media_id, owner_id)
 
         # If human review is disabled, handle the comment
         if not HUMAN_REVIEW:
-            handle_comment(comment_data, owner_id)
+            dispatch_comment(comment_data, owner_id)
             
     else:
         logger.error("Comment ID is missing in the comment data.")
 
-def comment_to_db(comment_id, comment_text, platform, user_id=None, user_name='Unknown User', media_id=None):
+@traced("comment_to_db")
+def comment_to_db(comment_id, comment_text, platform, user_id=None, user_name='Unknown User', media_id=None, owner_id=None):
     """
     Store a comment in the database.
     
@@ -217,45 +391,48 @@ def comment_to_db(comment_id, comment_text, platform, user_id=None, user_name='U
     user_id (str, optional): The ID of the user who made the comment.
     user_name (str, optional): The name of the user who made the comment.
     media_id (str, optional): The ID of the media associated with the comment (for Instagram).
+    owner_id (str, optional): The owner ID of the page or account the comment was made on.
     """
     try:
         # Prepare the comment data for insertion
-        comment_data = {
-            'id': comment_id,
-            'text': comment_text,
-            'status': 'PENDING',
-            'evaluation': evaluate_comment(comment_text),
-            'platform': platform,
-            'user_id': user_id,
-            'user_name': user_name,
-            'media_id': media_id
-        }
+        comment_data = comment_document(comment_id, comment_text, platform, user_id, user_name, media_id, owner_id)
 
         # Insert the comment into the database
-        comments_collection.insert_one(comment_data)
-        logger.info(f"Comment with ID {comment_id} successfully added to the database.")
+        with metrics.stage("mongo_write"):
+            comments_collection.insert_one(comment_data)
+        metrics.counter("haspde_comments_total", "Comments stored", platform=platform).inc()
+        moderation_counters.record(platform, owner_id, None, 'PENDING')
+        remember_comment(comment_id, media_id, platform)
+        logger.info("Comment with ID %s successfully added to the database.", comment_id,
+                    extra={'comment_id': comment_id, 'platform': platform})
 
     except Exception as e:
-        logger.error(f"Error inserting comment with ID {comment_id}: {e}")
+        logger.error("Error inserting comment with ID %s: %s", comment_id, e, extra={'comment_id': comment_id})
 
 def approve_comment(comment_id):
     """Approve the comment."""
     #approve(comment_id)
-    logger.debug(f"Comment {comment_id} has been approved.")
+    logger.debug("Comment %s has been approved.", comment_id)
 
 def send_for_human_review(comment_id):
     """Queue the comment for human review and hide it in the meantime."""
-    comments_collection.update_one({'id': comment_id}, {'$set': {'status': 'PENDING_REVIEW', 'hidden': '1'}})
-    logger.info(f"Comment {comment_id} is now queued for human review.")
+    moderation_counters.transition({'id': comment_id}, 'PENDING_REVIEW', {'$set': {'hidden': '1'}})
+    logger.info("Comment %s is now queued for human review.", comment_id, extra={'comment_id': comment_id})
     hide_comment(comment_id, log=False)  # Hide the comment while pending review
 
-def handle_action_based_on_mode(comment_id, fallback_action):
-    """Handle actions based on the config mode."""
-    if config.MODE == "full":
-        action_2(comment_id)
-    else:
-        send_for_human_review(comment_id)
-        
+def dispatch_comment(comment_data, owner_id):
+    """Queues a comment behind its owner's earlier comments, or moderates it here if the queue is off or full."""
+    if comment_queue is not None:
+        try:
+            comment_queue.put(owner_id, tracer.wrap(handle_comment), comment_data, owner_id)
+            return
+        except queue.Full:
+            logger.warning("Moderation queue is full, moderating comment in the webhook request.")
+            metrics.counter("haspde_comment_queue_full_total", "Comments moderated in the webhook request "
+                            "because the moderation queue was full").inc()
+    handle_comment(comment_data, owner_id)
+
+@traced("handle_comment")
 def handle_comment(comment_data, owner_id=None):
     """
     Process an incoming comment for moderation.
@@ -275,7 +452,7 @@ def handle_comment(comment_data, owner_id=None):
 
     # Skip processing if the comment has already been processed
     if comment_id in processed_comments:
-        logger.warning(f"Comment with id '{comment_id}' has already been processed. Skipping.")
+        logger.warning("Comment with id '%s' has already been processed. Skipping.", comment_id)
         return
 
     # Add comment ID to the processed set to avoid re-processing
@@ -284,7 +461,7 @@ def handle_comment(comment_data, owner_id=None):
     # Retrieve the owner's configuration if needed
     owner_config = get_owner_config(owner_id)
     if owner_config is None:
-        logger.warning(f"No configuration found for owner ID '{owner_id}'. Proceeding with default settings.")
+        logger.debug("No configuration found for owner ID '%s'. Proceeding with default settings.", owner_id)
 
     """OWNER CONFIG
     {
@@ -307,24 +484,63 @@ def handle_comment(comment_data, owner_id=None):
 
 
     # Moderate the comment using the moderation model, including owner ID if necessary
-    moderation_result = moderation_model.moderate_comment(comment_text, owner_config)
+    with load_governor.moderation():
+        moderation_result = moderate(comment_text, owner_config)
 
     # Define action based on moderation result
     result_action_map = {
-        0: approve_comment,
-        1: hide_comment,
-        2: lambda cid: handle_action_based_on_mode(cid, "max_hide"),
-        3: lambda cid: handle_action_based_on_mode(cid, "max_hide"),
-        4: send_for_human_review
+        APPROVE: approve_comment,
+        HIDE: hide_comment,
+        REMOVE: action_2,
+        REVIEW: send_for_human_review
     }
 
     # Execute the corresponding action
-    result_action = result_action_map.get(int(moderation_result))
-    if result_action:
-        result_action(comment_id)
+    metrics.counter("haspde_moderation_results_total", "Moderation results",
+                    result=str(int(moderation_result))).inc()
+    result_action = result_action_map.get(action_for(moderation_result, config.MODE))
+    if not result_action:
+        logger.error("Unknown moderation result: %s for comment %s", moderation_result, comment_id)
+        return
+    priority = MODERATION_PRIORITY[int(moderation_result)]
+    # Approving only logs, it does not need a place in the queue
+    if action_scheduler is not None and int(moderation_result) != ModerationResult.ACCEPT:
+        action_scheduler.submit(priority, ModerationResult.RESULT_MAPPING[int(moderation_result)],
+                                tracer.wrap(run_action), priority, result_action, comment_id)
     else:
-        logger.error(f"Unknown moderation result: {moderation_result} for comment {comment_id}")
+        run_action(priority, result_action, comment_id)
 
+def run_action(priority, result_action, comment_id):
+    """Runs the action of a verdict; the Graph API requests it queues are sent in the order of `priority`."""
+    with action_dispatcher.priority(priority):
+        result_action(comment_id)
+
+def moderate(comment_text, owner_config):
+    """Moderates a comment in the inference pool, or in this thread when the pool is off, full or failing."""
+    model_policy = load_governor.model_policy()
+    if inference_pool is not None:
+        try:
+            with metrics.stage("inference"), tracer.span("inference"):
+                verdict = inference_pool.moderate(comment_text, owner_config, timeout=config.INFERENCE_TIMEOUT,
+                                                  model_policy=model_policy)
+        except InferenceUnavailable as e:
+            logger.warning("Moderating in the request thread: %s", e)
+            metrics.counter("haspde_inference_fallbacks_total", "Comments moderated in the request thread "
+                            "because the inference pool was full or failing").inc()
+        else:
+            if verdict['model_result'] is None:
+                metrics.counter("haspde_model_skipped_total", "Comments moderated without the model under load",
+                                policy=model_policy).inc()
+            result = moderation_model.report(comment_text, verdict['result'], verdict['certainty'], telemetry=False)
+            if verdict['model_result'] is not None:
+                # Telemetry goes over the network, keep it off the request thread
+                telemetry_executor.submit(tracer.wrap(moderation_model._log_comment),
+                                          moderation_model._01_label(result), result, comment_text)
+            return result
+    return moderation_model.moderate_comment(comment_text, owner_config, model_policy=model_policy)
+
+@timed("owner_config")
+@traced("owner_config")
 def get_owner_config(owner_id):
     """
     Retrieve the configuration for the owner based on their ID.
@@ -340,6 +556,7 @@ def get_owner_config(owner_id):
     return owner_config
 
 
+@traced("owner_lookup")
 def get_instagram_owner_id(media_id):
     """
     Retrieve the owner ID for a given Instagram media or comment.
@@ -350,28 +567,15 @@ def get_instagram_owner_id(media_id):
     Returns:
     str: The owner ID of the media or comment.
     """
-    url = f"https://graph.facebook.com/{INSTAGRAM_API_VERSION}/{media_id}"
-    params = {
-        'fields': 'owner',
-        'access_token': INSTAGRAM_ACCESS_TOKEN
-    }
-
-    try:
-        response = requests.get(url, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            return data.get('owner', {}).get('id')
-        else:
-            logger.warning(f"Failed to get owner ID for media {media_id}. Status code: {response.status_code}")
-            return None
-    except requests.RequestException as e:
-        logger.error(f"An error occurred while retrieving owner ID for media {media_id}: {e}")
-        return None
+    return media_owner_cache.get(media_id)
 
 
 def action_2(comment_id):
-    remove(comment_id)  # Remove the comment if it is deemed inappropriate
-    logger.info(f"Comment {comment_id} has been removed.")
+    # Remove the comment if it is deemed inappropriate
+    if request_removal(comment_id):
+        logger.info("Comment %s has been removed.", comment_id)
+    else:
+        logger.error("Comment %s to remove was not found in the database.", comment_id)
 
 @app.route("/review")
 def re():
@@ -386,24 +590,15 @@ def review():
     Returns:
     Response: JSON with comment data or a message indicating no comments are pending.
     """
-    # Retrieve the pending comments and count them using len()
-    pending_comments = list(comments_collection.find({'status': 'PENDING_REVIEW'}))
-    pending_count = len(pending_comments)
-    
-    # Find the first pending comment from the list
-    if pending_comments:
-        pending_comment = pending_comments[0]
-        comment_id = pending_comment['id']
-        comment_text = pending_comment['text']
-        evaluation_result = pending_comment.get('evaluation', '')
-
-        # Update the status of the comment to 'IN_REVIEW'
-        comments_collection.update_one({'id': comment_id}, {'$set': {'status': 'IN_REVIEW'}})
+    # Claim the oldest pending comment atomically under a lease
+    pending_comment = review_queue.claim(reviewer_id())
+    pending_count = review_queue.pending_count()
 
+    if pending_comment:
         return jsonify({
-            'comment_id': comment_id,
-            'comment_text': comment_text,
-            'evaluation_result': evaluation_result,
+            'comment_id': pending_comment['id'],
+            'comment_text': pending_comment['text'],
+            'evaluation_result': pending_comment.get('evaluation', ''),
             'pending_count': pending_count
         })
     else:
@@ -412,6 +607,87 @@ def review():
             'pending_count': pending_count
         })
 
+def reviewer_id():
+    """Identify the reviewer making the request."""
+    return request.headers.get('X-Reviewer-Id') or request.args.get('reviewer') or request.remote_addr
+
+
+@app.route('/api/review/batch', methods=['GET'])
+def review_batch():
+    """
+    API endpoint to claim several pending comments for review at once.
+    Query parameters:
+    n (int): Number of comments to claim, at most MAX_REVIEW_BATCH (default 5).
+    Returns:
+    Response: JSON with the claimed comments and the number still pending.
+    """
+    count = max(1, min(request.args.get('n', 5, type=int), MAX_REVIEW_BATCH))
+    claimed = review_queue.claim_many(reviewer_id(), count)
+
+    return jsonify({
+        'comments': [{
+            'comment_id': comment['id'],
+            'comment_text': comment['text'],
+            'evaluation_result': comment.get('evaluation', '')
+        } for comment in claimed],
+        'pending_count': review_queue.pending_count()
+    })
+
+
+@app.route('/api/review/decisions', methods=['POST'])
+def review_decisions():
+    """
+    API endpoint to submit many review decisions in one call.
+    Body:
+    {"decisions": [{"comment_id": "...", "decision": "approve" | "skip" | "remove" | "release"}, ...]}
+    "release" returns a claimed but unreviewed comment to the queue.
+    Returns:
+    Response: JSON with the outcome of each decision.
+    """
+    decisions = (request.get_json(silent=True) or {}).get('decisions', [])
+    if not isinstance(decisions, list):
+        return jsonify({'error': 'decisions must be a list'}), 400
+
+    if len(decisions) > MAX_REVIEW_BATCH * 5:
+        return jsonify({'error': f'At most {MAX_REVIEW_BATCH * 5} decisions per call'}), 400
+
+    # One read for all the comments the decisions are about
+    comments = {c['id']: c for c in comments_collection.find(
+        {'id': {'$in': ReviewQueue.decision_ids(decisions)}}, ReviewQueue.DECISION_PROJECTION)}
+
+    now = datetime.utcnow()
+    operations, results = ReviewQueue.plan_decisions(decisions, comments, reviewer_id(), now)
+
+    if operations:
+        written = comments_collection.bulk_write(operations, ordered=False)
+        if written.matched_count < len(operations):
+            # A lease expired or was taken over between the read and the write: keep only what was written
+            ReviewQueue.keep_written(results, {c['id'] for c in comments_collection.find(
+                {'id': {'$in': [r['comment_id'] for r in results if r['ok']]}, 'reviewed_at': now}, {'id': 1})})
+        moderation_counters.record_many([
+            (comments[r['comment_id']].get('platform'), comments[r['comment_id']].get('owner_id'),
+             ReviewQueue.IN_REVIEW, ReviewQueue.DECISIONS[r['decision']])
+            for r in results if r['ok']
+        ])
+
+    # Graph API actions go through the batch dispatcher, telemetry runs in the background
+    for result in results:
+        if not result['ok']:
+            continue
+        comment_id = result['comment_id']
+        text = comments[comment_id]['text']
+        try:
+            if result['decision'] == 'approve':
+                telemetry_executor.submit(tracer.wrap(moderation_model._log_comment), action_type=0, comment=text, label=0)
+                hide_comment(comment_id, False, unhide=True)
+            elif result['decision'] == 'remove':
+                telemetry_executor.submit(tracer.wrap(moderation_model._log_comment), action_type=2, comment=text, label=1)
+                remove_comment(comment_id)
+        except Exception as e:
+            logger.error("Error acting on review decision for comment %s: %s", comment_id, e)
+
+    return jsonify({'results': results, 'pending_count': review_queue.pending_count()})
+
 
 @app.route('/api/skip/<comment_id>', methods=["POST"])
 def skip(comment_id):
@@ -421,9 +697,9 @@ def skip(comment_id):
     Response: JSON confirming the skip action.
     """
     # Update the comment status in MongoDB    
-    result = comments_collection.update_one({'id': comment_id}, {'$set': {'status': 'SKIPPED'}})
+    skipped = moderation_counters.transition({'id': comment_id}, 'SKIPPED', {'$unset': ReviewQueue.LEASE_FIELDS})
     
-    if result.modified_count > 0:
+    if skipped > 0:
         return jsonify({'message': 'Comment skipped successfully', 'comment_id': comment_id})
     else:
         return jsonify({'message': 'Comment not found or already skipped', 'comment_id': comment_id}), 404
@@ -447,7 +723,7 @@ def approve(comment_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     else:
-        comments_collection.update_one({'id': comment_id}, {'$set': {'status': 'APPROVED'}})
+        moderation_counters.transition({'id': comment_id}, 'APPROVED', {'$unset': ReviewQueue.LEASE_FIELDS})
         hide_comment(comment_id, False, unhide=True)
         return jsonify({'message': 'Comment approved successfully', 'comment_id': comment_id})
 
@@ -459,99 +735,107 @@ def remove(comment_id):
     Returns:
     Response: JSON confirming the removal action.
     """
-    # Find and remove the comment
-    comment = comments_collection.find_one({'id': comment_id})
-    
-    if not comment:
+    if not request_removal(comment_id):
         return jsonify({'message': 'Comment not found', 'comment_id': comment_id}), 404
+    return jsonify({'message': 'Comment removed successfully', 'comment_id': comment_id})
 
-    comments_collection.update_one({'id': comment_id}, {'$set': {'status': 'PENDING_REMOVE'}})
+def request_removal(comment_id):
+    """
+    Marks a comment PENDING_REMOVE, sends the decision as telemetry and queues its removal.
 
-    try:
-        moderation_model._log_comment(action_type=2, comment=comment["text"], label=1)
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-    else:
-        remove_comment(comment_id)
-        return jsonify({'message': 'Comment removed successfully', 'comment_id': comment_id})
+    Used by the /api/remove route and by the moderation actions, which run on worker threads
+    without a Flask context.
 
-def evaluate_comment(comment_text):
-    """
-    Evaluate the given comment for profanity using the profane_detector model 
-    designed for HaSpDe. Note: The profanity detection feature has been deprecated 
-    and will no longer be supported in future updates.
-    
-    Parameters:
-    comment_text (str): The text of the comment to evaluate.
-    
     Returns:
-    str: "Positive" if no profanity is detected, "Negative" otherwise.
+    bool: False if the comment is not in the database.
     """
-    logger.debug(f"Evaluating comment: {comment_text}")
+    comment = comments_collection.find_one({'id': comment_id}, {'text': 1})
+    if not comment:
+        return False
 
-    result = False  # This would normally involve a detection model
-    logger.debug(f"Profane detector result: {result}")
+    moderation_counters.transition({'id': comment_id}, 'PENDING_REMOVE', {'$unset': ReviewQueue.LEASE_FIELDS})
+    telemetry_executor.submit(tracer.wrap(moderation_model._log_comment), action_type=2, comment=comment["text"], label=1)
+    remove_comment(comment_id)
+    return True
 
-    # Determine evaluation based on detection result
-    evaluation = "Negative" if result else "Positive"
-    logger.debug(f"Evaluation result: {evaluation}")
 
-    return evaluation
+def remember_comment(comment_id, media_id, platform):
+    """Keep the media ID and platform of a stored comment so actions on it skip the database."""
+    recent_comments[comment_id] = (media_id, platform)
+    if len(recent_comments) > RECENT_COMMENTS_MAX:
+        recent_comments.popitem(last=False)
 
 
 def init_comment(comment_id):
+    # Recently stored comments are known without a database round trip
+    cached = recent_comments.get(comment_id)
+    if cached and cached[0]:
+        media_id, platform = cached
+        return {'id': comment_id, 'media_id': media_id, 'platform': platform}, media_id, platform
+
     # Fetch the comment details to get the media ID and platform
-    comment = comments_collection.find_one({'id': comment_id})
+    comment = comments_collection.find_one({'id': comment_id}, {'id': 1, 'media_id': 1, 'platform': 1})
     if not comment:
-        logger.critical(f"Comment with ID {comment_id} not found in the database.")
+        logger.critical("Comment with ID %s not found in the database.", comment_id)
         return
 
     media_id = comment.get('media_id')
     platform = comment.get('platform')  # Assuming you have a field for the platform
 
     if not media_id:
-        logger.error(f"No media ID found for comment ID {comment_id}.")
+        logger.error("No media ID found for comment ID %s.", comment_id)
         return
 
+    remember_comment(comment_id, media_id, platform)
     return comment, media_id, platform
 
 
-def remove_comment(comment_id):
+@traced("remove_comment")
+def remove_comment(comment_id, attempts=0):
     """
     Remove a comment from Facebook or Instagram using the Graph API.
     Parameters:
     comment_id (str): The unique identifier for the comment to be removed.
+    attempts (int, optional): Earlier failed attempts, when this is a retry.
+    Returns:
+    Future: Resolves to (ok, status_code, body) once the request has been sent.
     """
     comment, media_id, platform = init_comment(comment_id)
 
-    url = f"https://graph.facebook.com/{INSTAGRAM_API_VERSION}/{comment_id}"
+    access_token, page_id = action_target(media_id, platform)
 
-    headers = token_(media_id, platform)
+    # Queue the DELETE request, it is sent with other pending actions
+    return action_dispatcher.submit(GraphAction.DELETE, comment_id, access_token, page_id,
+                                    callback=lambda ok, status_code, body: _on_remove_result(comment_id, attempts, ok, status_code, body))
 
-    try:
-        # Send a DELETE request to remove the comment
-        response = requests.delete(url, headers=headers)
-
-        if response.status_code == 200:
-            logger.info(f"Comment with ID {comment_id} removed successfully.")
-            # Update the comment status in the database
-            comments_collection.update_many({'id': comment_id}, {'$set': {'status': 'REMOVED'}})
-        else:
-            comments_collection.update_many({'id': comment_id}, {'$set': {'status': 'REMOVE_FAILED', "error": response.text}})
+def _on_remove_result(comment_id, attempts, ok, status_code, body):
+    """Record the outcome of a comment removal."""
+    if ok:
+        logger.info("Comment with ID %s removed successfully.", comment_id, extra={'comment_id': comment_id})
+        # Update the comment status in the database
+        moderation_counters.transition({'id': comment_id}, 'REMOVED', {'$unset': RetrySweeper.RETRY_FIELDS})
+    else:
+        moderation_counters.transition({'id': comment_id}, 'REMOVE_FAILED', {'$set': {"error": body}})
+        retry_sweeper.record_failure(comment_id, "remove", body, attempts)
 
-            logger.warning(f"Failed to remove comment with ID {comment_id}. Status code: {response.status_code}, Response: {response.text}")
+        logger.warning("Failed to remove comment with ID %s. Status code: %s, Response: %.500s", comment_id, status_code, body,
+                       extra={'comment_id': comment_id})
 
-    except requests.RequestException as e:
-        logger.error(f"An error occurred while trying to remove comment with ID {comment_id}: {e}")
+def action_target(media_id, platform):
+    """
+    Resolve the access token and the page to rate limit for an action on a comment.
 
-def token_(media_id, platform):
+    Returns:
+    tuple: (access_token, page_id)
+    """
     if platform == "instagram":
-        access_token = INSTAGRAM_ACCESS_TOKEN
+        return INSTAGRAM_ACCESS_TOKEN, media_owner_cache.get(media_id)
 
-    elif platform == "facebook":
-        owner_id = media_id.split('_')[0]  # Get the part before the underscore
-        access_token = get_facebook_token(owner_id)
+    owner_id = media_id.split('_')[0]  # Get the part before the underscore
+    return get_facebook_token(owner_id), owner_id
 
+def token_(media_id, platform):
+    access_token, _ = action_target(media_id, platform)
     headers = {'Authorization': f'Bearer {access_token}'}
     return headers
 
@@ -570,69 +854,75 @@ def _str_bool(value):
     
     # If the input is neither a boolean nor a recognized string, return None or raise an error
     return None  # or raise ValueError("Input must be a boolean or a string.")
-def hide_comment(comment_id, log=True, unhide=False):
+@traced("hide_comment")
+def hide_comment(comment_id, log=True, unhide=False, attempts=0):
     """
     Hide or unhide a comment on Instagram using the Instagram Graph API.
 
     :param comment_id: The ID of the comment to hide or unhide.
     :param log: Whether to log the operation status (default is True).
     :param unhide: If True, the comment will be unhidden; if False, it will be hidden (default is False).
-    :return: Response of the API request.
+    :param attempts: Earlier failed attempts, when this is a retry (default is 0).
+    :return: Future resolving to (ok, status_code, body) once the request has been sent.
     """
     # Initialize the comment, media_id, and platform
     comment, media_id, platform = init_comment(comment_id)
 
-    # Construct the API endpoint URL
-    url = f"https://graph.facebook.com/{INSTAGRAM_API_VERSION}/{comment_id}"
-
-    # Prepare the headers and parameters for the request
-    headers = token_(media_id, platform)
-    params = {
-        "is_hidden": str(unhide).lower(),  # Set to 'true' for hiding, 'false' for unhiding
-        "hide": unhide  # Use the same boolean value for the 'hide' parameter
-    }
-
-    # Send the POST request to the API
-    response = requests.post(url, params=params, headers=headers)
+    # Queue the request, it is sent with other pending actions
+    access_token, page_id = action_target(media_id, platform)
+    kind = GraphAction.UNHIDE if unhide else GraphAction.HIDE
+    return action_dispatcher.submit(kind, comment_id, access_token, page_id,
+                                    callback=lambda ok, status_code, body: _on_hide_result(comment_id, log, unhide, attempts, ok, status_code, body))
 
-    # Process the response
-    if response.status_code == 200:
+def _on_hide_result(comment_id, log, unhide, attempts, ok, status_code, body):
+    """Record the outcome of hiding or unhiding a comment."""
+    if ok:
         # Determine the new status and hidden state based on the operation
         status = "APPROVED" if unhide else "HIDDEN"
         hidden = 0 if unhide else 1
 
         # Update the comment status in the database
-        to_set = {'hidden': hidden}
+        update = {'$set': {'hidden': hidden}, '$unset': RetrySweeper.RETRY_FIELDS}
         if log:
-            to_set['status'] = status
-
-        comments_collection.update_many({'id': comment_id}, {'$set': to_set})
+            moderation_counters.transition({'id': comment_id}, status, update)
+        else:
+            comments_collection.update_many({'id': comment_id}, update)
 
         # Log the action if logging is enabled
         if log:
-            logger.info(f"Comment with ID {comment_id} has been {'un' if unhide else ''}hidden successfully.")
+            logger.info("Comment with ID %s has been %shidden successfully.", comment_id, 'un' if unhide else '',
+                        extra={'comment_id': comment_id})
     else:
-        logger.warning(f"Failed to {'un' if unhide else ''}hide comment with ID {comment_id}. "
-                       f"Status code: {response.status_code}, Response: {response.text}")
+        logger.warning("Failed to %shide comment with ID %s. Status code: %s, Response: %.500s",
+                       'un' if unhide else '', comment_id, status_code, body, extra={'comment_id': comment_id})
+        retry_sweeper.record_failure(comment_id, "unhide" if unhide else "hide", body, attempts, log)
+
+def retry_failed_action(comment):
+    """
+    Re-dispatch the failed action recorded on a comment document.
+
+    Returns:
+    Future: Resolves to (ok, status_code, body) once the request has been sent.
+    """
+    retry = comment.get('retry_action') or {}
+    attempts = comment.get('attempts', 0)
+
+    if retry.get('action') == "remove":
+        return remove_comment(comment['id'], attempts=attempts)
+    return hide_comment(comment['id'], log=retry.get('log', True),
+                        unhide=retry.get('action') == "unhide", attempts=attempts)
 
 def method_not_allowed():
     logger.warning("Method not allowed!")
     return jsonify({'error': 'Method not allowed'}), 405
 
 def get_facebook_token(owner_id):
-    # Fetch user info to find the corresponding page access token
-    user = db_2.users.find_one({'managed_pages.page_id': owner_id})
-    if user:
-        for page in user['managed_pages']:
-            if page['page_id'] == owner_id:
-                page_access_token = page['page_access_token']
-                return page_access_token
-        else:
-            logger.critical(f"No access token found for owner ID {owner_id}.")
-            return
-    else:
-        logger.critical(f"No user found for owner ID {owner_id}.")
+    # Page access tokens are served from memory, see PageTokenStore
+    page_access_token = page_tokens.get(owner_id)
+    if not page_access_token:
+        logger.critical("No access token found for owner ID %s.", owner_id)
         return
+    return page_access_token
 
 def facebook_remove_handler(media_id): # For Facebook, derive the owner ID
     owner_id = media_id.split('_')[0]  # Get the part before the underscore
@@ -643,34 +933,89 @@ def facebook_remove_handler(media_id): # For Facebook, derive the owner ID
     return headers
 
 
+@app.route('/api/retry_stats', methods=['GET'])
+def retry_stats():
+    """
+    API endpoint reporting the retry backlog and recovery latency of failed actions.
+    Returns:
+    Response: JSON with the retry sweeper's counters.
+    """
+    return jsonify(retry_sweeper.stats())
+
+
+def comments_response(args):
+    """Streams one page of comments as a JSON array, or a 400 error for bad arguments."""
+    try:
+        comments = comment_listing.page(args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    return Response(stream_with_context(CommentListing.stream(comments)), mimetype='application/json')
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Metrics in the Prometheus text format, including p50/p90/p99 latency of every pipeline stage.
+    Returns:
+    Response: text/plain Prometheus exposition.
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    """
+    API endpoint reporting how many comments are in each status.
+    Query parameters: `platform` or `owner_id` narrow the counts to one platform or owner.
+    Returns:
+    Response: JSON with the counts per status, read from the maintained counters.
+    """
+    platform = request.args.get('platform')
+    owner_id = request.args.get('owner_id')
+    response = {'counts': moderation_counters.stats(platform, owner_id)}
+    if platform or owner_id:
+        response.update({'platform': platform, 'owner_id': owner_id})
+    else:
+        response['platforms'] = moderation_counters.platforms()
+    return jsonify(response)
+
+
 @app.route('/get_comments', methods=['GET'])
 def get_comments():
-    limit = int(request.args.get('limit', 10))  # Default to 10 if not specified
-    # Fetch the most recent comments
-    comments = list(comments_collection.find().sort('_id', -1).limit(limit))
-    
-    # Prepare comments for response (convert ObjectId to str)
-    for comment in comments:
-        comment['_id'] = str(comment['_id'])
-    
-    return jsonify(comments)
+    """
+    Lists comments, newest first.
+    Query parameters: `limit` (capped), `before`/`after` (comment `_id` cursors) and
+    the optional filters `status`, `platform` and `owner_id`.
+    """
+    return comments_response(request.args)
 
 @app.route('/get_new_comments', methods=['GET'])
 def get_new_comments():
+    """Lists comments added after `afterId`, oldest first, at most one page at a time."""
     after_id = request.args.get('afterId')
-    new_comments = []
-    
-    if after_id:
-        # Fetch comments that were added after the given comment ID
-        new_comments = list(comments_collection.find({
-            '_id': {'$gt': ObjectId(after_id)}
-        }).sort('_id', 1))  # Sort ascending to get newer comments
+    if not after_id:
+        return jsonify([])
 
-    # Prepare comments for response
-    for comment in new_comments:
-        comment['_id'] = str(comment['_id'])
+    args = request.args.to_dict()
+    args['after'] = after_id
+    return comments_response(args)
 
-    return jsonify(new_comments)
+@app.route('/stream/comments', methods=['GET'])
+def stream_comments():
+    """
+    Streams new comments and status changes to the dashboard as Server-Sent Events.
+    Reconnecting clients resume from the Last-Event-ID header, or from `afterId` on the first connect.
+
+    Every open stream holds one server thread for as long as the dashboard is open, so at most
+    FEED_MAX_SUBSCRIBERS are served; the others get a 503 and the dashboard polls /get_new_comments.
+    """
+    if comment_feed.subscriber_count() >= config.FEED_MAX_SUBSCRIBERS:
+        return jsonify({'error': 'Too many live feed connections'}), 503
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('afterId')
+    return Response(
+        stream_with_context(comment_feed.subscribe(last_event_id)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route("/")
 def index():
@@ -0,0 +1,283 @@
+"""
+Moves finalized comments out of the live collection into compressed archive files.
+
+Comments that are APPROVED, REMOVED or HIDDEN and older than a number of days
+are written to JSONL files compressed with zstandard (gzip when the
+`zstandard` package is not installed), partitioned by day and owner:
+
+    <archive>/day=2024-05-01/owner=1784.../part-<first _id>.jsonl.zst
+
+Each batch is written to temporary files that are renamed into place, and
+only then deleted from MongoDB, so an interrupted run is resumed by running
+it again. A part file is named after the first comment in its batch, so the
+rerun rewrites the same files instead of adding duplicates.
+
+Usage:
+    python archive_comments.py archive --archive ./archive --days 90 --rate 2000
+    python archive_comments.py query --archive ./archive --owner 1784... --since 2024-05-01 --text spam
+    python archive_comments.py ttl --days 180
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from log import logger
+
+FINALIZED = ['APPROVED', 'REMOVED', 'HIDDEN']
+TTL_INDEX = "created_at_ttl"
+
+
+def open_part(path, mode):
+    """Opens an archive part for text reading or writing, by its extension."""
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("Reading .zst archives needs the 'zstandard' package.")
+        raw = open(path, mode + "b")
+        if mode == "w":
+            stream = zstandard.ZstdCompressor(level=10).stream_writer(raw)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return gzip.open(path, mode + "t", encoding="utf-8")
+
+
+def partition(comment):
+    """Returns the (day, owner) partition of a comment."""
+    day = comment['_id'].generation_time.strftime("%Y-%m-%d")
+    return day, str(comment.get('owner_id') or "unknown")
+
+
+def to_record(comment):
+    record = dict(comment)
+    record['_id'] = str(comment['_id'])
+    record.setdefault('created_at', comment['_id'].generation_time.replace(tzinfo=None))
+    return json.dumps(record, default=str, ensure_ascii=False)
+
+
+class CommentArchiver:
+    """Archives finalized comments in bulk, resumably and at a limited rate."""
+
+    def __init__(self, collection, archive_dir, days=90, batch_size=1000, rate=2000, counters=None):
+        """
+        Args:
+            collection: The comments collection.
+            archive_dir (str): Directory the archive is written to.
+            days (int): Minimum age in days of archived comments.
+            batch_size (int): Comments read, written and deleted per batch.
+            rate (float): Maximum comments archived per second, 0 for no limit.
+            counters (ModerationCounters, optional): Decremented for every archived comment.
+        """
+        self.collection = collection
+        self.archive_dir = archive_dir
+        self.days = days
+        self.batch_size = batch_size
+        self.rate = rate
+        self.counters = counters
+        self.extension = ".jsonl.zst" if zstandard is not None else ".jsonl.gz"
+
+    def run(self, dry_run=False):
+        """
+        Archives every finalized comment older than `days`.
+
+        Returns:
+            int: The number of comments archived.
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        cutoff = ObjectId.from_datetime(datetime.utcnow() - timedelta(days=self.days))
+        last_id = None
+        archived = 0
+        started = time.monotonic()
+
+        while True:
+            id_range = {'$lt': cutoff}
+            if last_id is not None:
+                id_range['$gt'] = last_id
+            # Served by the (status, _id) index
+            batch = list(self.collection.find({'status': {'$in': FINALIZED}, '_id': id_range})
+                         .sort('_id', ASCENDING).limit(self.batch_size))
+            if not batch:
+                break
+
+            if dry_run:
+                archived += len(batch)
+                last_id = batch[-1]['_id']
+                continue
+
+            self.write_batch(batch)
+            ids = [comment['_id'] for comment in batch]
+            self.collection.delete_many({'_id': {'$in': ids}})
+            if self.counters is not None:
+                self.counters.record_many(
+                    (comment.get('platform'), comment.get('owner_id'), comment.get('status'), None)
+                    for comment in batch
+                )
+
+            last_id = ids[-1]
+            archived += len(batch)
+            logger.info("Archived %d comments, up to %s.", archived, last_id)
+
+            # Throttle to `rate` comments per second to leave headroom for the live service
+            if self.rate:
+                ahead = archived / self.rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        return archived
+
+    def write_batch(self, batch):
+        """Writes one batch into its day/owner partitions, each part atomically."""
+        groups = {}
+        for comment in batch:
+            groups.setdefault(partition(comment), []).append(comment)
+
+        for (day, owner), comments in groups.items():
+            directory = os.path.join(self.archive_dir, f"day={day}", f"owner={owner}")
+            os.makedirs(directory, exist_ok=True)
+            name = f"part-{comments[0]['_id']}{self.extension}"
+            temporary = os.path.join(directory, ".tmp-" + name)
+            with open_part(temporary, "w") as f:
+                for comment in comments:
+                    f.write(to_record(comment) + "\n")
+            os.replace(temporary, os.path.join(directory, name))
+
+
+def query_archive(archive_dir, owner=None, since=None, until=None, status=None, text=None, comment_id=None):
+    """
+    Yields archived comments matching the filters, pruning partitions by day and owner.
+
+    Args:
+        since (str, optional): First day included, as YYYY-MM-DD.
+        until (str, optional): Last day included, as YYYY-MM-DD.
+        text (str, optional): Case-insensitive substring of the comment text.
+    """
+    for day_dir in sorted(os.listdir(archive_dir)):
+        if not day_dir.startswith("day="):
+            continue
+        day = day_dir[4:]
+        if (since and day < since) or (until and day > until):
+            continue
+        owners = os.listdir(os.path.join(archive_dir, day_dir))
+        for owner_dir in sorted(owners):
+            if owner and owner_dir != f"owner={owner}":
+                continue
+            directory = os.path.join(archive_dir, day_dir, owner_dir)
+            # A rerun after an interrupted batch can leave a comment in two parts, always of the same
+            # partition, so the IDs seen are only kept for one partition at a time
+            seen = set()
+            for name in sorted(os.listdir(directory)):
+                if not name.startswith("part-"):
+                    continue
+                with open_part(os.path.join(directory, name), "r") as f:
+                    for line in f:
+                        record = json.loads(line)
+                        if record['_id'] in seen:
+                            continue
+                        if status and record.get('status') != status:
+                            continue
+                        if comment_id and record.get('id') != comment_id:
+                            continue
+                        if text and text.lower() not in (record.get('text') or "").lower():
+                            continue
+                        seen.add(record['_id'])
+                        yield record
+
+
+def ensure_ttl_index(collection, days):
+    """
+    Expires finalized comments from the live collection `days` after `created_at`, or removes the expiry when 0.
+
+    Comments stored before `created_at` was recorded get it from their `_id` first, otherwise
+    they would never expire. Partial TTL indexes with `$in` need MongoDB 6.0 or newer.
+    Keep `days` above the archive age, or comments are deleted before they are archived.
+
+    Returns:
+        int: The number of comments `created_at` was added to.
+    """
+    if TTL_INDEX in collection.index_information():
+        collection.drop_index(TTL_INDEX)
+    if not days:
+        return 0
+
+    backfilled = collection.update_many(
+        {'created_at': {'$exists': False}},
+        [{'$set': {'created_at': {'$toDate': '$_id'}}}]
+    ).modified_count
+    if backfilled:
+        logger.info("Set created_at from _id on %d older comments.", backfilled)
+    collection.create_index(
+        [('created_at', ASCENDING)],
+        name=TTL_INDEX,
+        expireAfterSeconds=int(days * 86400),
+        partialFilterExpression={'status': {'$in': FINALIZED}}
+    )
+    return backfilled
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive finalized comments and query the archive.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    archive = commands.add_parser("archive", help="Move old finalized comments to the archive")
+    archive.add_argument("--archive", default="archive", help="Archive directory")
+    archive.add_argument("--days", type=int, default=90, help="Archive comments older than this many days")
+    archive.add_argument("--batch-size", type=int, default=1000)
+    archive.add_argument("--rate", type=float, default=2000, help="Maximum comments per second, 0 for no limit")
+    archive.add_argument("--dry-run", action="store_true", help="Count the comments that would be archived")
+
+    query = commands.add_parser("query", help="Print archived comments as JSON lines")
+    query.add_argument("--archive", default="archive", help="Archive directory")
+    query.add_argument("--owner")
+    query.add_argument("--since", help="First day, YYYY-MM-DD")
+    query.add_argument("--until", help="Last day, YYYY-MM-DD")
+    query.add_argument("--status", choices=FINALIZED)
+    query.add_argument("--text", help="Substring of the comment text")
+    query.add_argument("--id", dest="comment_id", help="Platform comment ID")
+    query.add_argument("--count", action="store_true", help="Only print the number of matches")
+
+    ttl = commands.add_parser("ttl", help="Expire finalized comments from the live collection")
+    ttl.add_argument("--days", type=float, required=True, help="Days after creation, 0 removes the expiry")
+
+    args = parser.parse_args()
+
+    if args.command == "query":
+        matches = query_archive(args.archive, args.owner, args.since, args.until,
+                                args.status, args.text, args.comment_id)
+        if args.count:
+            print(sum(1 for _ in matches))
+        else:
+            for record in matches:
+                sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return
+
+    from database_manager import DatabaseManager
+    from moderation_counters import ModerationCounters
+
+    db = DatabaseManager().get_instance().get_db()
+    comments = db['comments']
+
+    if args.command == "ttl":
+        ensure_ttl_index(comments, args.days)
+        print(f"TTL on finalized comments set to {args.days} days." if args.days else "TTL removed.")
+        return
+
+    archiver = CommentArchiver(comments, args.archive, args.days, args.batch_size, args.rate,
+                               counters=ModerationCounters(db['moderation_counters'], comments))
+    count = archiver.run(dry_run=args.dry_run)
+    print(f"{'Would archive' if args.dry_run else 'Archived'} {count} comments.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,573 @@
+"""
+Asyncio variant of the HaSpDe SoMe webhook service.
+
+Serves the same routes as app.py on an ASGI server, using Motor for MongoDB
+and httpx for the Graph API, so a comment waiting on I/O does not hold a
+thread. CPU-bound ModerationModel inference runs in an executor.
+
+The stored comment, the action for each verdict (comment_pipeline) and the
+retry state of a failed action (RetrySweeper.failure_update) are shared with
+app.py. The rest is a smaller pipeline, and this service depends on app.py
+running against the same database:
+
+- failed actions are only recorded here; app.py's RetrySweeper retries them,
+  and dead-letters them after `retry_max_attempts`
+- the moderation counters behind /stats are not updated, run
+  `ModerationCounters.reconcile` (app.py does every `stats_reconcile_hours`)
+- there is no /metrics, tracing, load shedding, inference pool, ordered
+  moderation per owner, action scheduling, or Graph API batching and rate
+  limiting; every action is its own request
+
+Run with:
+    uvicorn asgi_app:app --port 5000
+"""
+import asyncio
+import random
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import httpx
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+from starlette.templating import Jinja2Templates
+
+from comment_listing import CommentListing
+from comment_pipeline import APPROVE, HIDE, REMOVE, REVIEW, action_for, comment_document
+from config import Config
+from log import logger
+from moderation_model import ModerationModel
+from retry_sweeper import RetrySweeper
+from review_queue import ReviewQueue
+
+config = Config()
+templates = Jinja2Templates(directory="templates")
+
+INSTAGRAM_ACCESS_TOKEN = config.INSTAGRAM_ACCESS_TOKEN
+INSTAGRAM_API_VERSION = config.INSTAGRAM_API_VERSION
+INSTAGRAM_VERIFY_TOKEN = config.INSTAGRAM_VERIFY_TOKEN
+HUMAN_REVIEW = config.HUMAN_REVIEW
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Most comments one reviewer can claim in one call, as in app.py
+MAX_REVIEW_BATCH = 20
+
+
+class AsyncGraph:
+    """Minimal async Graph API client with a pooled connection and jittered retries."""
+
+    def __init__(self, base_url, api_version, timeout, max_retries, max_connections=200):
+        self.api_version = api_version
+        self.max_retries = max_retries
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    async def request(self, method, path, access_token=None, params=None):
+        headers = {'Authorization': f'Bearer {access_token}'} if access_token else None
+        url = f"/{self.api_version}/{path.lstrip('/')}"
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.client.request(method, url, params=params, headers=headers)
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                    return response
+            await asyncio.sleep(random.uniform(0, 0.5 * (2 ** attempt)))
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class State:
+    """Connections and caches created when the application starts."""
+    mongo = None
+    comments = None
+    db_2 = None
+    media_owners = None
+    graph = None
+    model = None
+    executor = None
+    processed_comments = set()
+    owner_cache = OrderedDict()
+    page_tokens = {}
+    page_tokens_loaded_at = 0.0
+
+
+state = State()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    state.mongo = AsyncIOMotorClient(config.MONGO_URI, maxPoolSize=200)
+    db = state.mongo[config.MONGO_DBNAME]
+    state.comments = db['comments']
+    state.media_owners = db['media_owners']
+    state.db_2 = state.mongo["HaSpDeDash"]
+    state.graph = AsyncGraph(config.GRAPH_API_URL, INSTAGRAM_API_VERSION,
+                             config.GRAPH_TIMEOUT, config.GRAPH_MAX_RETRIES)
+    state.executor = ThreadPoolExecutor(max_workers=config.INFERENCE_THREADS, thread_name_prefix="inference")
+    state.model = ModerationModel(config.IMPROVE, HUMAN_REVIEW, certainty_needed=config.CERTAINTY_NEEDED,
+                                  updates_url=config.UPDATES_URL)
+    await load_page_tokens()
+    logger.info("Async HaSpDe SoMe service started.")
+    try:
+        yield
+    finally:
+        await state.graph.close()
+        state.executor.shutdown(wait=False)
+        state.mongo.close()
+
+
+async def webhook(request):
+    """Handle webhook verification (GET) and events (POST)."""
+    if request.method == 'GET':
+        params = request.query_params
+        if params.get('hub.mode') == 'subscribe' and params.get('hub.verify_token') == INSTAGRAM_VERIFY_TOKEN:
+            logger.info("Instagram verification successful!")
+            return PlainTextResponse(params.get('hub.challenge', ''))
+        logger.critical("Invalid verification token!")
+        return JSONResponse({'error': 'Invalid verification token'}, status_code=403)
+
+    data = await request.json()
+    comments = []
+
+    if data.get("object") == "page":
+        for entry in data.get("entry", []):
+            for change in entry.get('changes', []) or []:
+                value = change.get('value')
+                if change.get('field') == 'feed' and value and value.get('item') == 'comment':
+                    comments.append(process_facebook_comment(value))
+
+    elif data.get('object') == 'instagram':
+        for entry in data.get('entry', []):
+            for change in entry.get('changes', []) or []:
+                if change.get('field') == 'comments' and 'value' in change:
+                    comments.append(process_instagram_comment(change['value']))
+
+    else:
+        logger.error("CRITICAL ERROR")
+
+    await asyncio.gather(*comments)
+    return JSONResponse({'status': 'ok'})
+
+
+async def process_facebook_comment(comment_data):
+    comment_id = comment_data.get('comment_id')
+    post_id = comment_data.get('post_id')
+    owner_id = post_id.split('_')[0] if post_id else None
+
+    if not comment_id:
+        logger.error("Comment ID is missing in the comment data.")
+        return
+
+    await comment_to_db(comment_id, comment_data.get('message', ''), 'facebook',
+                        comment_data['from']['id'], comment_data['from'].get('name', 'Unknown User'), post_id, owner_id)
+    if not HUMAN_REVIEW:
+        await handle_comment(comment_data, owner_id)
+
+
+async def process_instagram_comment(comment_data):
+    comment_id = comment_data.get('id')
+    media_id = comment_data['media']['id']
+
+    if not comment_id:
+        logger.error("Comment ID is missing in the comment data.")
+        return
+
+    owner_id = await get_instagram_owner_id(media_id)
+    await comment_to_db(comment_id, comment_data.get('text', ''), 'instagram',
+                        comment_data['from']['id'], comment_data['from'].get('username', 'Unknown User'), media_id, owner_id)
+    if not HUMAN_REVIEW:
+        await handle_comment(comment_data, owner_id)
+
+
+async def comment_to_db(comment_id, comment_text, platform, user_id=None, user_name='Unknown User', media_id=None,
+                        owner_id=None):
+    """Store a comment unless it is already in the database."""
+    try:
+        await state.comments.update_one(
+            {'id': comment_id},
+            {'$setOnInsert': comment_document(comment_id, comment_text, platform, user_id, user_name, media_id,
+                                              owner_id)},
+            upsert=True
+        )
+    except Exception as e:
+        logger.error(f"Error inserting comment with ID {comment_id}: {e}")
+
+
+async def handle_comment(comment_data, owner_id=None):
+    """Moderate a comment and act on the result."""
+    comment_id = comment_data.get('comment_id') or comment_data.get('id')
+    comment_text = comment_data.get('message') or comment_data.get('text', '')
+
+    if comment_id in state.processed_comments:
+        logger.warning(f"Comment with id '{comment_id}' has already been processed. Skipping.")
+        return
+    state.processed_comments.add(comment_id)
+
+    owner_config = await state.db_2.owner_configs.find_one({'owner_id': owner_id})
+
+    loop = asyncio.get_running_loop()
+    moderation_result = await loop.run_in_executor(
+        state.executor, state.model.moderate_comment, comment_text, owner_config)
+
+    action = action_for(moderation_result, config.MODE)
+    if action == APPROVE:
+        logger.debug(f"Comment {comment_id} has been approved.")
+    elif action == HIDE:
+        await hide_comment(comment_id)
+    elif action == REMOVE:
+        await remove_action(comment_id)
+    elif action == REVIEW:
+        await send_for_human_review(comment_id)
+    else:
+        logger.error(f"Unknown moderation result: {moderation_result} for comment {comment_id}")
+
+
+async def send_for_human_review(comment_id):
+    await state.comments.update_one({'id': comment_id}, {'$set': {'status': 'PENDING_REVIEW', 'hidden': '1'}})
+    logger.info(f"Comment {comment_id} is now queued for human review.")
+    await hide_comment(comment_id, log=False)
+
+
+async def get_instagram_owner_id(media_id):
+    """Resolve the owner of an Instagram media through memory, MongoDB and the Graph API."""
+    owner_id = state.owner_cache.get(media_id)
+    if owner_id:
+        return owner_id
+
+    doc = await state.media_owners.find_one({'media_id': media_id}, {'owner_id': 1})
+    if doc:
+        owner_id = doc['owner_id']
+    else:
+        try:
+            response = await state.graph.request("GET", media_id, INSTAGRAM_ACCESS_TOKEN, {'fields': 'owner'})
+        except httpx.HTTPError as e:
+            logger.error(f"An error occurred while retrieving owner ID for media {media_id}: {e}")
+            return None
+        if response.status_code != 200:
+            logger.warning(f"Failed to get owner ID for media {media_id}. Status code: {response.status_code}")
+            return None
+        owner_id = response.json().get('owner', {}).get('id')
+        if not owner_id:
+            return None
+        await state.media_owners.update_one(
+            {'media_id': media_id},
+            {'$set': {'owner_id': owner_id, 'resolved_at': datetime.utcnow()}},
+            upsert=True
+        )
+
+    state.owner_cache[media_id] = owner_id
+    if len(state.owner_cache) > 10000:
+        state.owner_cache.popitem(last=False)
+    return owner_id
+
+
+async def load_page_tokens():
+    """Load every Facebook page access token into memory."""
+    tokens = {}
+    async for user in state.db_2.users.find(
+            {'managed_pages.page_id': {'$exists': True}},
+            {'_id': 0, 'managed_pages.page_id': 1, 'managed_pages.page_access_token': 1}):
+        for page in user.get('managed_pages', []):
+            if page.get('page_id') and page.get('page_access_token'):
+                tokens[page['page_id']] = page['page_access_token']
+    state.page_tokens = tokens
+    state.page_tokens_loaded_at = time.monotonic()
+
+
+async def access_token_for(media_id, platform):
+    if platform == "instagram":
+        return INSTAGRAM_ACCESS_TOKEN
+
+    owner_id = media_id.split('_')[0]
+    if owner_id not in state.page_tokens and time.monotonic() - state.page_tokens_loaded_at > 30:
+        await load_page_tokens()
+    token = state.page_tokens.get(owner_id)
+    if not token:
+        logger.critical(f"No access token found for owner ID {owner_id}.")
+    return token
+
+
+async def record_failure(comment_id, action, error, log=True):
+    """Leave retry state for the RetrySweeper of the Flask service, which retries with backoff."""
+    # Actions sent here are first attempts, the retries are sent by the sweeper
+    update = RetrySweeper.failure_update(action, error, 1, log, config.RETRY_MAX_ATTEMPTS, config.RETRY_BASE_DELAY)
+    await state.comments.update_many({'id': comment_id}, update)
+
+
+async def graph_action(comment_id, method, params=None):
+    """Send a hide/unhide/delete for a comment. Returns (ok, body)."""
+    comment = await state.comments.find_one({'id': comment_id}, {'media_id': 1, 'platform': 1})
+    if not comment or not comment.get('media_id'):
+        logger.critical(f"Comment with ID {comment_id} not found in the database.")
+        return False, "Comment not found"
+
+    access_token = await access_token_for(comment['media_id'], comment.get('platform'))
+    try:
+        response = await state.graph.request(method, comment_id, access_token, params)
+    except httpx.HTTPError as e:
+        return False, str(e)
+    return response.status_code == 200, response.text
+
+
+async def hide_comment(comment_id, log=True, unhide=False):
+    hidden = str(not unhide).lower()
+    ok, body = await graph_action(comment_id, "POST", {"is_hidden": hidden, "hide": hidden})
+
+    if ok:
+        to_set = {'hidden': 0 if unhide else 1}
+        if log:
+            to_set['status'] = "APPROVED" if unhide else "HIDDEN"
+        await state.comments.update_many({'id': comment_id}, {'$set': to_set, '$unset': RetrySweeper.RETRY_FIELDS})
+        if log:
+            logger.info(f"Comment with ID {comment_id} has been {'un' if unhide else ''}hidden successfully.")
+    else:
+        logger.warning(f"Failed to {'un' if unhide else ''}hide comment with ID {comment_id}. Response: {body}")
+        await record_failure(comment_id, "unhide" if unhide else "hide", body, log)
+
+
+async def remove_comment(comment_id):
+    ok, body = await graph_action(comment_id, "DELETE")
+
+    if ok:
+        logger.info(f"Comment with ID {comment_id} removed successfully.")
+        await state.comments.update_many({'id': comment_id}, {'$set': {'status': 'REMOVED'},
+                                                              '$unset': RetrySweeper.RETRY_FIELDS})
+    else:
+        logger.warning(f"Failed to remove comment with ID {comment_id}. Response: {body}")
+        await state.comments.update_many({'id': comment_id}, {'$set': {'status': 'REMOVE_FAILED', 'error': body}})
+        await record_failure(comment_id, "remove", body)
+
+
+async def log_decision(action_type, text, label):
+    """Send a reviewer's decision to the training log without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(state.executor, lambda: state.model._log_comment(
+        action_type=action_type, comment=text, label=label))
+
+
+async def remove_action(comment_id):
+    comment = await state.comments.find_one({'id': comment_id}, {'text': 1})
+    if not comment:
+        return JSONResponse({'message': 'Comment not found', 'comment_id': comment_id}, status_code=404)
+
+    await state.comments.update_one({'id': comment_id}, {'$set': {'status': 'PENDING_REMOVE'}, '$unset': ReviewQueue.LEASE_FIELDS})
+    try:
+        await log_decision(2, comment["text"], 1)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+    await remove_comment(comment_id)
+    return JSONResponse({'message': 'Comment removed successfully', 'comment_id': comment_id})
+
+
+async def claim_for_review(reviewer_id):
+    return await state.comments.find_one_and_update(
+        {'status': ReviewQueue.PENDING},
+        ReviewQueue.claim_update(reviewer_id, config.REVIEW_LEASE_SECONDS),
+        sort=[('_id', 1)],
+        projection=ReviewQueue.PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def reviewer_of(request):
+    """Identify the reviewer making the request."""
+    return (request.headers.get('X-Reviewer-Id') or request.query_params.get('reviewer')
+            or (request.client.host if request.client else None))
+
+
+async def release_expired():
+    """Return comments with expired review leases to the queue; returns how many were released."""
+    released = await state.comments.update_many(ReviewQueue.expired_filter(), ReviewQueue.release_update())
+    return released.modified_count
+
+
+async def review(request):
+    reviewer_id = reviewer_of(request)
+
+    pending_comment = await claim_for_review(reviewer_id)
+    if pending_comment is None:
+        # Return expired leases to the queue and try once more
+        if await release_expired():
+            pending_comment = await claim_for_review(reviewer_id)
+
+    pending_count = await state.comments.count_documents({'status': ReviewQueue.PENDING})
+
+    if not pending_comment:
+        return JSONResponse({'message': "No comments pending for review", 'pending_count': pending_count})
+
+    return JSONResponse({
+        'comment_id': pending_comment['id'],
+        'comment_text': pending_comment['text'],
+        'evaluation_result': pending_comment.get('evaluation', ''),
+        'pending_count': pending_count
+    })
+
+
+async def review_batch(request):
+    try:
+        count = int(request.query_params.get('n', 5))
+    except ValueError:
+        count = 5
+    count = max(1, min(count, MAX_REVIEW_BATCH))
+    reviewer_id = reviewer_of(request)
+
+    claimed = []
+    released = False
+    while len(claimed) < count:
+        comment = await claim_for_review(reviewer_id)
+        if comment is None:
+            # Return expired leases to the queue once and keep claiming
+            if released or not await release_expired():
+                break
+            released = True
+            continue
+        claimed.append(comment)
+
+    return JSONResponse({
+        'comments': [{
+            'comment_id': comment['id'],
+            'comment_text': comment['text'],
+            'evaluation_result': comment.get('evaluation', '')
+        } for comment in claimed],
+        'pending_count': await state.comments.count_documents({'status': ReviewQueue.PENDING})
+    })
+
+
+async def review_decisions(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        body = {}
+    decisions = body.get('decisions', []) if isinstance(body, dict) else None
+    if not isinstance(decisions, list):
+        return JSONResponse({'error': 'decisions must be a list'}, status_code=400)
+    if len(decisions) > MAX_REVIEW_BATCH * 5:
+        return JSONResponse({'error': f'At most {MAX_REVIEW_BATCH * 5} decisions per call'}, status_code=400)
+
+    comments = {c['id']: c async for c in state.comments.find(
+        {'id': {'$in': ReviewQueue.decision_ids(decisions)}}, ReviewQueue.DECISION_PROJECTION)}
+
+    now = datetime.utcnow()
+    operations, results = ReviewQueue.plan_decisions(decisions, comments, reviewer_of(request), now)
+
+    if operations:
+        written = await state.comments.bulk_write(operations, ordered=False)
+        if written.matched_count < len(operations):
+            # A lease expired or was taken over between the read and the write: keep only what was written
+            ReviewQueue.keep_written(results, {c['id'] async for c in state.comments.find(
+                {'id': {'$in': [r['comment_id'] for r in results if r['ok']]}, 'reviewed_at': now}, {'id': 1})})
+
+    async def act(comment_id, decision):
+        text = comments[comment_id]['text']
+        try:
+            if decision == 'approve':
+                await log_decision(0, text, 0)
+                await hide_comment(comment_id, False, unhide=True)
+            elif decision == 'remove':
+                await log_decision(2, text, 1)
+                await remove_comment(comment_id)
+        except Exception as e:
+            logger.error("Error acting on review decision for comment %s: %s", comment_id, e)
+
+    await asyncio.gather(*(act(r['comment_id'], r['decision']) for r in results if r['ok']))
+
+    return JSONResponse({'results': results,
+                         'pending_count': await state.comments.count_documents({'status': ReviewQueue.PENDING})})
+
+
+async def skip(request):
+    comment_id = request.path_params['comment_id']
+    result = await state.comments.update_one({'id': comment_id}, {'$set': {'status': 'SKIPPED'}, '$unset': ReviewQueue.LEASE_FIELDS})
+    if result.modified_count > 0:
+        return JSONResponse({'message': 'Comment skipped successfully', 'comment_id': comment_id})
+    return JSONResponse({'message': 'Comment not found or already skipped', 'comment_id': comment_id}, status_code=404)
+
+
+async def approve(request):
+    comment_id = request.path_params['comment_id']
+    comment = await state.comments.find_one({'id': comment_id}, {'text': 1})
+    if not comment:
+        return JSONResponse({'message': 'Comment not found', 'comment_id': comment_id}, status_code=404)
+
+    try:
+        await log_decision(0, comment["text"], 0)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+    await state.comments.update_one({'id': comment_id}, {'$set': {'status': 'APPROVED'}, '$unset': ReviewQueue.LEASE_FIELDS})
+    await hide_comment(comment_id, False, unhide=True)
+    return JSONResponse({'message': 'Comment approved successfully', 'comment_id': comment_id})
+
+
+async def remove(request):
+    return await remove_action(request.path_params['comment_id'])
+
+
+async def comments_response(args):
+    """Streams one page of comments as a JSON array, or a 400 error for bad arguments."""
+    try:
+        query, direction, limit = CommentListing.parse(args, max_limit=config.COMMENTS_PAGE_MAX)
+    except ValueError as e:
+        return JSONResponse({'status': 'error', 'message': str(e)}, status_code=400)
+    cursor = state.comments.find(query, CommentListing.PROJECTION).sort('_id', direction).limit(limit)
+
+    async def body():
+        yield "["
+        first = True
+        async for comment in cursor:
+            yield ("" if first else ",") + CommentListing.encode(comment)
+            first = False
+        yield "]"
+
+    return StreamingResponse(body(), media_type='application/json')
+
+
+async def get_comments(request):
+    return await comments_response(request.query_params)
+
+
+async def get_new_comments(request):
+    after_id = request.query_params.get('afterId')
+    if not after_id:
+        return JSONResponse([])
+    args = dict(request.query_params)
+    args['after'] = after_id
+    return await comments_response(args)
+
+
+async def index(request):
+    return templates.TemplateResponse(request, "index.html")
+
+
+async def review_page(request):
+    return templates.TemplateResponse(request, "review.html")
+
+
+app = Starlette(
+    routes=[
+        Route('/webhook', webhook, methods=['GET', 'POST']),
+        Route('/review', review_page),
+        Route('/api/review', review, methods=['GET']),
+        Route('/api/review/batch', review_batch, methods=['GET']),
+        Route('/api/review/decisions', review_decisions, methods=['POST']),
+        Route('/api/skip/{comment_id}', skip, methods=['POST']),
+        Route('/api/approve/{comment_id}', approve, methods=['POST']),
+        Route('/api/remove/{comment_id}', remove, methods=['POST']),
+        Route('/get_comments', get_comments, methods=['GET']),
+        Route('/get_new_comments', get_new_comments, methods=['GET']),
+        Route('/', index),
+    ],
+    lifespan=lifespan
+)
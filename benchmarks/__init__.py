@@ -0,0 +1,7 @@
+def percentile(values, percent):
+    """Returns the nearest-rank `percent` percentile of `values`, 0.0 when there are none."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return float(ordered[index])
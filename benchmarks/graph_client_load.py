@@ -0,0 +1,62 @@
+"""
+Load test for GraphClient against the local fake Graph API server.
+
+Sends hide calls for many pages from a pool of threads and reports throughput,
+latency percentiles and the number of failed calls.
+
+Usage (from the repository root):
+    python -m benchmarks.graph_client_load --calls 5000 --threads 64 --latency 0.02
+"""
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import percentile
+from fake_graph_server import FakeGraphServer
+from graph_client import GraphClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test GraphClient against a fake Graph API.")
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.02, help="Fake server latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--usage", type=int, default=0, help="Usage percentage reported by the fake server")
+    parser.add_argument("--app-rate", type=float, default=1000)
+    parser.add_argument("--page-rate", type=float, default=200)
+    args = parser.parse_args()
+
+    with FakeGraphServer(latency=args.latency, error_rate=args.error_rate, usage=args.usage) as server:
+        client = GraphClient("v20.0", base_url=server.url, pool_size=args.threads,
+                             app_rate=args.app_rate, page_rate=args.page_rate, backoff=0.05)
+
+        def call(i):
+            page_id = f"page{i % args.pages}"
+            start = time.perf_counter()
+            try:
+                response = client.post(f"{page_id}_{i}", access_token="token", page_id=page_id,
+                                       params={'is_hidden': 'true'})
+                ok = response.status_code == 200
+            except Exception:
+                ok = False
+            return time.perf_counter() - start, ok
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            results = list(pool.map(call, range(args.calls)))
+        elapsed = time.perf_counter() - started
+
+    latencies = [latency * 1000 for latency, _ in results]
+    failures = sum(1 for _, ok in results if not ok)
+    print(f"calls:       {args.calls} in {elapsed:.2f}s ({args.calls / elapsed:.0f}/s)")
+    print(f"http served: {server.requests_served}")
+    print(f"failures:    {failures}")
+    print(f"latency ms:  mean {statistics.mean(latencies):.1f}, p50 {percentile(latencies, 50):.1f}, "
+          f"p99 {percentile(latencies, 99):.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Throughput of InferencePool against its number of worker processes.
+
+For every value of `--processes` an InferencePool with that many forked
+workers is started on the same model, and `--threads` client threads send it
+comments, `--batch-size` per request, for `--duration` seconds, as app.py's
+request threads do with `inference_processes` set (one comment per request
+goes through InferencePool.moderate, which batches comments waiting for a
+busy worker). 0 processes runs moderate_batch in the client threads instead,
+as app.py does with `inference_processes: 0`. Reports comments per second, the speedup over the
+first row, and request latency percentiles.
+
+Throughput can only grow with the processes while there are free cores for
+them; the number of CPUs is printed and recorded in the output, compare runs
+made on the same machine.
+
+The model is set up as in benchmarks.moderation_pipeline: no network access,
+synthetic word lists and, unless `--model` and `--vectorizer` are given, a
+small model trained on the generated corpora.
+
+Usage (from the repository root):
+    python -m benchmarks.inference_scaling --processes 0,1,2,4 --threads 16 --duration 10
+"""
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+
+from benchmarks import percentile
+from benchmarks.moderation_pipeline import benchmark_model
+
+
+def run(send, comments, batch_size, threads, duration):
+    """Calls `send(batch)` from `threads` threads for `duration` seconds; returns (comments, latencies)."""
+    stop = time.monotonic() + duration
+    cursor = itertools.count()
+    lock = threading.Lock()
+    latencies = []
+    done = [0]
+    ring = comments + comments[:batch_size]
+
+    def client():
+        while time.monotonic() < stop:
+            start = next(cursor) * batch_size % len(comments)
+            batch = ring[start:start + batch_size]
+            began = time.monotonic()
+            send(batch)
+            elapsed = time.monotonic() - began
+            with lock:
+                latencies.append(elapsed)
+                done[0] += len(batch)
+
+    workers = [threading.Thread(target=client, daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return done[0], latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark InferencePool throughput against its worker processes.")
+    parser.add_argument("--processes", default="0,1,2,4", help="Comma-separated worker counts, 0 for no pool")
+    parser.add_argument("--threads", type=int, default=16, help="Client threads sending requests")
+    parser.add_argument("--batch-size", type=int, default=1, help="Comments per request")
+    parser.add_argument("--max-batch", type=int, default=16, help="max_batch of the pool")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per worker count")
+    parser.add_argument("--warmup", type=float, default=1, help="Untimed seconds before each run")
+    parser.add_argument("--corpus-size", type=int, default=500, help="Comments per generated corpus")
+    parser.add_argument("--corpus", help="Optional real corpus: one comment per line, or JSON lines with a 'text' field")
+    parser.add_argument("--list-size", type=int, default=200,
+                        help="Size of the synthetic word list of filters without a local one")
+    parser.add_argument("--model", help="Model file to use instead of training one")
+    parser.add_argument("--vectorizer", help="Vectorizer file to use instead of training one")
+    parser.add_argument("--output", help="File the JSON results are written to")
+    args = parser.parse_args()
+
+    model, corpora = benchmark_model(args.list_size, args.corpus_size, args.corpus, args.model, args.vectorizer)
+    from inference_pool import InferencePool
+
+    comments = [text for corpus in corpora.values() for text in corpus]
+    cpus = os.cpu_count()
+    print(f"{cpus} CPUs, {args.threads} client threads, {args.batch_size} comments per request, "
+          f"{len(comments)} comments")
+    print(f"{'processes':>9} {'comments/s':>11} {'speedup':>8} {'p50 ms':>8} {'p99 ms':>8}")
+
+    rows = []
+    for processes in (int(value) for value in args.processes.split(",")):
+        pool = None
+        if processes:
+            pool = InferencePool(model, processes=processes, max_pending=args.threads,
+                                 max_batch=args.max_batch).start()
+
+            def send(batch):
+                if len(batch) == 1:
+                    pool.moderate(batch[0], timeout=60)
+                else:
+                    pool.submit(batch, block=60).result(timeout=60)
+        else:
+            def send(batch):
+                model.moderate_batch(batch)
+
+        if args.warmup:
+            run(send, comments, args.batch_size, args.threads, args.warmup)
+        done, latencies = run(send, comments, args.batch_size, args.threads, args.duration)
+        if pool is not None:
+            pool.close()
+
+        row = {
+            'processes': processes,
+            'comments_per_second': done / args.duration,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+        }
+        row['speedup'] = row['comments_per_second'] / rows[0]['comments_per_second'] if rows else 1.0
+        rows.append(row)
+        print(f"{processes:>9} {row['comments_per_second']:>11.1f} {row['speedup']:>7.2f}x "
+              f"{row['p50_ms']:>8.1f} {row['p99_ms']:>8.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'cpus': cpus, 'threads': args.threads, 'batch_size': args.batch_size,
+                       'duration': args.duration, 'results': rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
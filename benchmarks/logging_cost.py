@@ -0,0 +1,128 @@
+"""
+Compares the logging cost per comment before and after the logging rework.
+
+"before" replays what one comment used to log: the eagerly built webhook
+debug string, the pretty-printed payload, a print of the entry and about 15
+INFO lines formatted with f-strings (including the full comment text),
+written synchronously by a StreamHandler. "after" logs the same events the
+way the service does now: lazily formatted, DEBUG lines level-guarded,
+per-filter lines sampled, and records handed to a QueueListener thread.
+
+Both write to os.devnull, so the numbers are the CPU cost on the request
+thread, not disk or terminal speed.
+
+Usage (from the repository root):
+    python -m benchmarks.logging_cost --comments 20000
+"""
+import argparse
+import contextlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+
+from log import FORMAT, TextFormatter, _InProcessQueueHandler
+
+FILTERS = ["HomoPhobiaFilter", "RacismFilter", "SuicideFilter", "SwearingFilter", "TappouhkausFilter",
+           "FatPhobiaFilter", "SexualViolenceFilter", "SexualHarassmentFilter", "PannaaksFilter",
+           "BoyFilter", "InclusiveSafetyFilter"]
+TEXT = "This is a fairly ordinary comment of the length people usually write under a post, " * 2
+ENTRY = {'id': '1784', 'time': 1700000000, 'changes': [{'field': 'comments', 'value': {
+    'id': '1790', 'text': TEXT, 'from': {'id': '42', 'username': 'someone'}, 'media': {'id': '1791'}}}]}
+PAYLOAD = {'object': 'instagram', 'entry': [ENTRY]}
+HEADERS = {'Content-Type': 'application/json', 'User-Agent': 'facebookexternalua', 'X-Hub-Signature-256': 'sha256=' + 'a' * 64}
+
+
+def before(logger, devnull):
+    data = "\n=== New Request ==="
+    data += "Request Method: POST\n"
+    data += f"Request Headers: {HEADERS}\n"
+    data += "Request Args: {}\n"
+    data += f"Request Data (raw): {json.dumps(PAYLOAD)}\n"
+    logger.debug(data)
+    logger.debug("Received webhook data:")
+    logger.debug(json.dumps(PAYLOAD, indent=2))
+    logger.info("The comment is instagram")
+    with contextlib.redirect_stdout(devnull):
+        print(ENTRY)
+    comment_id = ENTRY['changes'][0]['value']['id']
+    logger.info(f"Comment with ID {comment_id} successfully added to the database.")
+    for name in FILTERS:
+        logger.info(f"🔍 Filter {name} returned: 1")
+    logger.info(f"Most probable class: 0, Confidence: {93.5:.2f}%")
+    logger.info(f"Function get_most_probable_class_and_percent executed in {0.0004:.4f} seconds")
+    logger.info(f'🤖 Model moderation result: 0 with certainty {93.5:.2f}%')
+    logger.info(f"🌍 Comment '{TEXT}' logged with label 0 and action type 0.")
+    logger.info(f"Function _log_comment executed in {0.05:.4f} seconds")
+    logger.info(f'🎉 Comment "{TEXT}" received final moderation result: 0')
+    logger.info(f"Function moderate_comment executed in {0.06:.4f} seconds")
+
+
+def after(logger, devnull, sample_rate=0.01):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Webhook request: method=%s headers=%s args=%s body=%.4000s", "POST", HEADERS, {},
+                     json.dumps(PAYLOAD))
+    logger.debug("Received webhook data: %s", PAYLOAD)
+    logger.debug("The comment is instagram")
+    comment_id = ENTRY['changes'][0]['value']['id']
+    logger.info("Comment with ID %s successfully added to the database.", comment_id,
+                extra={'comment_id': comment_id, 'platform': 'instagram'})
+    log_filters = random.random() < sample_rate  # log.sample()
+    for name in FILTERS:
+        if log_filters:
+            logger.info("🔍 Filter %s returned: %s", name, 1, extra={'filter': name})
+    logger.debug("Most probable class: %s, Confidence: %.2f%%", 0, 93.5)
+    logger.debug('🤖 Model moderation result: %s with certainty %.2f%%', 0, 93.5)
+    logger.debug("🌍 Comment '%.80s' logged with label %s and action type %s.", TEXT, 0, 0)
+    logger.info('🎉 Comment "%.80s" received final moderation result: %s', TEXT, 0,
+                extra={'result': 0, 'certainty': 93.5})
+
+
+def measure(func, logger, devnull, comments):
+    started = time.perf_counter()
+    for _ in range(comments):
+        func(logger, devnull)
+    return (time.perf_counter() - started) / comments * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare logging cost per comment before and after.")
+    parser.add_argument("--comments", type=int, default=20000)
+    parser.add_argument("--sample-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    with open(os.devnull, "w") as devnull:
+        old = logging.getLogger("benchmark.before")
+        old.propagate = False
+        old.setLevel(logging.INFO)
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        old.addHandler(handler)
+
+        new = logging.getLogger("benchmark.after")
+        new.propagate = False
+        new.setLevel(logging.INFO)
+        records = queue.SimpleQueue()
+        new.addHandler(_InProcessQueueHandler(records))
+        stream_handler = logging.StreamHandler(devnull)
+        stream_handler.setFormatter(TextFormatter(FORMAT))
+        listener = logging.handlers.QueueListener(records, stream_handler)
+        listener.start()
+
+        before_us = measure(before, old, devnull, args.comments)
+        after_us = measure(lambda logger, devnull: after(logger, devnull, args.sample_rate), new, devnull, args.comments)
+        drain_started = time.perf_counter()
+        listener.stop()
+        drain_us = (time.perf_counter() - drain_started) / args.comments * 1e6
+
+    print(f"before: {before_us:8.2f} us/comment on the request thread")
+    print(f"after:  {after_us:8.2f} us/comment on the request thread "
+          f"(+{drain_us:.2f} us/comment left for the listener thread when the run ended)")
+    print(f"speedup: {before_us / after_us:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
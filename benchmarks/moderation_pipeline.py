@@ -0,0 +1,352 @@
+"""
+Per-stage micro-benchmarks of the moderation pipeline.
+
+Times each filter's `apply`, the combined filter pass, the aggregation of the
+filter results into one ModerationResult, the vectorizer transform,
+`predict_proba` and the full `moderate_comment`, per corpus and batch size,
+and writes the results as JSON so runs can be compared:
+
+    python -m benchmarks.moderation_pipeline --output before.json
+    ... change filters.py or moderation_model.py ...
+    python -m benchmarks.moderation_pipeline --output after.json --compare before.json
+
+The corpora are generated from a fixed seed: short, long, emoji-heavy, mixed
+Finnish/English, heavy-hit (several filter words per comment) and no-hit
+(no filter word anywhere, so every filter scans its whole list). `--corpus`
+adds a real corpus, one comment per line or JSON lines with a "text" field.
+
+Startup normally goes to the network; here the model update, the filter word
+list updates and the nltk download are stubbed out, and telemetry is off.
+Filters without a local word list get a synthetic one of `--list-size` words.
+Unless `--model` and `--vectorizer` are given, a TF-IDF vectorizer and a
+logistic regression are trained on the generated corpora. The list sizes and
+the model used are recorded in the output, compare runs made the same way.
+
+Usage (from the repository root):
+    python -m benchmarks.moderation_pipeline --batch-sizes 1,16,128 --repeat 20
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+SEED = 1337
+
+ENGLISH = ("the this that really nice post thanks for sharing love great photo what a day "
+           "i think you are right agree totally not sure about it weather today looks good "
+           "when is the next event see you there congratulations happy birthday well done "
+           "amazing work keep going why would anyone say so interesting idea").split()
+FINNISH = ("tämä on tosi hyvä kuva kiitos jakamisesta ihana päivä olen samaa mieltä "
+           "en ole varma siitä sää näyttää hyvältä milloin on seuraava tapahtuma nähdään "
+           "siellä onnea paljon hienoa työtä jatka samaan malliin miksi kukaan sanoisi "
+           "noin mielenkiintoinen ajatus huomenna sitten").split()
+EMOJI = ["😀", "😂", "❤️", "👍", "🔥", "🙏", "🎉", "😍", "👏🏽", "👩‍👩‍👧", "🇫🇮", "✨", "🥲", "💯"]
+
+
+def stub_model_update():
+    """Replaces the model update and the nltk download at startup with no-ops."""
+    import nltk
+    nltk.download = lambda *args, **kwargs: True
+
+    updater = types.ModuleType("model_updater")
+
+    class ModelUpdater:
+        def update_model(self, force=False):
+            pass
+
+    updater.ModelUpdater = ModelUpdater
+    sys.modules["model_updater"] = updater
+
+
+def stub_network():
+    """Replaces the network-bound parts of startup with no-ops."""
+    stub_model_update()
+    import filters
+    filters.BaseFilter.update_word_list = lambda self: None
+
+
+def words(rng, vocabulary, low, high):
+    return " ".join(rng.choice(vocabulary) for _ in range(rng.randint(low, high)))
+
+
+def hits(text, word_lists):
+    lowered = text.lower()
+    return any(word in lowered for word_list in word_lists for word in word_list)
+
+
+def build_corpora(size, word_lists, extra=None):
+    """Generates the corpora. `word_lists` are the filters' lists, used for the hit and no-hit corpora."""
+    rng = random.Random(SEED)
+    filter_words = sorted({word for word_list in word_lists for word in word_list})
+    neutral = [word for word in ENGLISH + FINNISH if not hits(word, word_lists)]
+
+    corpora = {
+        'short': [words(rng, ENGLISH + FINNISH, 1, 6) for _ in range(size)],
+        'long': [words(rng, ENGLISH + FINNISH, 80, 200) for _ in range(size)],
+        'emoji': [" ".join(rng.choice(EMOJI) if rng.random() < 0.6 else rng.choice(ENGLISH)
+                           for _ in range(rng.randint(3, 25))) for _ in range(size)],
+        'fi_en': [" ".join(rng.choice(FINNISH if i % 2 else ENGLISH) for i in range(rng.randint(8, 30)))
+                  for _ in range(size)],
+        'heavy_hit': [],
+        'no_hit': [],
+    }
+    for _ in range(size):
+        text = words(rng, ENGLISH + FINNISH, 10, 30).split()
+        for _ in range(rng.randint(3, 5)):
+            text.insert(rng.randint(0, len(text)), rng.choice(filter_words))
+        corpora['heavy_hit'].append(" ".join(text))
+    while len(corpora['no_hit']) < size:
+        text = words(rng, neutral, 10, 30)
+        if not hits(text, word_lists):
+            corpora['no_hit'].append(text)
+    if extra:
+        corpora['file'] = extra
+    return corpora
+
+
+def load_corpus(path):
+    comments = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                line = json.loads(line).get("text", "")
+            comments.append(line)
+    return comments
+
+
+def train_model(corpora, directory):
+    """Trains a small model on the generated corpora and returns the model and vectorizer paths."""
+    import joblib
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+
+    texts, labels = [], []
+    for name, comments in corpora.items():
+        texts.extend(comments)
+        labels.extend([1 if name == 'heavy_hit' else 0] * len(comments))
+    vectorizer = TfidfVectorizer()
+    model = LogisticRegression(max_iter=200).fit(vectorizer.fit_transform(texts), labels)
+
+    model_file = os.path.join(directory, "moderation_model.joblib")
+    vectorizer_file = os.path.join(directory, "tfidf_vectorizer.joblib")
+    joblib.dump(model, model_file)
+    joblib.dump(vectorizer, vectorizer_file)
+    return model_file, vectorizer_file
+
+
+def batches(comments, batch_size):
+    """Cycles through the corpus in batches of `batch_size` comments."""
+    start = 0
+    while True:
+        yield [comments[(start + i) % len(comments)] for i in range(batch_size)]
+        start = (start + batch_size) % len(comments)
+
+
+def measure(func, comments, batch_size, repeat, prepare=None):
+    """Returns the microseconds per comment of each of `repeat` rounds, after one warm-up round."""
+    rounds = []
+    source = batches(comments, batch_size)
+    for round_number in range(repeat + 1):
+        batch = next(source)
+        argument = prepare(batch) if prepare else batch
+        started = time.perf_counter_ns()
+        func(argument)
+        elapsed = time.perf_counter_ns() - started
+        if round_number:
+            rounds.append(elapsed / 1000 / batch_size)
+    return rounds
+
+
+def aggregate(results, priority):
+    """The filter result aggregation of ModerationModel.moderate_comment."""
+    highest = 0
+    for result in results:
+        if priority[int(result)] > priority[highest]:
+            highest = int(result)
+    return highest
+
+
+def stages(model, priority):
+    """Returns (name, function of a batch, prepare) for every stage benchmarked."""
+    filters = model.filters
+
+    def filter_pass(batch):
+        for text in batch:
+            for filter_instance in filters:
+                filter_instance.apply(text)
+
+    def aggregation(batch_results):
+        for results in batch_results:
+            aggregate(results, priority)
+
+    def moderate(batch):
+        for text in batch:
+            model.moderate_comment(text)
+
+    def filter_stage(filter_instance):
+        def run(batch):
+            for text in batch:
+                filter_instance.apply(text)
+        return run
+
+    result = [(f"filter:{f.__class__.__name__}", filter_stage(f), None) for f in filters]
+    result += [
+        ("filters", filter_pass, None),
+        ("aggregate", aggregation, lambda batch: [[f.apply(text) for f in filters] for text in batch]),
+        ("vectorize", model.vectorizer.transform, None),
+        ("predict_proba", model.model.predict_proba, model.vectorizer.transform),
+        ("moderate_comment", moderate, None),
+    ]
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    """Prints the change of every median against a baseline run. Returns the number of regressions."""
+    with open(baseline_path) as f:
+        baseline = {(r['stage'], r['corpus'], r['batch_size']): r for r in json.load(f)['results']}
+
+    regressions = 0
+    print(f"\n{'stage':<34} {'corpus':<10} {'batch':>5} {'before us':>10} {'after us':>10} {'change':>8}")
+    for r in results:
+        before = baseline.get((r['stage'], r['corpus'], r['batch_size']))
+        if before is None:
+            continue
+        old, new = before['us_per_comment']['median'], r['us_per_comment']['median']
+        change = (new - old) / old if old else 0.0
+        flag = ""
+        if change > threshold:
+            regressions += 1
+            flag = "  slower"
+        print(f"{r['stage']:<34} {r['corpus']:<10} {r['batch_size']:>5} {old:>10.2f} {new:>10.2f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def benchmark_model(list_size, corpus_size, corpus=None, model_file=None, vectorizer_file=None):
+    """
+    Starts a ModerationModel without network access and generates the corpora.
+
+    Returns:
+        tuple: (ModerationModel, {corpus name: comments}). Without `model_file` and
+            `vectorizer_file` the model is trained on the corpora.
+    """
+    stub_network()
+    logging.getLogger().setLevel(logging.WARNING)
+    from moderation_model import ModerationModel
+
+    with tempfile.TemporaryDirectory() as directory:
+        trained = not (model_file and vectorizer_file)
+        if trained:
+            # A throwaway model so ModerationModel can start; replaced by the trained one below
+            import joblib
+            model_file = vectorizer_file = os.path.join(directory, "placeholder.joblib")
+            joblib.dump(None, model_file)
+        model = ModerationModel(learns=False, model_file=model_file, vectorizer_file=vectorizer_file)
+
+        rng = random.Random(SEED)
+        for filter_instance in model.filters:
+            if not filter_instance.offensive_words:
+                filter_instance.offensive_words = [
+                    "".join(rng.choice("abcdefghijklmnopqrstuvwxyzåäö") for _ in range(rng.randint(4, 10)))
+                    for _ in range(list_size)]
+
+        extra = load_corpus(corpus) if corpus else None
+        corpora = build_corpora(corpus_size, [f.offensive_words for f in model.filters], extra)
+
+        if trained:
+            model.model_file, model.vectorizer_file = train_model(corpora, directory)
+            model.model, model.vectorizer = model.load_model(), model.load_vectorizer()
+    return model, corpora
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the moderation pipeline.")
+    parser.add_argument("--batch-sizes", default="1,16,128")
+    parser.add_argument("--repeat", type=int, default=20, help="Timed rounds per stage, corpus and batch size")
+    parser.add_argument("--corpus-size", type=int, default=500, help="Comments per generated corpus")
+    parser.add_argument("--corpus", help="Optional real corpus: one comment per line, or JSON lines with a 'text' field")
+    parser.add_argument("--corpora", help="Comma-separated corpora to run (default: all)")
+    parser.add_argument("--stages", help="Comma-separated stage name prefixes to run (default: all)")
+    parser.add_argument("--list-size", type=int, default=200,
+                        help="Size of the synthetic word list of filters without a local one")
+    parser.add_argument("--model", help="Model file to use instead of training one")
+    parser.add_argument("--vectorizer", help="Vectorizer file to use instead of training one")
+    parser.add_argument("--output", help="File the JSON results are written to")
+    parser.add_argument("--compare", help="Earlier JSON results to compare the medians with")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Relative slowdown of a median counted as a regression by --compare")
+    args = parser.parse_args()
+
+    model, corpora = benchmark_model(args.list_size, args.corpus_size, args.corpus, args.model, args.vectorizer)
+    from moderation_model import MODERATION_PRIORITY
+
+    selected_corpora = args.corpora.split(",") if args.corpora else list(corpora)
+    selected_stages = args.stages.split(",") if args.stages else None
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+
+    results = []
+    print(f"{'stage':<34} {'corpus':<10} {'batch':>5} {'median us':>10} {'min us':>8} {'max us':>8}")
+    for name, func, prepare in stages(model, MODERATION_PRIORITY):
+        if selected_stages and not any(name.startswith(prefix) for prefix in selected_stages):
+            continue
+        for corpus in selected_corpora:
+            for batch_size in batch_sizes:
+                rounds = measure(func, corpora[corpus], batch_size, args.repeat, prepare)
+                summary = {
+                    'median': statistics.median(rounds),
+                    'min': min(rounds),
+                    'max': max(rounds),
+                    'stdev': statistics.stdev(rounds) if len(rounds) > 1 else 0.0,
+                }
+                results.append({'stage': name, 'corpus': corpus, 'batch_size': batch_size,
+                                'rounds': len(rounds), 'us_per_comment': summary})
+                print(f"{name:<34} {corpus:<10} {batch_size:>5} {summary['median']:>10.2f} "
+                      f"{summary['min']:>8.2f} {summary['max']:>8.2f}")
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'time': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': SEED,
+            'repeat': args.repeat,
+            'corpus_size': args.corpus_size,
+            'corpus_file': args.corpus,
+            'model': args.model or "trained",
+            'word_lists': {f.__class__.__name__: len(f.offensive_words) for f in model.filters},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f"\n{regressions} results more than {args.threshold:.0%} slower than {args.compare}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Measures the cost of tracing on a comment's path through the pipeline.
+
+Runs a stand-in for one comment (a root span, the per-comment spans and one
+span per filter around a small amount of work) with tracing off, and at
+several sample rates with spans exported to a temporary file, and reports
+the time per comment and the overhead over an untraced run.
+
+Usage (from the repository root):
+    python -m benchmarks.tracing_overhead --comments 20000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from tracing import Tracer, SpanExporter
+
+STAGES = ["process_comment", "comment_to_db", "handle_comment", "owner_config", "moderate_comment"]
+FILTERS = 11
+
+
+def work():
+    return sum(range(50))
+
+
+def untraced():
+    for _ in STAGES:
+        work()
+    for _ in range(FILTERS):
+        work()
+
+
+def traced(tracer):
+    with tracer.start_trace("webhook"):
+        for stage in STAGES:
+            with tracer.span(stage):
+                work()
+        for index in range(FILTERS):
+            with tracer.span(f"filter:{index}") as span:
+                work()
+                span.set(result=0)
+
+
+def measure(func, comments):
+    started = time.perf_counter()
+    for _ in range(comments):
+        func()
+    return (time.perf_counter() - started) / comments * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the overhead of request tracing.")
+    parser.add_argument("--comments", type=int, default=20000)
+    parser.add_argument("--rates", default="0,0.01,0.1,1", help="Comma-separated sample rates")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        baseline = measure(untraced, args.comments)
+        print(f"{'sample rate':>12} {'us/comment':>11} {'overhead us':>12}")
+        print(f"{'untraced':>12} {baseline:>11.2f} {0:>12.2f}")
+
+        for rate in (float(rate) for rate in args.rates.split(",")):
+            tracer = Tracer(rate, SpanExporter(os.path.join(directory, f"spans-{rate}.jsonl")))
+            per_comment = measure(lambda: traced(tracer), args.comments)
+            print(f"{rate:>12g} {per_comment:>11.2f} {per_comment - baseline:>12.2f}"
+                  f"{f'  ({tracer.exporter.dropped} spans dropped)' if tracer.exporter.dropped else ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Concurrent-connection benchmark for the webhook endpoint.
+
+Holds a given number of concurrent connections, each posting Facebook comment
+webhooks back to back, and reports throughput and latency per concurrency
+level. Run it once against the Flask service (app.py) and once against the
+asyncio service (asgi_app.py), both pointed at the same MongoDB and fake
+Graph API, to compare how many concurrent webhooks each can carry.
+
+Usage (from the repository root):
+    python -m benchmarks.webhook_concurrency \\
+        --target flask=http://127.0.0.1:5000 --target asgi=http://127.0.0.1:5001 \\
+        --concurrency 10,100,500,1000,2000 --duration 10
+"""
+import argparse
+import asyncio
+import itertools
+import time
+import uuid
+
+import httpx
+
+from benchmarks import percentile
+
+_counter = itertools.count()
+
+
+def facebook_payload():
+    """Builds one page/feed comment webhook in the shape handle_webhook_event parses."""
+    n = next(_counter)
+    page_id = f"10{n % 50:04d}"
+    return {
+        "object": "page",
+        "entry": [{
+            "id": page_id,
+            "time": int(time.time()),
+            "changes": [{
+                "field": "feed",
+                "value": {
+                    "item": "comment",
+                    "verb": "add",
+                    "comment_id": f"{page_id}_{uuid.uuid4().hex[:12]}",
+                    "post_id": f"{page_id}_{n % 500}",
+                    "message": "Tämä on testikommentti number %d" % n,
+                    "from": {"id": str(n), "name": "Load Test"}
+                }
+            }]
+        }]
+    }
+
+
+async def run_level(url, concurrency, duration, slo):
+    latencies = []
+    errors = 0
+    stop_at = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=max(slo * 4, 30)) as client:
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < stop_at:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(f"{url}/webhook", json=facebook_payload())
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed,
+        'errors': errors,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+    }
+
+
+async def main_async(args):
+    levels = [int(level) for level in args.concurrency.split(",")]
+    targets = dict(target.split("=", 1) for target in args.target)
+
+    print(f"{'target':<8}{'conns':>7}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, url in targets.items():
+        capacity = 0
+        for level in levels:
+            result = await run_level(url.rstrip("/"), level, args.duration, args.slo)
+            print(f"{name:<8}{level:>7}{result['rps']:>10.0f}{result['p50'] * 1000:>10.1f}"
+                  f"{result['p99'] * 1000:>10.1f}{result['errors']:>8}")
+            error_rate = result['errors'] / max(result['requests'], 1)
+            if result['p99'] <= args.slo and error_rate < 0.01:
+                capacity = level
+        print(f"{name}: highest concurrency within p99 <= {args.slo * 1000:.0f} ms and <1% errors: {capacity}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare webhook concurrency of the Flask and asyncio services.")
+    parser.add_argument("--target", action="append", required=True, help="name=base URL, may be repeated")
+    parser.add_argument("--concurrency", default="10,50,100,500,1000")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per concurrency level")
+    parser.add_argument("--slo", type=float, default=1.0, help="p99 latency limit in seconds")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
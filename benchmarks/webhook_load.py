@@ -0,0 +1,405 @@
+"""
+Webhook load test of one app.py instance.
+
+Starts the fake Graph API and updates servers, starts app.py against them in
+a child process (in a temporary directory, with its own config.json and a
+small trained model) and posts Facebook `page`/`feed` and Instagram
+`comments` webhooks to it at a fixed rate, or as fast as `--concurrency`
+connections allow with `--rate 0`. Reports throughput, webhook latency
+percentiles and the time from a webhook arriving to the Graph API receiving
+the hide or delete of its comment.
+
+With a rate, latency is measured from when each webhook was due, so a
+service falling behind shows up as latency instead of a lower send rate.
+
+MongoDB is a local mongod (`--mongo mongodb://...`, a fresh database that is
+dropped afterwards) or, with `--mongo memory`, an in-memory mongomock client
+(`pip install mongomock`; it lacks change streams and is no stand-in for
+mongod's performance). `--replay` posts recorded webhook payloads, one JSON
+object per line, instead of generated ones; their comment IDs are made
+unique so the payloads can be replayed many times. `--target` loads an
+already running service instead, which must then use the printed fake
+server URLs as its graph_api_url and updates_url.
+
+Usage (from the repository root):
+    python -m benchmarks.webhook_load --rate 50 --duration 30 --concurrency 32 \\
+        --graph-latency 0.05 --updates-latency 0.02 --output load.json
+"""
+import argparse
+import copy
+import itertools
+import json
+import os
+import queue
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from benchmarks import percentile
+from benchmarks.moderation_pipeline import ENGLISH, FINNISH, build_corpora, stub_model_update, train_model
+from fake_graph_server import FakeGraphServer
+from fake_updates_server import FakeUpdatesServer
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VERIFY_TOKEN = "load-test"
+SEED_USER = "haspde-load-test"
+FILTER_TYPES = ["homophobia", "racism", "suicide", "swearing", "tappouhkaus", "fatphobia",
+                "sexual_violence", "sexual_harassment", "pannaaks", "boy"]
+
+
+def summary_ms(values):
+    return {
+        'p50': percentile(values, 50) * 1000,
+        'p90': percentile(values, 90) * 1000,
+        'p99': percentile(values, 99) * 1000,
+        'max': max(values, default=0.0) * 1000,
+    }
+
+
+def page_ids(pages):
+    return [f"9{n:05d}" for n in range(pages)]
+
+
+class Payloads:
+    """Generates, or replays, webhook payloads in the shapes handle_webhook_event parses."""
+
+    def __init__(self, pages, instagram_share, hit_share, comments_per_webhook, hit_words, replay=None):
+        self.pages = page_ids(pages)
+        self.instagram_share = instagram_share
+        self.hit_share = hit_share
+        self.comments_per_webhook = comments_per_webhook
+        self.hit_words = hit_words
+        self.replay = replay
+        self.rng = random.Random(1337)
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def text(self):
+        words = [self.rng.choice(ENGLISH + FINNISH) for _ in range(self.rng.randint(3, 25))]
+        if self.rng.random() < self.hit_share:
+            words.insert(self.rng.randint(0, len(words)), self.rng.choice(self.hit_words))
+        return " ".join(words)
+
+    def facebook_change(self, n, page_id):
+        return {
+            "field": "feed",
+            "value": {
+                "item": "comment",
+                "verb": "add",
+                "comment_id": f"{page_id}_{n}",
+                "post_id": f"{page_id}_{n % 500}",
+                "message": self.text(),
+                "from": {"id": str(n), "name": "Load Test"}
+            }
+        }
+
+    def instagram_change(self, n):
+        return {
+            "field": "comments",
+            "value": {
+                "id": f"17{n:015d}",
+                "text": self.text(),
+                "from": {"id": str(n), "username": "load_test"},
+                "media": {"id": f"18{n % 500:015d}"}
+            }
+        }
+
+    def __next__(self):
+        """Returns (payload, comment IDs in it)."""
+        with self.lock:
+            if self.replay:
+                return self._replayed(next(self.counter))
+            instagram = self.rng.random() < self.instagram_share
+            page_id = self.rng.choice(self.pages)
+            changes = [self.instagram_change(next(self.counter)) if instagram
+                       else self.facebook_change(next(self.counter), page_id)
+                       for _ in range(self.comments_per_webhook)]
+
+        ids = [change["value"].get("id") or change["value"].get("comment_id") for change in changes]
+        entry = {"id": "0" if instagram else page_id, "time": int(time.time()), "changes": changes}
+        return {"object": "instagram" if instagram else "page", "entry": [entry]}, ids
+
+    def _replayed(self, n):
+        payload = copy.deepcopy(self.replay[n % len(self.replay)])
+        ids = []
+        for entry in payload.get("entry", []):
+            for change in entry.get("changes", []) or []:
+                value = change.get("value") or {}
+                key = "comment_id" if "comment_id" in value else "id"
+                if value.get(key):
+                    value[key] = f"{value[key]}{n}"
+                    ids.append(value[key])
+        return payload, ids
+
+
+def load_replay(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(directory, mongo_uri, pages):
+    """Runs app.py in this process, from `directory`. Used as the child process of the load test."""
+    os.chdir(directory)
+    stub_model_update()
+
+    import pymongo
+    if mongo_uri == "memory":
+        import mongomock
+        client = mongomock.MongoClient()
+        pymongo.MongoClient = lambda *args, **kwargs: client
+    else:
+        client = pymongo.MongoClient(mongo_uri)
+
+    # Page access tokens for the generated Facebook pages
+    client["HaSpDeDash"].users.update_one(
+        {'_id': SEED_USER},
+        {'$set': {'managed_pages': [{'page_id': page_id, 'page_access_token': f"token-{page_id}"}
+                                    for page_id in page_ids(pages)]}},
+        upsert=True
+    )
+
+    import app as service
+    service.app.run(host="127.0.0.1", port=service.config.FLASK_PORT, threaded=True, use_reloader=False)
+
+
+def start_service(args, directory, graph, updates):
+    """Writes config.json and the model into `directory` and starts app.py. Returns (process, URL, database name)."""
+    port = free_port()
+    db_name = f"haspde_load_{int(time.time())}"
+    with open(os.path.join(directory, "config.json"), "w") as f:
+        json.dump({
+            'mongodb_uri': args.mongo if args.mongo != "memory" else "mongodb://localhost:27017/",
+            'db_name': db_name,
+            'instagram_access_token': "load-test-token",
+            'instagram_verify_token': VERIFY_TOKEN,
+            'graph_api_url': graph.url,
+            'graph_app_rate': args.graph_app_rate,
+            'graph_page_rate': args.graph_page_rate,
+            'updates_url': updates.url,
+            'improve': True,
+            'human_review': False,
+            'flask_debug': False,
+            'flask_port': port,
+            'log_level': args.log_level,
+        }, f)
+
+    if args.model and args.vectorizer:
+        shutil.copy(args.model, os.path.join(directory, "moderation_model.joblib"))
+        shutil.copy(args.vectorizer, os.path.join(directory, "tfidf_vectorizer.joblib"))
+    else:
+        train_model(build_corpora(300, [updates.words_of(kind) for kind in FILTER_TYPES]), directory)
+
+    log = open(os.path.join(directory, "app.log"), "w")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPOSITORY, os.environ.get("PYTHONPATH")])))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.webhook_load", "--serve", directory, "--mongo", args.mongo,
+         "--pages", str(args.pages)],
+        cwd=REPOSITORY, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    return process, f"http://127.0.0.1:{port}", db_name
+
+
+def wait_ready(url, process, timeout):
+    deadline = time.monotonic() + timeout
+    params = {'hub.mode': 'subscribe', 'hub.verify_token': VERIFY_TOKEN, 'hub.challenge': 'ready'}
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            return False
+        try:
+            if requests.get(f"{url}/webhook", params=params, timeout=2).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def run_load(url, payloads, rate, concurrency, duration):
+    """
+    Posts webhooks for `duration` seconds. `rate` is webhooks per second, 0 sends back to back.
+
+    Returns a list of (due, sent, done, status code or None, comment IDs).
+    """
+    jobs = queue.Queue(maxsize=0 if rate else concurrency)
+    results = []
+
+    def worker():
+        session = requests.Session()
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            due, payload, ids = job
+            sent = time.monotonic()
+            try:
+                status = session.post(f"{url}/webhook", json=payload, timeout=60).status_code
+            except requests.RequestException:
+                status = None
+            results.append((due, sent, time.monotonic(), status, ids))
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in workers:
+        thread.start()
+
+    started = time.monotonic()
+    for n in itertools.count():
+        now = time.monotonic()
+        if now - started >= duration:
+            break
+        due = now
+        if rate:
+            due = started + n / rate
+            if due > now:
+                time.sleep(due - now)
+        payload, ids = next(payloads)
+        jobs.put((due, payload, ids))
+
+    for _ in workers:
+        jobs.put(None)
+    for thread in workers:
+        thread.join()
+    return results
+
+
+def wait_for_actions(graph, timeout, quiet=1.0):
+    """Waits until no new Graph API actions arrive for `quiet` seconds, or `timeout` passes."""
+    deadline = time.monotonic() + timeout
+    count, changed = len(graph.actions), time.monotonic()
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+        if len(graph.actions) != count:
+            count, changed = len(graph.actions), time.monotonic()
+        elif time.monotonic() - changed >= quiet:
+            break
+
+
+def report(results, graph, updates, duration, rate):
+    ok = [r for r in results if r[3] == 200]
+    arrived = {}
+    for due, sent, done, status, ids in results:
+        for comment_id in ids:
+            arrived[comment_id] = sent
+
+    first_action = {}
+    for at, method, object_id, params in list(graph.actions):
+        if object_id in arrived and object_id not in first_action:
+            first_action[object_id] = at
+
+    comments = sum(len(r[4]) for r in results)
+    return {
+        'webhooks_sent': len(results),
+        'comments_sent': comments,
+        'errors': len(results) - len(ok),
+        'duration_s': duration,
+        'target_rate_webhooks_per_s': rate,
+        'throughput_comments_per_s': sum(len(r[4]) for r in ok) / duration if duration else 0.0,
+        # From when the webhook was due with a rate, from when it was sent without one
+        'webhook_latency_ms': summary_ms([done - (due if rate else sent) for due, sent, done, _, _ in results]),
+        'actioned_comments': len(first_action),
+        'arrival_to_action_ms': summary_ms([at - arrived[comment_id] for comment_id, at in first_action.items()]),
+        'graph_requests': graph.requests_served,
+        'telemetry_posts': len(updates.telemetry),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the webhook of one app.py instance.")
+    parser.add_argument("--rate", type=float, default=20, help="Webhooks per second, 0 sends back to back")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=5, help="Seconds of load before measuring")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--comments-per-webhook", type=int, default=1)
+    parser.add_argument("--instagram-share", type=float, default=0.5, help="Fraction of Instagram webhooks")
+    parser.add_argument("--hit-share", type=float, default=0.2, help="Fraction of comments with a filter word")
+    parser.add_argument("--pages", type=int, default=20, help="Facebook pages the comments are spread over")
+    parser.add_argument("--replay", help="Recorded webhook payloads to post, one JSON object per line")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017/", help="MongoDB URI, or 'memory'")
+    parser.add_argument("--graph-latency", type=float, default=0.05)
+    parser.add_argument("--graph-error-rate", type=float, default=0.0)
+    parser.add_argument("--graph-app-rate", type=float, default=1000)
+    parser.add_argument("--graph-page-rate", type=float, default=200)
+    parser.add_argument("--updates-latency", type=float, default=0.02)
+    parser.add_argument("--updates-error-rate", type=float, default=0.0)
+    parser.add_argument("--graph-port", type=int, default=0, help="Fake Graph API port, for --target")
+    parser.add_argument("--updates-port", type=int, default=0, help="Fake updates server port, for --target")
+    parser.add_argument("--target", help="URL of an already running service to load instead of starting one")
+    parser.add_argument("--model", help="Model file for the service instead of training one")
+    parser.add_argument("--vectorizer", help="Vectorizer file for the service instead of training one")
+    parser.add_argument("--log-level", default="WARNING", help="Log level of the service")
+    parser.add_argument("--drain", type=float, default=30, help="Seconds to wait for outstanding Graph actions")
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    parser.add_argument("--output", help="File the JSON report is written to")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.mongo, args.pages)
+        return
+
+    directory = tempfile.mkdtemp(prefix="haspde-load-")
+    process = None
+    db_name = None
+    try:
+        with FakeGraphServer(port=args.graph_port, latency=args.graph_latency, error_rate=args.graph_error_rate) as graph, \
+                FakeUpdatesServer(port=args.updates_port, latency=args.updates_latency,
+                                  error_rate=args.updates_error_rate) as updates:
+            print(f"Fake Graph API on {graph.url}, fake updates server on {updates.url}")
+            if args.target:
+                url = args.target.rstrip("/")
+            else:
+                process, url, db_name = start_service(args, directory, graph, updates)
+            if not wait_ready(url, process, args.startup_timeout):
+                with open(os.path.join(directory, "app.log")) as f:
+                    print("".join(f.readlines()[-40:]), file=sys.stderr)
+                sys.exit(f"The service at {url} did not become ready.")
+
+            hit_words = [word for kind in FILTER_TYPES for word in updates.words_of(kind)]
+            payloads = Payloads(args.pages, args.instagram_share, args.hit_share, args.comments_per_webhook,
+                                hit_words, load_replay(args.replay) if args.replay else None)
+
+            if args.warmup:
+                run_load(url, payloads, args.rate, args.concurrency, args.warmup)
+            results = run_load(url, payloads, args.rate, args.concurrency, args.duration)
+            wait_for_actions(graph, args.drain)
+            result = report(results, graph, updates, args.duration, args.rate)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+        if db_name and args.mongo != "memory":
+            import pymongo
+            client = pymongo.MongoClient(args.mongo)
+            client.drop_database(db_name)
+            client["HaSpDeDash"].users.delete_one({'_id': SEED_USER})
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"webhooks sent:        {result['webhooks_sent']} ({result['comments_sent']} comments, {result['errors']} errors)")
+    print(f"throughput:           {result['throughput_comments_per_s']:.1f} comments/s")
+    latency = result['webhook_latency_ms']
+    print(f"webhook latency:      p50 {latency['p50']:.1f} ms, p90 {latency['p90']:.1f} ms, "
+          f"p99 {latency['p99']:.1f} ms, max {latency['max']:.1f} ms")
+    action = result['arrival_to_action_ms']
+    print(f"arrival to hide:      p50 {action['p50']:.1f} ms, p90 {action['p90']:.1f} ms, "
+          f"p99 {action['p99']:.1f} ms, max {action['max']:.1f} ms ({result['actioned_comments']} comments)")
+    print(f"graph requests:       {result['graph_requests']}, telemetry posts: {result['telemetry_posts']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import errors
+
+from log import logger
+
+
+class CommentFeed:
+    """
+    Live feed of new comments and status changes for the dashboard.
+
+    One background thread follows the comments collection, through a change
+    stream when the deployment supports it and by polling otherwise, and fans
+    every event out to all subscribers. Polling finds new comments by `_id` and
+    status changes by re-reading the status of the `history` most recent
+    comments, so older comments do not get status events without change
+    streams. Mongo load therefore stays
+    the same no matter how many dashboards are open. Events carry only the
+    fields the dashboard renders, with the text truncated. Recent events are
+    kept in memory so reconnecting clients (SSE `Last-Event-ID`) usually catch
+    up without a query.
+    """
+
+    FIELDS = ('id', 'text', 'status', 'platform', 'user_name')
+    PROJECTION = {field: 1 for field in FIELDS}
+
+    def __init__(self, collection, poll_interval=2, max_text=500, history=500,
+                 backfill_limit=200, subscriber_queue=1000):
+        """
+        Args:
+            collection: The comments collection.
+            poll_interval (float): Seconds between polls when change streams are unavailable.
+            max_text (int): Maximum number of characters of comment text sent per event.
+            history (int): Number of recent new-comment events kept in memory for reconnects.
+            backfill_limit (int): Maximum number of comments sent to a reconnecting client.
+            subscriber_queue (int): Events buffered per subscriber before it is disconnected.
+        """
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.max_text = max_text
+        self.backfill_limit = backfill_limit
+        self.subscriber_queue = subscriber_queue
+
+        self._history = deque(maxlen=history)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_id = None
+        self._statuses = OrderedDict()  # _id -> status of the recent comments followed while polling
+
+    def event(self, doc, kind="comment"):
+        """Builds a size-limited SSE event from a comment document."""
+        data = {field: doc.get(field) for field in self.FIELDS if field in doc}
+        data['_id'] = str(doc['_id'])
+        if isinstance(data.get('text'), str) and len(data['text']) > self.max_text:
+            data['text'] = data['text'][:self.max_text] + "…"
+
+        lines = []
+        if kind == "comment":
+            lines.append(f"id: {data['_id']}")
+        lines.append(f"event: {kind}")
+        lines.append(f"data: {json.dumps(data)}")
+        return "\n".join(lines) + "\n\n"
+
+    def subscribe(self, last_event_id=None):
+        """
+        Yields SSE messages for one client until it disconnects.
+
+        Args:
+            last_event_id (str, optional): ID of the last comment the client has seen.
+        """
+        self._ensure_started()
+        subscriber = queue.Queue(maxsize=self.subscriber_queue)
+
+        with self._lock:
+            self._subscribers.add(subscriber)
+            history = list(self._history)
+        backlog = self._backlog(last_event_id, history)
+
+        try:
+            yield "retry: 3000\n\n"
+            for message in backlog:
+                yield message
+            while True:
+                try:
+                    message = subscriber.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    return  # Too slow to keep up; the client reconnects with Last-Event-ID
+                yield message
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def _backlog(self, last_event_id, history):
+        """Returns the new-comment events after `last_event_id`, from `history` when it reaches back far enough."""
+        if not last_event_id:
+            return []
+        try:
+            after = ObjectId(last_event_id)
+        except (InvalidId, TypeError):
+            return []
+
+        if history and history[0][0] <= after:
+            return [message for oid, message in history if oid > after][-self.backfill_limit:]
+
+        docs = self.collection.find({'_id': {'$gt': after}}, self.PROJECTION) \
+            .sort('_id', -1).limit(self.backfill_limit)
+        return [self.event(doc) for doc in reversed(list(docs))]
+
+    def _publish(self, message, oid=None):
+        with self._lock:
+            if oid is not None:
+                self._history.append((oid, message))
+            subscribers = list(self._subscribers)
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                with self._lock:
+                    self._subscribers.discard(subscriber)
+                # Make room for the end-of-stream marker
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+                subscriber.put_nowait(None)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            latest = self.collection.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+            self._last_id = latest['_id'] if latest else None
+            self._thread = threading.Thread(target=self._run, name="comment-feed", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        try:
+            self._follow_change_stream()
+        except errors.PyMongoError as e:
+            logger.info(f"Comment change stream unavailable, polling instead: {e}")
+        self._poll()
+
+    def _follow_change_stream(self):
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}]
+        resume_after = None
+        while True:
+            with self.collection.watch(pipeline, full_document='updateLookup', resume_after=resume_after) as stream:
+                try:
+                    for change in stream:
+                        resume_after = stream.resume_token
+                        doc = change.get('fullDocument')
+                        if not doc:
+                            continue
+                        if change['operationType'] == 'insert':
+                            self._last_id = doc['_id']
+                            self._publish(self.event(doc), doc['_id'])
+                        else:
+                            self._publish(self.event(doc, kind="status"))
+                except errors.ConnectionFailure as e:
+                    logger.warning(f"Comment change stream interrupted, resuming: {e}")
+                    time.sleep(1)
+
+    def _poll(self):
+        try:
+            recent = self.collection.find({}, {'status': 1}).sort('_id', -1).limit(self._history.maxlen)
+            for doc in reversed(list(recent)):
+                self._track(doc)
+        except Exception as e:
+            logger.error("Error reading recent comment statuses: %s", e)
+
+        while True:
+            try:
+                query = {'_id': {'$gt': self._last_id}} if self._last_id else {}
+                docs = list(self.collection.find(query, self.PROJECTION).sort('_id', 1).limit(500))
+                for doc in docs:
+                    self._last_id = doc['_id']
+                    self._publish(self.event(doc), doc['_id'])
+                    self._track(doc)
+                self._poll_statuses()
+            except Exception as e:
+                logger.error(f"Error polling for new comments: {e}")
+            time.sleep(self.poll_interval)
+
+    def _track(self, doc):
+        self._statuses[doc['_id']] = doc.get('status')
+        while len(self._statuses) > self._history.maxlen:
+            self._statuses.popitem(last=False)
+
+    def _poll_statuses(self):
+        """Publishes a status event for each followed comment whose status changed since the last poll."""
+        if not self._statuses:
+            return
+        for doc in self.collection.find({'_id': {'$in': list(self._statuses)}}, {'status': 1}):
+            if doc.get('status') != self._statuses.get(doc['_id']):
+                self._statuses[doc['_id']] = doc.get('status')
+                self._publish(self.event(doc, kind="status"))
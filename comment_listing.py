@@ -0,0 +1,97 @@
+import json
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+from log import logger
+
+
+class CommentListing:
+    """
+    Keyset-paginated listing of comments for the dashboard.
+
+    Pages are selected with `before`/`after` on `_id` instead of skip/offset,
+    so every page is one index range scan no matter how deep it is. Only the
+    fields the dashboard renders are read, the page size is capped, and the
+    optional filters (status, platform, owner_id) each have an index ending
+    in `_id`. Pages are encoded as a JSON array one comment at a time, so a
+    large page is never held in memory as one string.
+    """
+
+    FIELDS = ('id', 'text', 'status', 'platform', 'user_name', 'owner_id')
+    PROJECTION = {field: 1 for field in FIELDS}
+    FILTERS = ('status', 'platform', 'owner_id')
+
+    def __init__(self, collection, default_limit=10, max_limit=100):
+        """
+        Initializes the listing and its indexes.
+
+        Args:
+            collection: The comments collection.
+            default_limit (int): Page size when the request does not give one.
+            max_limit (int): Largest page size a request may ask for.
+        """
+        self.collection = collection
+        self.default_limit = default_limit
+        self.max_limit = max_limit
+
+        try:
+            for field in self.FILTERS:
+                self.collection.create_index([(field, ASCENDING), ('_id', ASCENDING)])
+        except Exception as e:
+            logger.warning("Could not create comment listing indexes: %s", e)
+
+    @classmethod
+    def parse(cls, args, default_limit=10, max_limit=100):
+        """
+        Builds the query for one page from request arguments.
+
+        Args:
+            args (Mapping): Request arguments: `limit`, `before`, `after` and the filter fields.
+
+        Returns:
+            tuple: (filter, sort direction, limit).
+
+        Raises:
+            ValueError: If `limit` is not an integer or a cursor is not a valid ObjectId.
+        """
+        limit = args.get('limit')
+        limit = int(limit) if limit not in (None, "") else default_limit
+        limit = max(1, min(limit, max_limit))
+
+        query = {field: args.get(field) for field in cls.FILTERS if args.get(field)}
+        before, after = args.get('before'), args.get('after')
+        try:
+            id_range = {}
+            if before:
+                id_range['$lt'] = ObjectId(before)
+            if after:
+                id_range['$gt'] = ObjectId(after)
+        except (InvalidId, TypeError):
+            raise ValueError("Cursor must be a comment _id")
+        if id_range:
+            query['_id'] = id_range
+
+        # Walking forward from `after` returns the oldest comments first, otherwise newest first
+        direction = ASCENDING if after and not before else DESCENDING
+        return query, direction, limit
+
+    def page(self, args):
+        """Returns a cursor over one page of projected comments. Raises ValueError on bad arguments."""
+        query, direction, limit = self.parse(args, self.default_limit, self.max_limit)
+        return self.collection.find(query, self.PROJECTION).sort('_id', direction).limit(limit)
+
+    @staticmethod
+    def encode(comment):
+        """Encodes one projected comment as JSON."""
+        comment['_id'] = str(comment['_id'])
+        return json.dumps(comment, default=str)
+
+    @classmethod
+    def stream(cls, comments):
+        """Yields a JSON array of `comments` piece by piece."""
+        yield "["
+        for index, comment in enumerate(comments):
+            yield ("," if index else "") + cls.encode(comment)
+        yield "]"
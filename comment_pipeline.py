@@ -0,0 +1,75 @@
+"""
+The parts of comment handling shared by the Flask (app.py) and asyncio
+(asgi_app.py) services: the stored comment document and the action taken on
+each moderation verdict. Both services do their own I/O around them.
+
+    comments.insert_one(comment_document(comment_id, text, "instagram", media_id=media_id))
+    action = action_for(moderation_result, config.MODE)  # APPROVE, HIDE, REMOVE or REVIEW
+"""
+from datetime import datetime
+
+from log import logger
+
+APPROVE = "approve"
+HIDE = "hide"
+REMOVE = "remove"
+REVIEW = "review"  # Queued for human review and hidden meanwhile
+
+
+def evaluate_comment(comment_text):
+    """
+    Evaluate the given comment for profanity using the profane_detector model
+    designed for HaSpDe. Note: The profanity detection feature has been deprecated
+    and will no longer be supported in future updates.
+
+    Parameters:
+    comment_text (str): The text of the comment to evaluate.
+
+    Returns:
+    str: "Positive" if no profanity is detected, "Negative" otherwise.
+    """
+    logger.debug("Evaluating comment: %.80s", comment_text)
+
+    result = False  # This would normally involve a detection model
+    logger.debug("Profane detector result: %s", result)
+
+    # Determine evaluation based on detection result
+    evaluation = "Negative" if result else "Positive"
+    logger.debug("Evaluation result: %s", evaluation)
+
+    return evaluation
+
+
+def comment_document(comment_id, comment_text, platform, user_id=None, user_name='Unknown User', media_id=None,
+                     owner_id=None):
+    """Returns the document a new comment is stored as, with status PENDING."""
+    return {
+        'id': comment_id,
+        'text': comment_text,
+        'status': 'PENDING',
+        'evaluation': evaluate_comment(comment_text),
+        'platform': platform,
+        'user_id': user_id,
+        'user_name': user_name,
+        'media_id': media_id,
+        'owner_id': owner_id,
+        'created_at': datetime.utcnow()
+    }
+
+
+def action_for(moderation_result, mode):
+    """
+    Returns the action for a moderation verdict, or None for an unknown one.
+
+    REMOVE and BAN remove the comment in the "full" mode and send it to human review otherwise.
+    """
+    result = int(moderation_result)
+    if result == 0:
+        return APPROVE
+    if result == 1:
+        return HIDE
+    if result in (2, 3):
+        return REMOVE if mode == "full" else REVIEW
+    if result == 4:
+        return REVIEW
+    return None
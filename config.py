@@ -18,6 +18,73 @@ class Config:
         self.INSTAGRAM_API_VERSION = config.get('instagram_api_version', 'v20.0')
         self.INSTAGRAM_VERIFY_TOKEN = config.get('instagram_verify_token', '')
 
+        # Graph API client settings
+        self.GRAPH_API_URL = config.get('graph_api_url', 'https://graph.facebook.com')
+        self.GRAPH_TIMEOUT = config.get('graph_timeout', 10)
+        self.GRAPH_MAX_RETRIES = config.get('graph_max_retries', 3)
+        self.GRAPH_APP_RATE = config.get('graph_app_rate', 50)
+        self.GRAPH_PAGE_RATE = config.get('graph_page_rate', 10)
+        self.GRAPH_BATCH_WINDOW = config.get('graph_batch_window', 0.05)
+
+        # Retries of failed Graph API actions
+        self.RETRY_MAX_ATTEMPTS = config.get('retry_max_attempts', 8)
+        self.RETRY_BASE_DELAY = config.get('retry_base_delay', 30)
+        self.RETRY_INTERVAL = config.get('retry_interval', 1)
+
+        # Threads running model inference in the asyncio service (asgi_app.py)
+        self.INFERENCE_THREADS = config.get('inference_threads', 4)
+
+        # Processes running model inference in the Flask service (app.py), 0 to run it in the request threads
+        self.INFERENCE_PROCESSES = config.get('inference_processes', 0)
+        self.INFERENCE_QUEUE = config.get('inference_queue', 256)
+        self.INFERENCE_BATCH = config.get('inference_batch', 16)
+        self.INFERENCE_TIMEOUT = config.get('inference_timeout', 10)
+
+        # Threads moderating webhook comments in order per owner, 0 to moderate in the webhook request
+        self.COMMENT_WORKERS = config.get('comment_workers', 0)
+        self.COMMENT_PARTITIONS = config.get('comment_partitions', 64)
+        self.COMMENT_QUEUE_MAX = config.get('comment_queue_max', 10000)
+
+        # Threads running moderation actions most severe first, 0 to run them right after moderation
+        self.ACTION_WORKERS = config.get('action_workers', 0)
+        self.ACTION_AGING = config.get('action_aging', 10)
+
+        # Load shedding: per signal, the value at which each step starts (defer telemetry, model only for
+        # filter hits, no model, reject webhooks). 'depth' counts webhooks in progress and queued comments
+        # and actions, 'latency' is the moving average of seconds to moderate a comment (at least the age of the
+        # oldest one in progress).
+        self.SHED_THRESHOLDS = config.get('shed_thresholds', {'depth': [200, 400, 800, 1600], 'latency': [1, 2, 4, 8]})
+        self.SHED_COOLDOWN = config.get('shed_cooldown', 10)
+        self.SHED_RETRY_AFTER = config.get('shed_retry_after', 60)
+
+        # Seconds a reviewer holds a claimed comment before it returns to the queue
+        self.REVIEW_LEASE_SECONDS = config.get('review_lease_seconds', 300)
+
+        # Largest page of comments /get_comments and /get_new_comments return
+        self.COMMENTS_PAGE_MAX = config.get('comments_page_max', 100)
+
+        # Most dashboards following /stream/comments at once, each holds a server thread while connected
+        self.FEED_MAX_SUBSCRIBERS = config.get('feed_max_subscribers', 20)
+
+        # Hours between rebuilds of the moderation counters from the comments collection
+        self.STATS_RECONCILE_HOURS = config.get('stats_reconcile_hours', 24)
+
+        # Logging: lowest level, "text" or "json" records, and the fraction of per-filter records kept
+        self.LOG_LEVEL = config.get('log_level', 'INFO')
+        self.LOG_FORMAT = config.get('log_format', 'text')
+        self.LOG_SAMPLE_RATE = config.get('log_sample_rate', 0.01)
+
+        # Request tracing: fraction of webhook requests traced, span file and optional OTLP/HTTP endpoint
+        self.TRACE_SAMPLE_RATE = config.get('trace_sample_rate', 0.0)
+        self.TRACE_FILE = config.get('trace_file', 'traces.jsonl')
+        self.TRACE_OTLP_ENDPOINT = config.get('trace_otlp_endpoint', None)
+
+        # Bearer token for the /admin/profile endpoints; they are not registered when empty
+        self.ADMIN_TOKEN = config.get('admin_token', '')
+
+        # Server the filter word lists and the training telemetry go to
+        self.UPDATES_URL = config.get('updates_url', 'https://updates.haspde.luova.club')
+
         # Other settings
         self.IMPROVE = config.get('improve', True)
         self.HUMAN_REVIEW = config.get('human_review', False)
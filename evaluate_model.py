@@ -0,0 +1,266 @@
+"""
+Evaluates moderation quality against latency over a grid of configurations.
+
+Runs a labeled dataset (JSON lines with the comment text and a label: 0/1,
+true/false or a moderation result name, where anything but ACCEPT counts as
+harmful) through the ModerationModel filters and one or more model backends,
+and reports precision, recall and F1 of flagging harmful comments next to
+the mean and p99 latency per comment, for every combination of:
+
+    --threshold   certainty_needed values
+    --filter-set  filter sets ("all", "none" or comma-separated filter types); --ablate adds
+                  "all but X" for every filter
+    --cascade     full           every filter, then the model (what the service does)
+                  early-exit     stop at the first filter hiding or worse and skip the model
+                  gated          run the model only for comments a filter flagged
+                  filters-only   no model
+    --backend     name=model.joblib,vectorizer.joblib (default: the service's model files)
+
+Everything expensive is computed once and reused by the whole grid: each
+filter's result and time per comment, and each backend's probabilities
+(vectorized in one batch) and its vectorize + predict time per comment.
+A configuration's latency per comment is the sum of the times of the stages
+it runs for that comment. Configurations no other one beats on both F1 and
+p99 latency are marked with *, those are the operating points to choose from.
+
+Usage:
+    python evaluate_model.py labeled.jsonl --threshold 60,70,80,90 --ablate \\
+        --cascade full,early-exit,gated --output evaluation.json
+"""
+import argparse
+import itertools
+import json
+import time
+
+import numpy as np
+
+from benchmarks import percentile
+from moderation_model import MODERATION_PRIORITY, ModerationModel, final_result
+from results import ModerationResult
+
+CASCADES = ("full", "early-exit", "gated", "filters-only")
+RESULTS = {name.lower(): code for code, name in ModerationResult.RESULT_MAPPING.items()}
+
+
+def parse_label(value):
+    """Returns 1 for harmful and 0 for acceptable comments."""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return int(value != 0)
+    value = str(value).strip().lower()
+    if value in RESULTS:
+        return int(RESULTS[value] != ModerationResult.ACCEPT)
+    if value in ("true", "yes", "harmful", "1"):
+        return 1
+    if value in ("false", "no", "ok", "0"):
+        return 0
+    raise ValueError(f"Unknown label: {value!r}")
+
+
+def load_dataset(path, text_field="text", label_field="label"):
+    texts, labels = [], []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                texts.append(record[text_field])
+                labels.append(parse_label(record[label_field]))
+    return texts, np.array(labels)
+
+
+class Evaluation:
+    """Caches filter and model results and timings of a dataset, and evaluates configurations from them."""
+
+    def __init__(self, filters, texts, labels, repeat=3):
+        """
+        Args:
+            filters (list): Filter instances, in the order the service runs them.
+            texts (list): Comment texts.
+            labels (numpy.ndarray): 1 for harmful comments, 0 for acceptable ones.
+            repeat (int): Timings per comment and stage; the fastest is kept.
+        """
+        self.filters = filters
+        self.texts = texts
+        self.labels = labels
+        self.repeat = repeat
+        self.filter_results = {}  # filter type -> result per comment
+        self.filter_times = {}  # filter type -> seconds per comment
+        self.backends = {}  # name -> (model result per comment, certainty per comment, seconds per comment)
+        for filter_instance in filters:
+            self._run_filter(filter_instance)
+
+    def _time(self, func, text):
+        best = None
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            result = func(text)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return result, best
+
+    def _run_filter(self, filter_instance):
+        results, times = [], []
+        for text in self.texts:
+            result, elapsed = self._time(filter_instance.apply, text)
+            results.append(int(result))
+            times.append(elapsed)
+        self.filter_results[filter_instance.filter_type] = results
+        self.filter_times[filter_instance.filter_type] = np.array(times)
+
+    def add_backend(self, name, model, vectorizer):
+        """Scores the dataset with one model, in one batch for the results and per comment for the timings."""
+        probabilities = model.predict_proba(vectorizer.transform(self.texts))
+        most_probable = np.argmax(probabilities, axis=1)
+        certainty = probabilities[np.arange(len(self.texts)), most_probable] * 100
+        model_results = np.where(most_probable == 1, ModerationResult.HIDE, ModerationResult.ACCEPT)
+        times = np.array([self._time(lambda text: model.predict_proba(vectorizer.transform([text])), text)[1]
+                          for text in self.texts])
+        self.backends[name] = (model_results, certainty, times)
+
+    def evaluate(self, backend, filter_set, cascade, threshold):
+        """Returns the quality and latency of one configuration."""
+        model_results, certainty, model_times = self.backends[backend]
+        flagged = np.zeros(len(self.texts), dtype=int)
+        latency = np.zeros(len(self.texts))
+        exit_priority = MODERATION_PRIORITY[ModerationResult.HIDE]
+
+        for index in range(len(self.texts)):
+            highest = ModerationResult.ACCEPT
+            stopped = False
+            for filter_type in filter_set:
+                result = self.filter_results[filter_type][index]
+                latency[index] += self.filter_times[filter_type][index]
+                if MODERATION_PRIORITY[result] > MODERATION_PRIORITY[highest]:
+                    highest = result
+                if cascade == "early-exit" and MODERATION_PRIORITY[result] >= exit_priority:
+                    stopped = True
+                    break
+
+            run_model = not stopped and (cascade in ("full", "early-exit") or
+                                         (cascade == "gated" and highest != ModerationResult.ACCEPT))
+            if run_model:
+                latency[index] += model_times[index]
+                highest = final_result(highest, int(model_results[index]), certainty[index], threshold)
+            flagged[index] = highest != ModerationResult.ACCEPT
+
+        true_positives = int(np.sum((flagged == 1) & (self.labels == 1)))
+        precision = true_positives / max(int(np.sum(flagged)), 1)
+        recall = true_positives / max(int(np.sum(self.labels)), 1)
+        return {
+            'backend': backend,
+            'filters': filter_set_name(filter_set, self.filters),
+            'cascade': cascade,
+            'threshold': threshold,
+            'precision': precision,
+            'recall': recall,
+            'f1': 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+            'flagged': int(np.sum(flagged)),
+            'mean_us': float(np.mean(latency)) * 1e6,
+            'p99_us': percentile(latency, 99) * 1e6,
+        }
+
+
+def filter_set_name(filter_set, filters):
+    all_types = [f.filter_type for f in filters]
+    if list(filter_set) == all_types:
+        return "all"
+    if not filter_set:
+        return "none"
+    missing = [name for name in all_types if name not in filter_set]
+    if len(missing) == 1:
+        return f"all-{missing[0]}"
+    return ",".join(filter_set)
+
+
+def filter_sets(specs, filters, ablate):
+    """Returns the filter type lists to evaluate, in the service's filter order."""
+    all_types = [f.filter_type for f in filters]
+    sets = []
+    for spec in specs or ["all"]:
+        if spec == "all":
+            sets.append(all_types)
+        elif spec == "none":
+            sets.append([])
+        else:
+            wanted = spec.split(",")
+            unknown = set(wanted) - set(all_types)
+            if unknown:
+                raise SystemExit(f"Unknown filters: {', '.join(sorted(unknown))}. Known: {', '.join(all_types)}")
+            sets.append([name for name in all_types if name in wanted])
+    if ablate:
+        sets.extend([name for name in all_types if name != left_out] for left_out in all_types)
+    return sets
+
+
+def mark_pareto(rows):
+    """Marks the rows no other row beats on both F1 and p99 latency."""
+    for row in rows:
+        row['pareto'] = not any(
+            other['f1'] >= row['f1'] and other['p99_us'] <= row['p99_us'] and
+            (other['f1'] > row['f1'] or other['p99_us'] < row['p99_us'])
+            for other in rows
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate moderation quality and latency over configurations.")
+    parser.add_argument("dataset", help="JSON lines with the comment text and label")
+    parser.add_argument("--text-field", default="text")
+    parser.add_argument("--label-field", default="label")
+    parser.add_argument("--threshold", default="80", help="Comma-separated certainty_needed values")
+    parser.add_argument("--filter-set", action="append", help="'all', 'none' or comma-separated filter types (repeatable)")
+    parser.add_argument("--ablate", action="store_true", help="Also evaluate all filters but one, for each filter")
+    parser.add_argument("--cascade", default="full", help=f"Comma-separated, of: {', '.join(CASCADES)}")
+    parser.add_argument("--backend", action="append", help="name=model.joblib,vectorizer.joblib (repeatable)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timings per comment and stage")
+    parser.add_argument("--sort", choices=["f1", "p99", "mean"], default="f1")
+    parser.add_argument("--output", help="File the JSON results are written to")
+    args = parser.parse_args()
+
+    import joblib
+
+    cascades = args.cascade.split(",")
+    unknown = set(cascades) - set(CASCADES)
+    if unknown:
+        raise SystemExit(f"Unknown cascade settings: {', '.join(sorted(unknown))}")
+
+    texts, labels = load_dataset(args.dataset, args.text_field, args.label_field)
+    model = ModerationModel(learns=False)
+    print(f"Caching filter results and timings for {len(texts)} comments ({int(labels.sum())} harmful)...")
+    evaluation = Evaluation(model.filters, texts, labels, args.repeat)
+
+    if args.backend:
+        for spec in args.backend:
+            name, _, files = spec.partition("=")
+            model_file, vectorizer_file = files.split(",")
+            evaluation.add_backend(name, joblib.load(model_file), joblib.load(vectorizer_file))
+    else:
+        evaluation.add_backend("default", model.model, model.vectorizer)
+
+    thresholds = [float(value) for value in args.threshold.split(",")]
+    rows = []
+    sets = filter_sets(args.filter_set, model.filters, args.ablate)
+    for backend, filter_set, cascade in itertools.product(evaluation.backends, sets, cascades):
+        # The threshold only matters when the model runs
+        for threshold in (thresholds if cascade != "filters-only" else thresholds[:1]):
+            rows.append(evaluation.evaluate(backend, filter_set, cascade, threshold))
+    mark_pareto(rows)
+
+    key = {'f1': lambda row: -row['f1'], 'p99': lambda row: row['p99_us'], 'mean': lambda row: row['mean_us']}[args.sort]
+    rows.sort(key=key)
+    print(f"\n  {'backend':<12} {'filters':<28} {'cascade':<13} {'thr':>5} {'prec':>6} {'recall':>6} {'f1':>6} "
+          f"{'mean us':>9} {'p99 us':>9}")
+    for row in rows:
+        print(f"{'*' if row['pareto'] else ' '} {row['backend']:<12} {row['filters'][:28]:<28} {row['cascade']:<13} "
+              f"{row['threshold']:>5g} {row['precision']:>6.3f} {row['recall']:>6.3f} {row['f1']:>6.3f} "
+              f"{row['mean_us']:>9.1f} {row['p99_us']:>9.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'dataset': args.dataset, 'comments': len(texts), 'harmful': int(labels.sum()),
+                       'results': rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Local stand-in for graph.facebook.com, used for load tests.
+
+It answers the Graph API calls HaSpDe makes (owner lookups, including the
+multi-ID ``?ids=`` form, comment hide/unhide and delete, and batch requests
+combining them) with configurable latency, error rate and reported usage,
+and records every action it receives.
+
+Usage:
+    python fake_graph_server.py --port 8081 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeGraphServer:
+    """
+    A threaded HTTP server imitating the parts of the Graph API HaSpDe uses.
+
+    Attributes:
+        actions (list): (monotonic time, method, object ID, params) of every hide/unhide/delete received.
+        lookups (list): The media IDs of every owner lookup received, one list per request.
+        requests_served (int): Number of HTTP requests answered.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, usage=0, owners=None, missing=None):
+        """
+        Args:
+            host (str): Interface to listen on.
+            port (int): Port to listen on, 0 picks a free one.
+            latency (float): Seconds added to every response.
+            error_rate (float): Fraction of requests answered with HTTP 500.
+            usage (int): Usage percentage reported in the X-App-Usage header.
+            owners (dict, optional): Fixed media ID -> owner ID mapping.
+            missing (iterable, optional): Media IDs that do not exist; a lookup including one fails with 400.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.usage = usage
+        self.owners = owners or {}
+        self.missing = set(missing or ())
+        self.lookups = []
+        self.actions = []
+        self.requests_served = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                server._handle(self, "GET")
+
+            def do_POST(self):
+                server._handle(self, "POST")
+
+            def do_DELETE(self):
+                server._handle(self, "DELETE")
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def owner_of(self, media_id):
+        """Returns the owner of a media, derived deterministically when not configured."""
+        return self.owners.get(media_id) or str(zlib.crc32(media_id.encode()))
+
+    def start(self):
+        """Starts serving in a background thread."""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-graph", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handle(self, handler, method):
+        parts = urlsplit(handler.path)
+        params = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        length = int(handler.headers.get('Content-Length') or 0)
+        if length:
+            body = handler.rfile.read(length).decode()
+            params.update({key: values[-1] for key, values in parse_qs(body).items()})
+
+        # Path looks like /<version>/<object id> or /<version>/
+        segments = [segment for segment in parts.path.split("/") if segment]
+        object_id = segments[1] if len(segments) > 1 else None
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.requests_served += 1
+
+        if self.error_rate and random.random() < self.error_rate:
+            self._respond(handler, 500, {'error': {'message': 'Fake server error', 'code': 2}})
+            return
+
+        status, payload = self.dispatch(method, object_id, params)
+        self._respond(handler, status, payload)
+
+    def dispatch(self, method, object_id, params):
+        """Answers one Graph API call. Returns (status code, JSON payload)."""
+        if method == "GET":
+            if object_id is None and 'ids' in params:
+                media_ids = [media_id for media_id in params['ids'].split(",") if media_id]
+            elif object_id:
+                media_ids = [object_id]
+            else:
+                return 400, {'error': {'message': 'Missing object ID', 'code': 100}}
+            with self._lock:
+                self.lookups.append(media_ids)
+            unknown = [media_id for media_id in media_ids if media_id in self.missing]
+            if unknown:
+                return 400, {'error': {'message': f"(#100) Some of the aliases you requested do not exist: "
+                                                  f"{','.join(unknown)}", 'code': 100}}
+            owners = {media_id: {'id': media_id, 'owner': {'id': self.owner_of(media_id)}} for media_id in media_ids}
+            return 200, owners if object_id is None else owners[object_id]
+
+        if object_id is None and method == "POST" and 'batch' in params:
+            return 200, [self._dispatch_batch_item(item) for item in json.loads(params['batch'])]
+
+        if object_id and method in ("POST", "DELETE"):
+            with self._lock:
+                self.actions.append((time.monotonic(), method, object_id, params))
+            return 200, {'success': True}
+
+        return 400, {'error': {'message': 'Unsupported request', 'code': 100}}
+
+    def _dispatch_batch_item(self, item):
+        parts = urlsplit(item.get('relative_url', ''))
+        params = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        object_id = parts.path.strip("/").split("/")[-1] or None
+        status, payload = self.dispatch(item.get('method', 'GET').upper(), object_id, params)
+        return {'code': status, 'headers': [], 'body': json.dumps(payload)}
+
+    def _respond(self, handler, status, payload):
+        body = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        usage = json.dumps({'call_count': self.usage, 'total_time': self.usage, 'total_cputime': self.usage})
+        handler.send_header('X-App-Usage', usage)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local fake Graph API server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with 500")
+    parser.add_argument("--usage", type=int, default=0, help="Usage percentage reported in X-App-Usage")
+    args = parser.parse_args()
+
+    server = FakeGraphServer(args.host, args.port, args.latency, args.error_rate, args.usage)
+    print(f"Fake Graph API listening on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Local stand-in for updates.haspde.luova.club, used for load tests.
+
+It serves the filter word lists the filters download at startup
+(``/filters/<type>/version`` and ``/filters/<type>``) and accepts the
+training telemetry posted to ``/comments``, with configurable latency and
+error rate, and counts what it receives.
+
+Usage:
+    python fake_updates_server.py --port 8082 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+class FakeUpdatesServer:
+    """
+    A threaded HTTP server imitating the HaSpDe updates server.
+
+    Attributes:
+        telemetry (list): (monotonic time, payload) of every comment posted to /comments.
+        requests_served (int): Number of HTTP requests answered.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, words=None, list_size=200,
+                 version="1"):
+        """
+        Args:
+            host (str): Interface to listen on.
+            port (int): Port to listen on, 0 picks a free one.
+            latency (float): Seconds added to every response.
+            error_rate (float): Fraction of requests answered with HTTP 500.
+            words (dict, optional): Fixed filter type -> word list mapping.
+            list_size (int): Size of the generated word list of filters not in `words`.
+            version (str): Word list version reported for every filter.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.words = words or {}
+        self.list_size = list_size
+        self.version = version
+        self.telemetry = []
+        self.requests_served = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                server._handle(self, "GET")
+
+            def do_POST(self):
+                server._handle(self, "POST")
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def words_of(self, filter_type):
+        """Returns the word list of a filter, generated deterministically when not configured."""
+        if filter_type in self.words:
+            return self.words[filter_type]
+        rng = random.Random(zlib.crc32(filter_type.encode()))
+        return ["".join(rng.choice("abcdefghijklmnopqrstuvwxyzåäö") for _ in range(rng.randint(4, 10)))
+                for _ in range(self.list_size)]
+
+    def start(self):
+        """Starts serving in a background thread."""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-updates", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handle(self, handler, method):
+        segments = [segment for segment in urlsplit(handler.path).path.split("/") if segment]
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b""
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.requests_served += 1
+
+        if self.error_rate and random.random() < self.error_rate:
+            self._respond(handler, 500, {'error': 'Fake server error'})
+            return
+
+        status, payload = self.dispatch(method, segments, body)
+        self._respond(handler, status, payload)
+
+    def dispatch(self, method, segments, body):
+        """Answers one request. Returns (status code, JSON payload or plain text)."""
+        if method == "GET" and len(segments) == 3 and segments[0] == "filters" and segments[2] == "version":
+            return 200, self.version
+        if method == "GET" and len(segments) == 2 and segments[0] == "filters":
+            return 200, {'words': self.words_of(segments[1])}
+        if method == "POST" and segments == ["comments"]:
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                return 400, {'error': 'Invalid JSON'}
+            with self._lock:
+                self.telemetry.append((time.monotonic(), payload))
+            return 200, {'status': 'ok'}
+        return 404, {'error': 'Not found'}
+
+    def _respond(self, handler, status, payload):
+        if isinstance(payload, str):
+            body, content_type = payload.encode(), 'text/plain'
+        else:
+            body, content_type = json.dumps(payload).encode(), 'application/json'
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local fake HaSpDe updates server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with 500")
+    parser.add_argument("--list-size", type=int, default=200, help="Words in each generated filter word list")
+    args = parser.parse_args()
+
+    server = FakeUpdatesServer(args.host, args.port, args.latency, args.error_rate, list_size=args.list_size)
+    print(f"Fake updates server listening on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,10 @@ import logging
 import json
 import os
 
+from log import sample
+
 # Set up logging
-logger = logging
+logger = logging.getLogger("HaSpDe SoMe.filters")
 class BaseFilter:
     """
     Base class for all text filters.
@@ -34,7 +36,7 @@ class BaseFilter:
             with open(f"filters/{self.filter_type}_version.json", "r") as f:
                 return json.load(f).get("version", "0")
         except FileNotFoundError:
-            logger.info(f"No local version found for {self.filter_type}. Setting to 0.")
+            logger.info("No local version found for %s. Setting to 0.", self.filter_type)
             return "0"
 
     def update_word_list(self):
@@ -45,41 +47,41 @@ class BaseFilter:
             server_version = response.text.strip()
 
             if server_version != self.local_version:
-                logger.info(f"Updating {self.filter_type} word list from {self.update_url}...")
+                logger.info("Updating %s word list from %s...", self.filter_type, self.update_url)
                 word_list_response = requests.get(self.update_url)
                 word_list_response.raise_for_status()
 
                 self.offensive_words = word_list_response.json().get("words", [])
                 self.save_word_list()  # Save to local file
                 self.save_local_version(server_version)  # Update version
-                logger.info(f"Updated {self.filter_type} word list: {self.offensive_words[:10]}...")
+                logger.info("Updated %s word list: %d words.", self.filter_type, len(self.offensive_words))
             else:
-                logger.info(f"{self.filter_type.capitalize()} word list is up to date.")
+                logger.info("%s word list is up to date.", self.filter_type.capitalize())
 
         except Exception as e:
-            logger.error(f"Failed to update {self.filter_type} word list: {e}")
+            logger.error("Failed to update %s word list: %s", self.filter_type, e)
 
     def load_offensive_words(self):
         """Loads the offensive words list from a local JSON file."""
         try:
             with open(f"filters/{self.filter_type}_words.json", "r") as f:
                 self.offensive_words = json.load(f).get("words", [])
-                logger.info(f"Loaded {self.filter_type} offensive words: {self.offensive_words[:10]}...")
+                logger.info("Loaded %s offensive words: %d words.", self.filter_type, len(self.offensive_words))
         except FileNotFoundError:
-            logger.info(f"No local words file found for {self.filter_type}. Keeping the list empty.")
+            logger.info("No local words file found for %s. Keeping the list empty.", self.filter_type)
 
     def save_word_list(self):
         """Saves the offensive words list to a local file."""
         os.makedirs("filters", exist_ok=True)
         with open(f"filters/{self.filter_type}_words.json", "w") as f:
             json.dump({"words": self.offensive_words}, f)
-        logger.info(f"Saved {self.filter_type} word list to {self.filter_type}_words.json")
+        logger.info("Saved %s word list to %s_words.json", self.filter_type, self.filter_type)
 
     def save_local_version(self, version: str):
         """Saves the local version of the word list."""
         with open(f"filters/{self.filter_type}_version.json", "w") as f:
             json.dump({"version": version}, f)
-        logger.info(f"Saved local version for {self.filter_type}: {version}")
+        logger.info("Saved local version for %s: %s", self.filter_type, version)
 
     def apply(self, text) -> ModerationResult:
         """
@@ -116,10 +118,12 @@ class CustomFilter(BaseFilter):
         """
         # Check if the text contains any offensive words
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Filter detected offensive content in comment: '{text}'")
+            if sample():
+                logger.info("Filter detected offensive content in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return self._1_action  # Return the action for offensive words
         
-        logger.info(f"No offensive content detected in comment: '{text}'")
+        if sample():
+            logger.info("No offensive content detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
         return self._0_action  # Return the action for non-offensive content
 
 
@@ -145,7 +149,8 @@ class HomoPhobiaFilter(BaseFilter):
             ModerationResult: BAN if offensive words are detected, otherwise ACCEPT.
         """
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Hate speech detected in comment: '{text}'")
+            if sample():
+                logger.info("Hate speech detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return ModerationResult(ModerationResult.HUMAN_REVIEW)
         return ModerationResult(ModerationResult.ACCEPT)
 
@@ -172,7 +177,8 @@ class JesusFilter(BaseFilter):
             ModerationResult: BAN if offensive words are detected, otherwise ACCEPT.
         """
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Hate speech detected in comment: '{text}'")
+            if sample():
+                logger.info("Hate speech detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return ModerationResult(ModerationResult.HUMAN_REVIEW)
         return ModerationResult(ModerationResult.ACCEPT)
 
@@ -199,7 +205,8 @@ class RacismFilter(BaseFilter):
             ModerationResult: BAN if offensive words are detected, otherwise ACCEPT.
         """
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Racist content detected in comment: '{text}'")
+            if sample():
+                logger.info("Racist content detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return ModerationResult(ModerationResult.BAN)
         return ModerationResult(ModerationResult.ACCEPT)
 
@@ -226,7 +233,8 @@ class SuicideFilter(BaseFilter):
             ModerationResult: HUMAN_REVIEW if concerning content is detected, otherwise ACCEPT.
         """
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Suicidal content detected in comment: '{text}'")
+            if sample():
+                logger.info("Suicidal content detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return ModerationResult(ModerationResult.HUMAN_REVIEW)
         return ModerationResult(ModerationResult.ACCEPT)
 
@@ -253,7 +261,8 @@ class SwearingFilter(BaseFilter):
             ModerationResult: HIDE if swearing is detected, otherwise ACCEPT.
         """
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Swearing detected in comment: '{text}'")
+            if sample():
+                logger.info("Swearing detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return ModerationResult(ModerationResult.HIDE)
         return ModerationResult(ModerationResult.ACCEPT)
 
@@ -277,7 +286,8 @@ class TappouhkausFilter(BaseFilter):
             ModerationResult: BAN if threatening words are detected, otherwise ACCEPT.
         """
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Threatening language detected in comment: '{text}'")
+            if sample():
+                logger.info("Threatening language detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return ModerationResult(ModerationResult.BAN)
         return ModerationResult(ModerationResult.ACCEPT)
 
@@ -301,7 +311,8 @@ class FatPhobiaFilter(BaseFilter):
             ModerationResult: BAN if offensive words are detected, otherwise ACCEPT.
         """
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Fatphobic content detected in comment: '{text}'")
+            if sample():
+                logger.info("Fatphobic content detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return ModerationResult(ModerationResult.BAN)
         return ModerationResult(ModerationResult.ACCEPT)
 
@@ -469,7 +480,8 @@ class InclusiveSafetyFilter(BaseFilter):
             ModerationResult: HUMAN_REVIEW if offensive words are detected, otherwise ACCEPT.
         """
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Offensive content detected in comment: '{text}'")
+            if sample():
+                logger.info("Offensive content detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return ModerationResult(
                 ModerationResult.HUMAN_REVIEW
                 if not training
@@ -497,7 +509,8 @@ class SexualViolenceFilter(BaseFilter):
             ModerationResult: HUMAN_REVIEW if offensive words are detected, otherwise ACCEPT.
         """
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Sexual violence content detected in comment: '{text}'")
+            if sample():
+                logger.info("Sexual violence content detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return ModerationResult(ModerationResult.HUMAN_REVIEW)
         return ModerationResult(ModerationResult.ACCEPT)
 
@@ -521,7 +534,8 @@ class SexualHarassmentFilter(BaseFilter):
             ModerationResult: HUMAN_REVIEW if offensive words are detected, otherwise ACCEPT.
         """
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Sexual harassment content detected in comment: '{text}'")
+            if sample():
+                logger.info("Sexual harassment content detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return ModerationResult(ModerationResult.HUMAN_REVIEW)
         return ModerationResult(ModerationResult.ACCEPT)
 
@@ -545,7 +559,8 @@ class PannaaksFilter(BaseFilter):
             ModerationResult: HUMAN_REVIEW if offensive words are detected, otherwise ACCEPT.
         """
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Offensive content detected in comment: '{text}'")
+            if sample():
+                logger.info("Offensive content detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return ModerationResult(ModerationResult.HUMAN_REVIEW)
         return ModerationResult(ModerationResult.ACCEPT)
 
@@ -569,6 +584,7 @@ class BoyFilter(BaseFilter):
             ModerationResult: BAN if references to being a boy are detected, otherwise ACCEPT.
         """
         if any(word in text.lower() for word in self.offensive_words):
-            logger.info(f"Reference to being a boy detected in comment: '{text}'")
+            if sample():
+                logger.info("Reference to being a boy detected in comment: '%.80s'", text, extra={'filter': self.filter_type})
             return ModerationResult(ModerationResult.BAN)
         return ModerationResult(ModerationResult.ACCEPT)
@@ -0,0 +1,263 @@
+import json
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from log import logger
+
+
+class GraphRateLimited(requests.RequestException):
+    """Raised when a request cannot be sent before its deadline because of rate limiting."""
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    The refill rate can be changed at any time, and the bucket can be paused
+    until a point in time when the API reports that access is blocked.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Args:
+            rate (float): Tokens added per second.
+            capacity (float, optional): Maximum number of stored tokens. Defaults to `rate`.
+        """
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, deadline=None):
+        """
+        Takes one token, waiting for it if needed.
+
+        Args:
+            deadline (float, optional): `time.monotonic()` value after which to give up.
+
+        Returns:
+            bool: True if a token was taken, False if the deadline passed first.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    wait = (1 - self.tokens) / self.rate
+
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(min(wait, 1.0))
+
+    def set_rate(self, rate):
+        """Changes the refill rate."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(rate, 0.01)
+
+    def block_for(self, seconds):
+        """Stops handing out tokens for `seconds`."""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class GraphClient:
+    """
+    Shared client for the Facebook/Instagram Graph API.
+
+    Requests go through one keep-alive connection pool, have a deadline that
+    covers all retries, and are retried with jittered exponential backoff on
+    429 and 5xx responses. Sending is paced by a token bucket for the app and
+    one per page. Their rates adapt to the usage Meta reports in the
+    X-App-Usage, X-Page-Usage and X-Business-Use-Case-Usage headers.
+    """
+
+    GRAPH_URL = "https://graph.facebook.com"
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, api_version, base_url=None, timeout=10, max_retries=3, backoff=0.5,
+                 pool_size=50, app_rate=50, page_rate=10):
+        """
+        Initializes the client.
+
+        Args:
+            api_version (str): Graph API version, e.g. "v20.0".
+            base_url (str, optional): Graph API base URL. Defaults to GRAPH_URL.
+            timeout (float): Default deadline in seconds for one call, retries included.
+            max_retries (int): Maximum number of retries for one call.
+            backoff (float): Base delay in seconds for the retry backoff.
+            pool_size (int): Maximum number of pooled keep-alive connections.
+            app_rate (float): Requests per second allowed for the whole app.
+            page_rate (float): Requests per second allowed for one page.
+        """
+        self.api_version = api_version
+        self.base_url = (base_url or self.GRAPH_URL).rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.page_rate = page_rate
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.app_bucket = TokenBucket(app_rate)
+        self._page_buckets = {}
+        self._lock = threading.Lock()
+
+    def url(self, path=""):
+        """Builds the versioned URL for a Graph API path."""
+        return f"{self.base_url}/{self.api_version}/{path.lstrip('/')}"
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def request(self, method, path, access_token=None, page_id=None, params=None, data=None, timeout=None):
+        """
+        Sends a request to the Graph API.
+
+        Args:
+            method (str): HTTP method.
+            path (str): Path relative to the versioned API root, e.g. a comment ID.
+            access_token (str, optional): Token sent as a bearer token.
+            page_id (str, optional): Page the call is made for, used for per-page rate limiting.
+            params (dict, optional): Query parameters.
+            data (dict, optional): Form body.
+            timeout (float, optional): Deadline in seconds for the call, retries included.
+
+        Returns:
+            requests.Response: The last response received.
+
+        Raises:
+            GraphRateLimited: If the rate limiter does not allow the call before the deadline.
+            requests.RequestException: If the last attempt failed without a response.
+        """
+        deadline = time.monotonic() + (timeout or self.timeout)
+        headers = {'Authorization': f'Bearer {access_token}'} if access_token else None
+        url = self.url(path)
+        attempt = 0
+
+        while True:
+            self._acquire(page_id, deadline)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise GraphRateLimited(f"Deadline exceeded before {method} {path} could be sent")
+
+            try:
+                response = self.session.request(method, url, params=params, data=data,
+                                                headers=headers, timeout=remaining)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not self._sleep_before_retry(attempt, deadline):
+                    raise
+                logger.warning("Graph API %s %s failed (%s), retrying.", method, path, e)
+                attempt += 1
+                continue
+
+            self._update_limits(response, page_id)
+
+            if response.status_code not in self.RETRY_STATUSES:
+                return response
+            if not self._sleep_before_retry(attempt, deadline, response.headers.get('Retry-After')):
+                return response
+
+            logger.warning("Graph API %s %s returned %s, retrying.", method, path, response.status_code)
+            attempt += 1
+
+    def _acquire(self, page_id, deadline):
+        if not self.app_bucket.acquire(deadline):
+            raise GraphRateLimited("App rate limit reached")
+        if page_id is not None and not self._page_bucket(page_id).acquire(deadline):
+            raise GraphRateLimited(f"Rate limit reached for page {page_id}")
+
+    def _page_bucket(self, page_id):
+        bucket = self._page_buckets.get(page_id)
+        if bucket is None:
+            with self._lock:
+                bucket = self._page_buckets.setdefault(page_id, TokenBucket(self.page_rate))
+        return bucket
+
+    def _sleep_before_retry(self, attempt, deadline, retry_after=None):
+        """Sleeps before the next attempt. Returns False if no retry should be made."""
+        if attempt >= self.max_retries:
+            return False
+
+        delay = random.uniform(0, self.backoff * (2 ** attempt))
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+
+        if time.monotonic() + delay >= deadline:
+            return False
+        time.sleep(delay)
+        return True
+
+    @staticmethod
+    def _parse_usage(header):
+        try:
+            return json.loads(header) if header else None
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _usage_percent(usage):
+        return max((usage.get(key, 0) or 0) for key in ('call_count', 'total_cputime', 'total_time'))
+
+    def _adapt(self, bucket, base_rate, percent):
+        """Slows a bucket down as the reported usage approaches 100%."""
+        if percent >= 100:
+            bucket.block_for(60)
+        elif percent >= 75:
+            bucket.set_rate(base_rate * (100 - percent) / 25)
+        else:
+            bucket.set_rate(base_rate)
+
+    def _update_limits(self, response, page_id):
+        """Adjusts the token buckets from the usage headers of a response."""
+        app_usage = self._parse_usage(response.headers.get('X-App-Usage'))
+        if app_usage:
+            self._adapt(self.app_bucket, self.app_bucket.base_rate, self._usage_percent(app_usage))
+
+        if page_id is None:
+            return
+
+        bucket = self._page_bucket(page_id)
+        page_usage = self._parse_usage(response.headers.get('X-Page-Usage'))
+        if page_usage:
+            self._adapt(bucket, self.page_rate, self._usage_percent(page_usage))
+
+        buc_usage = self._parse_usage(response.headers.get('X-Business-Use-Case-Usage'))
+        if buc_usage:
+            for entries in buc_usage.values():
+                for usage in entries or []:
+                    regain_minutes = usage.get('estimated_time_to_regain_access') or 0
+                    if regain_minutes:
+                        logger.warning("Graph API throttled page %s for %s minutes.", page_id, regain_minutes)
+                        bucket.block_for(regain_minutes * 60)
+                    else:
+                        self._adapt(bucket, self.page_rate, self._usage_percent(usage))
@@ -0,0 +1,385 @@
+"""
+Worker processes running moderation inference for the service.
+
+The filters, vectorizer and model are CPU-bound Python and numpy code, so
+request threads running them in one process are serialized by the GIL. The
+pool is started after the model is loaded and before the service starts any
+other thread: it forks a fork server, which forks the `processes` workers
+and any replacement for a worker that died, so no worker is ever forked from
+a process with other threads (whose locks it would inherit held). Workers
+share the model's memory copy-on-write (the parent's objects are frozen out
+of the garbage collector around the fork so the children do not touch, and
+copy, them). The timings of the pipeline stages a worker ran come back with
+its verdicts and are recorded in the parent's metrics.
+
+Request threads send comments to the least busy worker over its own pipe
+and wait on a Future for the verdicts of ModerationModel.moderate_batch.
+Comments passed to moderate() while every worker is busy wait, and go to
+the next free worker together, up to `max_batch` in one moderate_batch
+call. At most `max_pending` requests or waiting comments are in flight;
+beyond that, and when a worker crashes or does not answer in time,
+InferenceUnavailable is raised and the caller moderates in its own thread
+instead. A health check restarts workers that died or hang on a request.
+
+    pool = InferencePool(moderation_model, processes=8).start()
+    verdict = pool.moderate(text, owner_config, timeout=10)
+"""
+import atexit
+import gc
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import log
+from log import logger
+from metrics import metrics
+
+
+class InferenceUnavailable(RuntimeError):
+    """The pool cannot take or finish a request; moderate in the calling thread instead."""
+
+
+def _serve(model, conn):
+    """
+    Worker loop: scores (request ID, comments, configs, options) messages until the pipe closes.
+
+    Replies carry the verdicts and the stage timings recorded while scoring them.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    log.log_directly()
+    # The timings inherited from the parent are already in its metrics
+    metrics.drain_stages()
+    while True:
+        try:
+            request_id, comments, configs, options = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            reply = (request_id, True, (model.moderate_batch(comments, configs, **options), metrics.drain_stages()))
+        except Exception as e:
+            reply = (request_id, False, repr(e))
+        conn.send(reply)
+
+
+def _fork_server(model, control, parent_end):
+    """
+    Fork server loop: forks a worker for every pipe end received on `control` and sends back its PID.
+
+    The server has a single thread, so a worker never inherits a lock held by another thread.
+    It exits when the parent closes its end of `control`.
+    """
+    parent_end.close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Exited workers are reaped by the kernel
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    log.log_directly()
+    while True:
+        try:
+            _, fds, _, _ = socket.recv_fds(control, 1, 1)
+        except OSError:
+            return
+        if not fds:
+            return
+        pid = os.fork()
+        if pid == 0:
+            control.close()
+            code = 1
+            try:
+                _serve(model, multiprocessing.connection.Connection(fds[0]))
+                code = 0
+            finally:
+                os._exit(code)
+        os.close(fds[0])
+        control.sendall(struct.pack("q", pid))
+
+
+class _Worker:
+    def __init__(self, index):
+        self.index = index
+        self.pid = None
+        self.conn = None
+        self.alive = False
+        self.in_flight = {}  # request ID -> (Future, monotonic time sent)
+        self.send_lock = threading.Lock()
+
+
+class InferencePool:
+    """A fixed number of inference worker processes with bounded queueing and restarts."""
+
+    def __init__(self, model, processes=4, max_pending=256, max_batch=16, request_timeout=30, health_interval=1.0):
+        """
+        Args:
+            model (ModerationModel): The loaded model the workers inherit.
+            processes (int): Number of worker processes.
+            max_pending (int): Maximum requests in flight across all workers, and comments waiting in moderate().
+            max_batch (int): Maximum waiting comments moderate() sends to a worker in one request.
+            request_timeout (float): Seconds after which a worker busy with one request is restarted.
+            health_interval (float): Seconds between health checks.
+        """
+        self.model = model
+        self.processes = processes
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self.request_timeout = request_timeout
+        self.health_interval = health_interval
+        self.restarts = 0
+        self._workers = [_Worker(index) for index in range(processes)]
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._waiting = deque()  # (comment, config, options, Future) of moderate() calls
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._context = multiprocessing.get_context("fork")
+        self._server = None
+        self._control = None
+        self._control_lock = threading.Lock()
+        self._closing = False
+
+    def start(self):
+        """
+        Forks the fork server and the workers, and starts the health check.
+
+        Call it before the service starts any thread; the logging listener is stopped around the fork.
+        """
+        with log.listener_stopped():
+            if threading.active_count() > 1:
+                logger.warning("Inference pool started with %d other threads running; a lock one of them "
+                               "holds stays held in the workers.", threading.active_count() - 1)
+            self._start_server()
+        self._fork(self._workers)
+        threading.Thread(target=self._check_health, name="inference-health", daemon=True).start()
+        atexit.register(self.close)
+        logger.info("Started %d inference worker processes.", self.processes)
+        return self
+
+    def _start_server(self):
+        self._control, server_end = socket.socketpair()
+        # Objects frozen before the fork are never traversed by the collector of the server or the workers
+        gc.freeze()
+        try:
+            self._server = self._context.Process(target=_fork_server, args=(self.model, server_end, self._control),
+                                                 name="inference-fork-server", daemon=True)
+            self._server.start()
+        finally:
+            gc.unfreeze()
+        server_end.close()
+
+    def _fork(self, workers):
+        """Has the fork server fork the workers. Raises OSError if the fork server is gone."""
+        for worker in workers:
+            parent_conn, child_conn = self._context.Pipe()
+            try:
+                with self._control_lock:
+                    socket.send_fds(self._control, [b"w"], [child_conn.fileno()])
+                    reply = self._control.recv(8, socket.MSG_WAITALL)
+            finally:
+                child_conn.close()
+            if len(reply) != 8:
+                parent_conn.close()
+                raise OSError("The inference fork server exited.")
+            worker.pid, worker.conn, worker.alive = struct.unpack("q", reply)[0], parent_conn, True
+            threading.Thread(target=self._receive, args=(worker, parent_conn),
+                             name=f"inference-{worker.index}-results", daemon=True).start()
+
+    def _receive(self, worker, conn):
+        """Resolves the Futures of one worker's replies, until the worker exits."""
+        while True:
+            try:
+                request_id, ok, result = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                entry = worker.in_flight.pop(request_id, None)
+            if entry is None:
+                continue
+            self._slots.release()
+            if ok:
+                verdicts, stages = result
+                metrics.merge_stages(stages)
+                entry[0].set_result(verdicts)
+            else:
+                entry[0].set_exception(InferenceUnavailable(f"Inference failed: {result}"))
+        self._lost(worker, conn)
+
+    def _lost(self, worker, conn):
+        """Fails the requests of a worker that exited; the health check starts a new one."""
+        with self._lock:
+            if worker.conn is not conn:
+                return
+            worker.alive = False
+            lost = list(worker.in_flight.values())
+            worker.in_flight.clear()
+        for future, _ in lost:
+            self._slots.release()
+            future.set_exception(InferenceUnavailable(f"Inference worker {worker.index} exited."))
+        if lost:
+            logger.error("Inference worker %d exited, %d requests failed.", worker.index, len(lost))
+
+    def _check_health(self):
+        while not self._closing:
+            time.sleep(self.health_interval)
+            now = time.monotonic()
+            for worker in self._workers:
+                with self._lock:
+                    oldest = min((sent for _, sent in worker.in_flight.values()), default=None)
+                    alive = worker.alive
+                if alive and oldest is not None and now - oldest > self.request_timeout:
+                    logger.error("Inference worker %d did not answer in %.0fs, restarting it.",
+                                 worker.index, self.request_timeout)
+                    try:
+                        os.kill(worker.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                elif self._closing or alive:
+                    continue
+                else:
+                    logger.error("Inference worker %d exited, restarting it.", worker.index)
+                self._restart(worker)
+
+    def _restart(self, worker):
+        with self._lock:
+            worker.alive = False
+        worker.conn.close()
+        self._lost(worker, worker.conn)
+        try:
+            self._fork([worker])
+        except OSError as e:
+            logger.error("Could not restart inference worker %d: %s", worker.index, e)
+            return
+        self.restarts += 1
+        self._dispatch()
+
+    def submit(self, comments, configs=None, block=0.0, **options):
+        """
+        Sends a batch of comments to the least busy worker.
+
+        Args:
+            comments (list): Comment texts.
+            configs (list, optional): The owner configuration of each comment.
+            block (float): Seconds to wait for room when `max_pending` requests are in flight.
+            **options: Keyword arguments of moderate_batch, e.g. model_policy.
+
+        Returns:
+            Future: Resolves to the list of verdicts of ModerationModel.moderate_batch.
+
+        Raises:
+            InferenceUnavailable: If the pool is full or no worker is running.
+        """
+        if not self._slots.acquire(blocking=bool(block), timeout=block or None):
+            raise InferenceUnavailable("Inference pool is full.")
+
+        future = Future()
+        request_id = next(self._ids)
+        with self._lock:
+            running = [worker for worker in self._workers if worker.alive]
+            if not running:
+                self._slots.release()
+                raise InferenceUnavailable("No inference workers are running.")
+            worker = min(running, key=lambda w: len(w.in_flight))
+            worker.in_flight[request_id] = (future, time.monotonic())
+            conn = worker.conn
+
+        try:
+            with worker.send_lock:
+                conn.send((request_id, comments, configs, options))
+        except (OSError, ValueError):
+            # The worker is gone; its receiver thread fails the request
+            pass
+        return future
+
+    def moderate(self, comment, config=None, timeout=10, **options):
+        """
+        Moderates one comment in a worker and returns its verdict.
+
+        The comment goes to an idle worker, or waits for one together with the comments of other
+        request threads, so a busy pool moderates them in batches.
+
+        Raises:
+            InferenceUnavailable: If the pool is full, the worker failed, or no verdict came within `timeout`.
+        """
+        future = Future()
+        with self._lock:
+            if len(self._waiting) >= self.max_pending:
+                raise InferenceUnavailable("Inference pool is full.")
+            self._waiting.append((comment, config, options, future))
+        self._dispatch()
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise InferenceUnavailable(f"No verdict within {timeout}s.")
+
+    def _dispatch(self):
+        """Sends waiting comments to idle workers, up to `max_batch` with the same options per request."""
+        while True:
+            with self._lock:
+                running = [worker for worker in self._workers if worker.alive]
+                if not running:
+                    failed = list(self._waiting)
+                    self._waiting.clear()
+                elif not self._waiting or all(worker.in_flight for worker in running):
+                    return
+                else:
+                    failed, batch = None, []
+                    options = self._waiting[0][2]
+                    while self._waiting and len(batch) < self.max_batch and self._waiting[0][2] == options:
+                        entry = self._waiting.popleft()
+                        # Comments whose caller gave up are dropped
+                        if entry[3].set_running_or_notify_cancel():
+                            batch.append(entry)
+            if failed is not None:
+                for *_, waiter in failed:
+                    if waiter.set_running_or_notify_cancel():
+                        waiter.set_exception(InferenceUnavailable("No inference workers are running."))
+                return
+            if not batch:
+                continue
+
+            try:
+                future = self.submit([entry[0] for entry in batch], [entry[1] for entry in batch], **options)
+            except InferenceUnavailable as e:
+                for *_, waiter in batch:
+                    waiter.set_exception(e)
+                continue
+            future.add_done_callback(lambda future, batch=batch: self._resolve(batch, future))
+
+    def _resolve(self, batch, future):
+        """Passes the verdicts of a batch sent by _dispatch to its callers, then sends the next batch."""
+        try:
+            verdicts = future.result()
+        except Exception as e:
+            for *_, waiter in batch:
+                waiter.set_exception(e)
+        else:
+            for (*_, waiter), verdict in zip(batch, verdicts):
+                waiter.set_result(verdict)
+        self._dispatch()
+
+    def close(self):
+        """Stops the workers and the fork server; they exit when their pipe closes."""
+        self._closing = True
+        for worker in self._workers:
+            with self._lock:
+                worker.alive = False
+            if worker.conn is not None:
+                worker.conn.close()
+        if self._control is not None:
+            self._control.close()
+        if self._server is not None:
+            self._server.join(timeout=1)
+
+    def pending(self):
+        """Returns the number of requests in flight and comments waiting for a worker."""
+        return sum(len(worker.in_flight) for worker in self._workers) + len(self._waiting)
+
+    def alive(self):
+        """Returns the number of running workers."""
+        return sum(1 for worker in self._workers if worker.alive)
@@ -0,0 +1,177 @@
+"""
+Load shedding for the webhook service: degrades moderation in steps under pressure.
+
+Once a second the governor reads its signals (by default the webhooks in
+progress plus comments queued, and the moving average of moderation
+latency, which is at least the age of the oldest moderation in progress so
+a stall does not look like falling latency) and compares them with a
+threshold per step. The service runs at
+the highest step any signal reaches:
+
+    0 normal
+    1 defer_telemetry   training telemetry is queued and sent when the load is over
+    2 gate_model        the model only sees comments a filter flagged, the others are accepted
+    3 model_off         the model sees no comments; filter hits below REMOVE go to review, hidden
+    4 reject            webhooks are answered 503 with Retry-After, Meta sends them again later
+
+Steps are taken up at once and down one at a time, after the signals have
+stayed below the current step for `cooldown` seconds, so the service does not
+flap between steps. Every change is logged and counted in
+`haspde_load_shed_transitions_total`.
+
+    governor = LoadGovernor({'depth': [100, 200, 400, 800]}, {'depth': queue.size})
+    with governor.request():
+        with governor.moderation():
+            ...
+"""
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from log import logger
+from metrics import metrics
+from moderation_model import MODEL_FULL, MODEL_GATED, MODEL_OFF
+
+LEVELS = ("normal", "defer_telemetry", "gate_model", "model_off", "reject")
+NORMAL, DEFER_TELEMETRY, GATE_MODEL, MODEL_OFF_LEVEL, REJECT = range(len(LEVELS))
+
+
+class LoadGovernor:
+    """Chooses the load shedding step from pressure signals and their thresholds."""
+
+    def __init__(self, thresholds, signals=None, interval=1.0, cooldown=10.0, on_change=None):
+        """
+        Starts the thread evaluating the signals.
+
+        Args:
+            thresholds (dict): Signal name -> the value at which each of steps 1-4 starts. A signal
+                with fewer than 4 values never reaches the later steps.
+            signals (dict, optional): Signal name -> callable returning its current value. 'depth'
+                (webhooks in progress, plus the value of a 'depth' callable) and 'latency' (moving
+                average of observe(), at least the age of the oldest moderation()) are provided
+                by the governor.
+            interval (float): Seconds between evaluations.
+            cooldown (float): Seconds the signals must stay below a step before it is left.
+            on_change (callable, optional): Called with (old level, new level) after every change.
+        """
+        self.thresholds = thresholds
+        self.signals = dict(signals or {})
+        self.interval = interval
+        self.cooldown = cooldown
+        self.on_change = on_change
+        self.level = NORMAL
+        self._in_flight = 0
+        self._latency = 0.0
+        self._observed = False
+        self._moderating = {}  # ID -> monotonic start of each moderation() in progress
+        self._ids = itertools.count()
+        self._calm_since = None
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name="load-governor", daemon=True).start()
+
+    @contextmanager
+    def request(self):
+        """Counts a webhook request in progress for the 'depth' signal."""
+        with self._lock:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    @contextmanager
+    def moderation(self):
+        """Times one comment's moderation for the 'latency' signal, also while it is in progress."""
+        started = time.monotonic()
+        key = next(self._ids)
+        with self._lock:
+            self._moderating[key] = started
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._moderating[key]
+            self.observe(time.monotonic() - started)
+
+    def observe(self, seconds):
+        """Adds one moderation latency to the moving average of the 'latency' signal."""
+        with self._lock:
+            self._latency += 0.2 * (seconds - self._latency)
+            self._observed = True
+
+    def values(self):
+        """Returns the current value of every signal."""
+        values = {name: signal() for name, signal in self.signals.items()}
+        values['depth'] = values.get('depth', 0) + self._in_flight
+        values['latency'] = self._latency
+        return values
+
+    def pressure(self, values):
+        """Returns the highest step reached by any signal, and the signal reaching it."""
+        level, reason = NORMAL, None
+        for name, limits in self.thresholds.items():
+            reached = sum(1 for limit in limits[:REJECT] if values.get(name, 0) >= limit)
+            if reached > level:
+                level, reason = reached, name
+        return level, reason
+
+    def evaluate(self, now=None):
+        """Moves to the step the signals call for: up at once, down one step after the cooldown."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            oldest = min(self._moderating.values(), default=None)
+            if oldest is not None:
+                # A moderation that does not finish is not observed, count the time it has taken so far
+                self._latency = max(self._latency, time.monotonic() - oldest)
+            elif not self._observed:
+                # Without new comments, and none in progress, the average would stay at its last value
+                self._latency /= 2
+            self._observed = False
+        values = self.values()
+        target, reason = self.pressure(values)
+
+        if target > self.level:
+            self._calm_since = None
+            self._change(target, f"{reason} {values[reason]:g} >= {self.thresholds[reason][target - 1]:g}")
+        elif target < self.level:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.cooldown:
+                self._calm_since = now
+                self._change(self.level - 1, f"below thresholds for {self.cooldown:g}s")
+        else:
+            self._calm_since = None
+
+    def _change(self, level, reason):
+        old, self.level = self.level, level
+        log = logger.warning if level > old else logger.info
+        log("Load shedding step %s -> %s: %s.", LEVELS[old], LEVELS[level], reason,
+            extra={'shed_level': level})
+        metrics.counter("haspde_load_shed_transitions_total", "Changes of the load shedding step",
+                        to=LEVELS[level], **{'from': LEVELS[old]}).inc()
+        if self.on_change is not None:
+            try:
+                self.on_change(old, level)
+            except Exception as e:
+                logger.error("Error applying load shedding step %s: %s", LEVELS[level], e)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.evaluate()
+            except Exception as e:
+                logger.error("Error evaluating load: %s", e)
+
+    def model_policy(self):
+        """Returns how many comments the model sees at the current step."""
+        if self.level >= MODEL_OFF_LEVEL:
+            return MODEL_OFF
+        if self.level >= GATE_MODEL:
+            return MODEL_GATED
+        return MODEL_FULL
+
+    def rejecting(self):
+        return self.level >= REJECT
@@ -1,11 +1,130 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import random
+from contextlib import contextmanager
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else on a record came from `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+
+class TextFormatter(logging.Formatter):
+    """The usual text format, followed by the record's `extra` fields as key=value pairs."""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, with the record's `extra` fields as keys."""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update(_fields(record))
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+
+class _InProcessQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records as they are, so formatting happens on the listener thread.
+
+    The stock QueueHandler formats every record on the logging thread to make
+    it picklable, which is not needed for an in-process queue.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+# Request threads only put records on the queue; one listener thread formats and writes them
+_queue = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(TextFormatter(FORMAT))
+_queue_handler = _InProcessQueueHandler(_queue)
+_sample_rate = 0.01
+_listener = logging.handlers.QueueListener(_queue, _stream_handler, respect_handler_level=True)
 
 # Set up logging configuration
 logging.basicConfig(
-    level=logging.INFO,  # This will capture all levels from DEBUG and above
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]  # Ensure logs are output to the console
+    level=logging.INFO,
+    handlers=[_queue_handler]
 )
+_listener.start()
+atexit.register(_listener.stop)
+
+
+def configure(level="INFO", fmt="text", sample_rate=0.01):
+    """
+    Applies the logging settings from the configuration.
+
+    Args:
+        level (str): Lowest level logged.
+        fmt (str): "text" or "json".
+        sample_rate (float): Fraction of high-volume records (per-filter results) kept.
+    """
+    global _sample_rate
+    logging.getLogger().setLevel(level.upper() if isinstance(level, str) else level)
+    _stream_handler.setFormatter(JSONFormatter() if fmt == "json" else TextFormatter(FORMAT))
+    _sample_rate = sample_rate
+
+
+def log_directly():
+    """
+    Writes records straight to the stream instead of through the listener thread.
+
+    For forked worker processes: a fork copies only the forking thread, so the
+    child has the queue but no listener draining it.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_stream_handler)
+
+
+@contextmanager
+def listener_stopped():
+    """
+    Stops the listener thread for the duration of the block, so the process can fork with no other thread.
+
+    Records logged meanwhile stay on the queue and are written when the listener starts again.
+    """
+    _listener.stop()
+    try:
+        yield
+    finally:
+        _listener.start()
+
+
+def sample():
+    """
+    Decides whether to log one occurrence of a high-volume record.
+
+    Checked before logging, so skipped records are never created:
+
+        if sample():
+            logger.info("Filter %s returned: %s", name, result)
+    """
+    return random.random() < _sample_rate
+
 
 # Create logger instance
-logger = logging.getLogger("HaSpDe SoMe")
\ No newline at end of file
+logger = logging.getLogger("HaSpDe SoMe")
@@ -0,0 +1,244 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import requests
+from pymongo import UpdateOne
+
+from log import logger
+
+
+class _PendingLookup:
+    """A media ID that is waiting for the Graph API to resolve its owner."""
+
+    __slots__ = ("event", "owner_id")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.owner_id = None
+
+
+class MediaOwnerCache:
+    """
+    Resolves Instagram media IDs to the IDs of their owners.
+
+    A media's owner never changes, so resolved owners are kept in an in-memory
+    LRU backed by a MongoDB collection. Media that are in neither are resolved
+    through the Graph API using the multi-ID ``?ids=`` form, so lookups that
+    arrive close together share one HTTP request. Concurrent lookups for the
+    same media wait for the request that is already in flight.
+
+    The Graph API rejects a multi-ID request when any of its IDs is invalid;
+    such a request is split in halves and sent again, so only the invalid
+    media go unresolved.
+    """
+
+    MAX_IDS_PER_REQUEST = 50  # Graph API limit for the ids= parameter
+
+    def __init__(self, collection, graph_client, access_token, max_size=10000,
+                 batch_window=0.005, timeout=5):
+        """
+        Initializes the cache.
+
+        Args:
+            collection: MongoDB collection used as the persistent cache.
+            graph_client (GraphClient): Client used for Graph API lookups.
+            access_token (str): Access token used for Graph API lookups.
+            max_size (int): Maximum number of entries kept in memory.
+            batch_window (float): Seconds to wait for other misses before a lookup is sent.
+            timeout (float): Deadline in seconds for one Graph API request.
+        """
+        self.collection = collection
+        self.graph_client = graph_client
+        self.access_token = access_token
+        self.max_size = max_size
+        self.batch_window = batch_window
+        self.timeout = timeout
+
+        self._lru = OrderedDict()
+        self._inflight = {}
+        self._queue = []
+        self._flushing = False
+        self._lock = threading.Lock()
+
+        try:
+            self.collection.create_index("media_id", unique=True)
+        except Exception as e:
+            logger.warning("Could not create media owner index: %s", e)
+
+    def get(self, media_id):
+        """
+        Returns the owner ID of a media, or None if it could not be resolved.
+        """
+        if not media_id:
+            return None
+        return self.get_many([media_id]).get(media_id)
+
+    def get_many(self, media_ids):
+        """
+        Resolves the owners of several media at once.
+
+        Args:
+            media_ids (iterable): Media IDs to resolve.
+
+        Returns:
+            dict: Mapping of media ID to owner ID (None for unresolved media).
+        """
+        result = {}
+        missing = []
+
+        with self._lock:
+            for media_id in dict.fromkeys(media_ids):
+                if not media_id:
+                    continue
+                owner_id = self._lru.get(media_id)
+                if owner_id is not None:
+                    self._lru.move_to_end(media_id)
+                    result[media_id] = owner_id
+                else:
+                    missing.append(media_id)
+
+        if missing:
+            missing = self._load_from_db(missing, result)
+
+        if missing:
+            result.update(self._resolve_remote(missing))
+
+        return result
+
+    def invalidate(self, media_id):
+        """Removes a media from the in-memory cache."""
+        with self._lock:
+            self._lru.pop(media_id, None)
+
+    def _remember(self, media_id, owner_id):
+        """Stores a resolved owner in the LRU. The caller must hold the lock."""
+        self._lru[media_id] = owner_id
+        self._lru.move_to_end(media_id)
+        while len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+
+    def _load_from_db(self, media_ids, result):
+        """Fills `result` from MongoDB and returns the media IDs that are still missing."""
+        try:
+            docs = self.collection.find(
+                {'media_id': {'$in': media_ids}},
+                {'_id': 0, 'media_id': 1, 'owner_id': 1}
+            )
+            found = {doc['media_id']: doc['owner_id'] for doc in docs if doc.get('owner_id')}
+        except Exception as e:
+            logger.error("Error reading media owners from the database: %s", e)
+            return media_ids
+
+        with self._lock:
+            for media_id, owner_id in found.items():
+                self._remember(media_id, owner_id)
+        result.update(found)
+
+        return [media_id for media_id in media_ids if media_id not in found]
+
+    def _resolve_remote(self, media_ids):
+        """Resolves media through the Graph API, joining lookups that are already in flight."""
+        waits = {}
+        with self._lock:
+            for media_id in media_ids:
+                pending = self._inflight.get(media_id)
+                if pending is None:
+                    pending = _PendingLookup()
+                    self._inflight[media_id] = pending
+                    self._queue.append(media_id)
+                waits[media_id] = pending
+
+            leader = bool(self._queue) and not self._flushing
+            if leader:
+                self._flushing = True
+
+        if leader:
+            # Give concurrent misses a moment to join the same request
+            if self.batch_window:
+                time.sleep(self.batch_window)
+            self._flush()
+
+        # Every queued lookup is answered by the flush, which may take several `timeout`s
+        # when it sends many chunks, so there is no deadline here
+        result = {}
+        for media_id, pending in waits.items():
+            pending.event.wait()
+            result[media_id] = pending.owner_id
+        return result
+
+    def _flush(self):
+        """Sends queued lookups in chunks until the queue is empty."""
+        while True:
+            with self._lock:
+                batch = self._queue[:self.MAX_IDS_PER_REQUEST]
+                del self._queue[:self.MAX_IDS_PER_REQUEST]
+                if not batch:
+                    self._flushing = False
+                    return
+
+            owners = {}
+            try:
+                owners = self._fetch_owners(batch)
+                self._store(owners)
+            except Exception as e:
+                logger.error("Error resolving the owners of %d media: %s", len(batch), e)
+            finally:
+                with self._lock:
+                    for media_id in batch:
+                        owner_id = owners.get(media_id)
+                        if owner_id is not None:
+                            self._remember(media_id, owner_id)
+                        pending = self._inflight.pop(media_id, None)
+                        if pending is not None:
+                            pending.owner_id = owner_id
+                            pending.event.set()
+
+    def _fetch_owners(self, media_ids):
+        """Fetches the owners of up to MAX_IDS_PER_REQUEST media in one Graph API request."""
+        params = {
+            'ids': ",".join(media_ids),
+            'fields': 'owner'
+        }
+
+        try:
+            response = self.graph_client.get("", access_token=self.access_token, params=params,
+                                             timeout=self.timeout)
+            if response.status_code == 400 and len(media_ids) > 1:
+                # One invalid ID fails the whole request, find it by halves
+                half = len(media_ids) // 2
+                return {**self._fetch_owners(media_ids[:half]), **self._fetch_owners(media_ids[half:])}
+            if response.status_code != 200:
+                logger.warning("Failed to get owner IDs for %d media. Status code: %s",
+                               len(media_ids), response.status_code)
+                return {}
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            logger.error("An error occurred while retrieving owner IDs for %d media: %s", len(media_ids), e)
+            return {}
+
+        owners = {}
+        for media_id, media in data.items():
+            owner_id = (media or {}).get('owner', {}).get('id')
+            if owner_id:
+                owners[media_id] = owner_id
+        return owners
+
+    def _store(self, owners):
+        """Persists resolved owners to MongoDB."""
+        if not owners:
+            return
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {'media_id': media_id},
+                {'$set': {'owner_id': owner_id, 'resolved_at': now}},
+                upsert=True
+            )
+            for media_id, owner_id in owners.items()
+        ]
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error("Error storing media owners in the database: %s", e)
@@ -0,0 +1,279 @@
+"""
+In-process metrics: counters, gauges and latency histograms, rendered in the
+Prometheus text format by the `/metrics` route.
+
+Recording a value is a lock and a few integer operations. Quantiles and text
+are only computed when the metrics are scraped, so an unscraped registry
+costs next to nothing.
+
+    from metrics import metrics, timed
+
+    with metrics.stage("vectorize"):
+        ...
+
+    @timed("predict")
+    def predict(...):
+        ...
+"""
+import functools
+import threading
+import time
+
+STAGE_METRIC = "haspde_stage_seconds"
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Counter:
+    """A monotonically increasing count."""
+
+    __slots__ = ("_value", "_lock")
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Histogram:
+    """
+    Latency histogram with logarithmic buckets, in the style of HdrHistogram.
+
+    Values are recorded in microseconds. Below 16 µs every value has its own
+    bucket; above that each power of two is split into 8 buckets, so a
+    quantile is accurate to within 12.5% across microseconds to hours with
+    about 300 integers of state.
+    """
+
+    SUB_BUCKETS = 8
+    BUCKETS = 16 + 36 * SUB_BUCKETS
+
+    __slots__ = ("_counts", "_count", "_sum", "_max", "_lock")
+
+    def __init__(self):
+        self._counts = [0] * self.BUCKETS
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def bucket_of(cls, micros):
+        if micros < 16:
+            return micros
+        shift = micros.bit_length() - 4
+        return min(16 + (shift - 1) * cls.SUB_BUCKETS + (micros >> shift) - 8, cls.BUCKETS - 1)
+
+    @classmethod
+    def bucket_value(cls, index):
+        """Returns the midpoint of a bucket in microseconds."""
+        if index < 16:
+            return index
+        shift = (index - 16) // cls.SUB_BUCKETS + 1
+        mantissa = (index - 16) % cls.SUB_BUCKETS + 8
+        return ((mantissa << shift) + ((mantissa + 1) << shift)) / 2
+
+    def observe(self, seconds):
+        """Records one duration in seconds."""
+        index = self.bucket_of(max(int(seconds * 1e6), 0))
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += seconds
+            if seconds > self._max:
+                self._max = seconds
+
+    def drain(self):
+        """Returns ({bucket: count}, count, sum, max) of the values recorded since the last drain, and clears them."""
+        with self._lock:
+            drained = ({index: n for index, n in enumerate(self._counts) if n}, self._count, self._sum, self._max)
+            self._counts = [0] * self.BUCKETS
+            self._count = 0
+            self._sum = 0.0
+            self._max = 0.0
+        return drained
+
+    def merge(self, counts, count, total, largest):
+        """Adds the values drained from another histogram, e.g. one in a worker process."""
+        with self._lock:
+            for index, n in counts.items():
+                self._counts[index] += n
+            self._count += count
+            self._sum += total
+            if largest > self._max:
+                self._max = largest
+
+    def snapshot(self):
+        """Returns (count, sum, max, quantiles) with quantiles in seconds."""
+        with self._lock:
+            counts = list(self._counts)
+            count, total, largest = self._count, self._sum, self._max
+
+        quantiles = {}
+        if count:
+            targets = [(q, q * count) for q in QUANTILES]
+            seen = 0
+            for index, n in enumerate(counts):
+                if not n:
+                    continue
+                seen += n
+                while targets and seen >= targets[0][1]:
+                    quantiles[targets.pop(0)[0]] = min(self.bucket_value(index) / 1e6, largest)
+                if not targets:
+                    break
+        return count, total, largest, quantiles
+
+
+class _Timing:
+    """Times one block with the monotonic performance counter."""
+
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class MetricsRegistry:
+    """Holds every metric of the process, keyed by name and labels."""
+
+    def __init__(self):
+        self._metrics = {}  # (name, labels) -> Counter | Histogram | callable
+        self._help = {}
+        self._types = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, factory, name, help, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = factory()
+                    self._types[name] = kind
+                    if help:
+                        self._help[name] = help
+        return metric
+
+    def counter(self, name, help="", **labels):
+        """Returns the counter with this name and labels, creating it on first use."""
+        return self._get("counter", Counter, name, help, labels)
+
+    def histogram(self, name, help="", **labels):
+        """Returns the latency histogram with this name and labels, creating it on first use."""
+        return self._get("summary", Histogram, name, help, labels)
+
+    def gauge(self, name, help, callback, **labels):
+        """Registers a gauge whose value is read from `callback` when the metrics are scraped."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._metrics[key] = callback
+            self._types[name] = "gauge"
+            self._help[name] = help
+
+    def stage(self, stage):
+        """Returns a context manager timing one run of a pipeline stage."""
+        return _Timing(self.histogram(STAGE_METRIC, "Time spent in each pipeline stage", stage=stage))
+
+    def observe(self, stage, seconds):
+        """Records a duration measured elsewhere for a pipeline stage."""
+        self.histogram(STAGE_METRIC, "Time spent in each pipeline stage", stage=stage).observe(seconds)
+
+    def drain_stages(self):
+        """Returns {stage: drained histogram} of the stages timed since the last drain, for merge_stages."""
+        drained = {}
+        for (name, labels), metric in list(self._metrics.items()):
+            if name == STAGE_METRIC:
+                values = metric.drain()
+                if values[1]:
+                    drained[dict(labels)['stage']] = values
+        return drained
+
+    def merge_stages(self, drained):
+        """Records the stage timings drained in another process."""
+        for stage, values in drained.items():
+            self.histogram(STAGE_METRIC, "Time spent in each pipeline stage", stage=stage).merge(*values)
+
+    def stages(self):
+        """Returns {stage: {'count', 'p50', 'p90', 'p99', 'max'}} with latencies in seconds."""
+        result = {}
+        for (name, labels), metric in list(self._metrics.items()):
+            if name != STAGE_METRIC:
+                continue
+            count, _, largest, quantiles = metric.snapshot()
+            result[dict(labels)['stage']] = {
+                'count': count,
+                **{f"p{int(q * 100)}": quantiles.get(q, 0.0) for q in QUANTILES},
+                'max': largest,
+            }
+        return result
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        by_name = {}
+        for (name, labels), metric in list(self._metrics.items()):
+            by_name.setdefault(name, []).append((labels, metric))
+
+        lines = []
+        for name in sorted(by_name):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {self._types[name]}")
+            for labels, metric in by_name[name]:
+                if isinstance(metric, Histogram):
+                    count, total, largest, quantiles = metric.snapshot()
+                    for q in QUANTILES:
+                        lines.append(f"{name}{_labels(labels, quantile=q)} {quantiles.get(q, 0.0):.6f}")
+                    lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+                    lines.append(f"{name}_count{_labels(labels)} {count}")
+                elif isinstance(metric, Counter):
+                    lines.append(f"{name}{_labels(labels)} {metric.value}")
+                else:
+                    try:
+                        value = metric()
+                    except Exception:
+                        continue
+                    lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+# The registry shared by the whole process
+metrics = MetricsRegistry()
+
+
+def timed(stage):
+    """Decorator timing every call of a function as a pipeline stage."""
+    def decorator(func):
+        histogram = metrics.histogram(STAGE_METRIC, "Time spent in each pipeline stage", stage=stage)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
@@ -0,0 +1,199 @@
+from collections import Counter
+from datetime import datetime
+
+from pymongo import ReturnDocument, UpdateOne
+
+from log import logger
+
+
+class ModerationCounters:
+    """
+    Comment counts per status, kept up to date as comments change status.
+
+    Every status transition increments the new status and decrements the old
+    one with `$inc` on three counter documents: the overall totals
+    (`_id: "all"`), the platform (`"platform:<name>"`) and the owner
+    (`"owner:<id>"`). Reading stats is then a lookup by `_id` instead of a
+    scan of the comments collection. Comments being reviewed (IN_REVIEW) are
+    counted as PENDING_REVIEW, so claims and expired leases do not touch the
+    counters. Transitions that race with each other can make the counters
+    drift; `reconcile` rebuilds them from the comments collection and runs on
+    the scheduler.
+    """
+
+    TOTAL = "all"
+    # Statuses counted under another status
+    ALIASES = {'IN_REVIEW': 'PENDING_REVIEW'}
+
+    def __init__(self, collection, comments):
+        """
+        Args:
+            collection: The collection holding the counter documents.
+            comments: The comments collection.
+        """
+        self.collection = collection
+        self.comments = comments
+
+    @classmethod
+    def counted(cls, status):
+        return cls.ALIASES.get(status, status)
+
+    @classmethod
+    def keys(cls, platform, owner_id):
+        """Returns the IDs of the counter documents a comment counts towards."""
+        keys = [cls.TOTAL]
+        if platform:
+            keys.append(f"platform:{platform}")
+        if owner_id:
+            keys.append(f"owner:{owner_id}")
+        return keys
+
+    def record(self, platform, owner_id, old_status, new_status, count=1):
+        """Counts `count` comments moving from `old_status` (None for new comments) to `new_status`."""
+        self.record_many([(platform, owner_id, old_status, new_status)], count)
+
+    def record_many(self, transitions, count=1):
+        """
+        Counts several transitions with one write.
+
+        Args:
+            transitions (iterable): (platform, owner_id, old_status, new_status) tuples.
+            count (int): Comments each transition stands for.
+        """
+        deltas = {}
+        for platform, owner_id, old_status, new_status in transitions:
+            old_status, new_status = self.counted(old_status), self.counted(new_status)
+            if old_status == new_status:
+                continue
+            for key in self.keys(platform, owner_id):
+                delta = deltas.setdefault(key, Counter())
+                if old_status:
+                    delta[old_status] -= count
+                if new_status:
+                    delta[new_status] += count
+
+        operations = []
+        for key, delta in deltas.items():
+            inc = {f'counts.{status}': n for status, n in delta.items() if n}
+            if inc:
+                operations.append(UpdateOne({'_id': key}, {'$inc': inc}, upsert=True))
+        if not operations:
+            return
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error("Error updating moderation counters: %s", e)
+
+    def transition(self, comment_filter, new_status, update=None):
+        """
+        Sets the status of the comments matching `comment_filter` and counts the change.
+
+        Each comment is moved with `find_one_and_update`, so its previous status is
+        known exactly. Comments already in `new_status` are left alone.
+
+        Args:
+            comment_filter (dict): Selects the comments, usually `{'id': comment_id}`.
+            new_status (str): The status to set.
+            update (dict, optional): Further update operators applied with the status change.
+
+        Returns:
+            int: The number of comments whose status changed.
+        """
+        update = dict(update or {})
+        update['$set'] = dict(update.get('$set') or {}, status=new_status)
+        query = dict(comment_filter, status={'$ne': new_status})
+
+        changed = 0
+        while True:
+            previous = self.comments.find_one_and_update(
+                query, update,
+                projection={'status': 1, 'platform': 1, 'owner_id': 1},
+                return_document=ReturnDocument.BEFORE
+            )
+            if previous is None:
+                return changed
+            changed += 1
+            self.record(previous.get('platform'), previous.get('owner_id'), previous.get('status'), new_status)
+
+    def transition_all(self, comment_filter, new_status, update=None):
+        """
+        Moves every comment matching `comment_filter` to `new_status` with one
+        `update_many` per platform and owner, counting the changes.
+
+        Returns:
+            int: The number of comments whose status changed.
+        """
+        update = dict(update or {})
+        update['$set'] = dict(update.get('$set') or {}, status=new_status)
+        groups = self.comments.aggregate([
+            {'$match': comment_filter},
+            {'$group': {'_id': {'platform': '$platform', 'owner_id': '$owner_id', 'status': '$status'}}}
+        ])
+
+        changed = 0
+        for group in groups:
+            platform, owner_id, status = group['_id'].get('platform'), group['_id'].get('owner_id'), group['_id'].get('status')
+            result = self.comments.update_many(
+                {'$and': [comment_filter, {'platform': platform, 'owner_id': owner_id, 'status': status}]},
+                update
+            )
+            if result.modified_count:
+                self.record(platform, owner_id, status, new_status, result.modified_count)
+                changed += result.modified_count
+        return changed
+
+    def stats(self, platform=None, owner_id=None):
+        """
+        Returns the counts per status, overall or for one platform or owner.
+
+        Returns:
+            dict: Status -> number of comments, without empty statuses.
+        """
+        if owner_id:
+            key = f"owner:{owner_id}"
+        elif platform:
+            key = f"platform:{platform}"
+        else:
+            key = self.TOTAL
+        doc = self.collection.find_one({'_id': key}) or {}
+        return {status: n for status, n in (doc.get('counts') or {}).items() if n}
+
+    def platforms(self):
+        """Returns the counts per status of every platform."""
+        docs = self.collection.find({'_id': {'$regex': '^platform:'}})
+        return {doc['_id'].split(":", 1)[1]: {status: n for status, n in doc.get('counts', {}).items() if n}
+                for doc in docs}
+
+    def reconcile(self):
+        """Rebuilds all counters from the comments collection."""
+        started = datetime.utcnow()
+        counts = {}
+        try:
+            groups = self.comments.aggregate([
+                {'$group': {
+                    '_id': {'platform': '$platform', 'owner_id': '$owner_id', 'status': '$status'},
+                    'count': {'$sum': 1}
+                }}
+            ], allowDiskUse=True)
+            for group in groups:
+                status = self.counted(group['_id'].get('status'))
+                if not status:
+                    continue
+                for key in self.keys(group['_id'].get('platform'), group['_id'].get('owner_id')):
+                    counts.setdefault(key, Counter())[status] += group['count']
+
+            for key, by_status in counts.items():
+                self.collection.replace_one({'_id': key}, {'counts': dict(by_status), 'reconciled_at': started},
+                                            upsert=True)
+            self.collection.delete_many({'_id': {'$nin': list(counts)}})
+        except Exception as e:
+            logger.error("Error reconciling moderation counters: %s", e)
+            return
+
+        logger.info("Reconciled moderation counters for %d keys in %.1fs.",
+                    len(counts), (datetime.utcnow() - started).total_seconds())
+
+    def reconcile_if_missing(self):
+        """Builds the counters when they have never been built."""
+        if self.collection.find_one({'_id': self.TOTAL}, {'_id': 1}) is None:
+            self.reconcile()
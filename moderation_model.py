@@ -3,11 +3,14 @@ from typing import List, Type
 import os
 import nltk
 import joblib
-from log import logger
+from log import logger, sample
+from metrics import metrics, timed
+from tracing import tracer, traced
 from pymongo import MongoClient
 import logging
+import time
+from collections import OrderedDict, deque
 import numpy as np
-import time  # New for performance tracking
 
 from model_updater import ModelUpdater
 from filters import (
@@ -33,6 +36,7 @@ logger = logging.getLogger("HaSpDe")
 nltk.download('punkt')
 
 LOG_SERVER_URL = "https://haspde.luova.club/log_comment"
+UPDATES_URL = "https://updates.haspde.luova.club"
 
 # Priority levels for moderation results
 MODERATION_PRIORITY = {
@@ -43,30 +47,49 @@ MODERATION_PRIORITY = {
     ModerationResult.BAN: 5,
 }
 
-# Adding performance tracking decorator
-def performance_tracker(func):
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        duration = end_time - start_time
-        logger.info(f"Function {func.__name__} executed in {duration:.4f} seconds")
-        return result
-    return wrapper
-
-@performance_tracker
+def final_result(filter_result, model_result, percent, certainty_needed):
+    """Combines the most severe filter result with the model's, which counts only when certain enough."""
+    if percent >= certainty_needed and MODERATION_PRIORITY[model_result] > MODERATION_PRIORITY[filter_result]:
+        return model_result
+    return filter_result
+
+# How many comments the model sees, lowered by the load governor under pressure
+MODEL_FULL = "full"    # Every comment
+MODEL_GATED = "gated"  # Only comments a filter flagged, the others are accepted
+MODEL_OFF = "off"      # None, flagged comments below REMOVE go to human review
+
+def runs_model(filter_result, model_policy):
+    return model_policy == MODEL_FULL or (model_policy == MODEL_GATED and filter_result != ModerationResult.ACCEPT)
+
+def shed_result(filter_result, model_policy):
+    """The result of a comment the model did not see: without the model, weaker filter hits are uncertain."""
+    if (model_policy == MODEL_OFF and filter_result != ModerationResult.ACCEPT
+            and MODERATION_PRIORITY[filter_result] < MODERATION_PRIORITY[ModerationResult.REMOVE]):
+        return ModerationResult.HUMAN_REVIEW
+    return filter_result
+
+@timed("predict")
+@traced("inference")
 def get_most_probable_class_and_percent(model, X):
     """Get the most probable class and its percentage from the model."""
     probabilities = model.predict_proba(X)
     most_probable_class_index = np.argmax(probabilities, axis=1)[0]  # First element
     most_probable_percent = probabilities[0, most_probable_class_index] * 100  # First row
-    logger.info(f"Most probable class: {most_probable_class_index}, Confidence: {most_probable_percent:.2f}%")
+    logger.debug("Most probable class: %s, Confidence: %.2f%%", most_probable_class_index, most_probable_percent)
     return most_probable_class_index, most_probable_percent
 
 class ModerationModel:
+    # Custom filters are reused for this many seconds, then created again to pick up word list changes
+    CUSTOM_FILTER_TTL = 300
+    CUSTOM_FILTER_CACHE_SIZE = 1000
+
     def __init__(self, learns=True, human_review=False, certainty_needed=80,
-                 model_file="moderation_model.joblib", vectorizer_file="tfidf_vectorizer.joblib"):
+                 model_file="moderation_model.joblib", vectorizer_file="tfidf_vectorizer.joblib",
+                 updates_url=UPDATES_URL):
         self.updater = ModelUpdater()
+        self.telemetry_url = f"{updates_url}/comments"
+        # The filters fetch their word lists from the same server when they are created
+        BaseFilter.BASE_UPDATE_URL = f"{updates_url}/filters"
         self.model_file = model_file
         self.vectorizer_file = vectorizer_file
         self.model = self.load_model()
@@ -87,9 +110,13 @@ class ModerationModel:
             BoyFilter,
             InclusiveSafetyFilter
         ]
+        self._custom_filters = OrderedDict()  # (name, 0_action, 1_action) -> (CustomFilter, monotonic time created)
+        # Telemetry is queued here instead of sent while the service is under load, the oldest dropped when full
+        self.defer_telemetry = False
+        self._deferred_telemetry = deque(maxlen=10000)
         self._initialize()
 
-    @performance_tracker
+    @timed("load_model")
     def load_model(self, attempt=0, max_attempts=2):
         """
         Load the machine learning model with retry logic.
@@ -109,19 +136,19 @@ class ModerationModel:
             model = joblib.load(self.model_file)
             logger.info("🔥 Existing model loaded successfully. Let's go!")
         except Exception as e:
-            logger.error(f"💔 Failed to load the model: {e}. Attempting to reinitialize it!")
+            logger.error("💔 Failed to load the model: %s. Attempting to reinitialize it!", e)
             
             # Try to force reinitialize the model
             try:
                 self.updater.update_model(force=True)
                 logger.info("🎨 Model reinitialized successfully.")
             except Exception as reinit_error:
-                logger.error(f"❌ Error during reinitialization: {reinit_error}. Exiting.")
+                logger.error("❌ Error during reinitialization: %s. Exiting.", reinit_error)
                 exit(1)
 
             # Retry the loading process if maximum attempts not reached
             if attempt < max_attempts:
-                logger.info(f"🔁 Retrying model load (attempt {attempt + 1}/{max_attempts})...")
+                logger.info("🔁 Retrying model load (attempt %d/%d)...", attempt + 1, max_attempts)
                 return self.load_model(attempt=attempt + 1, max_attempts=max_attempts)
             else:
                 logger.critical("💀 Maximum retries exceeded. Exiting.")
@@ -130,7 +157,7 @@ class ModerationModel:
         return model
 
 
-    @performance_tracker
+    @timed("load_vectorizer")
     def load_vectorizer(self, attempt=0, max_attempts=2):
         """
         Load the vectorizer with retry logic and error handling.
@@ -147,19 +174,19 @@ class ModerationModel:
             vectorizer = joblib.load(self.vectorizer_file)
             logger.info("🎨 Vectorizer loaded successfully.")
         except Exception as e:
-            logger.error(f"🛑 Failed to load vectorizer: {e}. Attempting to reinitialize model...")
+            logger.error("🛑 Failed to load vectorizer: %s. Attempting to reinitialize model...", e)
 
             # Try to force reinitialize the model
             try:
                 self.updater.update_model(force=True)
                 logger.info("🎨 Model reinitialized successfully.")
             except Exception as reinit_error:
-                logger.error(f"❌ Error during reinitialization: {reinit_error}. Exiting.")
+                logger.error("❌ Error during reinitialization: %s. Exiting.", reinit_error)
                 exit(1)
 
             # Retry loading the vectorizer if maximum attempts not reached
             if attempt < max_attempts:
-                logger.info(f"🔁 Retrying vectorizer load (attempt {attempt + 1}/{max_attempts})...")
+                logger.info("🔁 Retrying vectorizer load (attempt %d/%d)...", attempt + 1, max_attempts)
                 return self.load_vectorizer(attempt=attempt + 1, max_attempts=max_attempts)
             else:
                 logger.critical("💀 Maximum retries exceeded. Exiting.")
@@ -171,12 +198,13 @@ class ModerationModel:
     def _initialize(self):
         self.filters = [filter() for filter in self.filters]  # Instantiate each filter and store it
         for filter in self.filters:
-            logger.info(f"🚀 Initializing {filter.__class__.__name__}")
+            logger.info("🚀 Initializing %s", filter.__class__.__name__)
 
     def _01_label(self, label):
         return 0 if label in [0] else 1
-    @performance_tracker
-    def moderate_comment(self, comment, config={}, interactive=False):
+    @timed("moderate")
+    @traced("moderate_comment")
+    def moderate_comment(self, comment, config={}, interactive=False, model_policy=MODEL_FULL):
         highest_result = ModerationResult.ACCEPT  # Start with the lowest moderation level
         
         filt = []
@@ -188,34 +216,46 @@ class ModerationModel:
         
         filt.extend(self.filters)
 
+        # Per-filter results are logged for a sample of comments only
+        log_filters = sample()
+
         # Run all filters
         for filter_instance in filt:
-            result = filter_instance.apply(comment)
-            logger.info(f"🔍 Filter {filter_instance.__class__.__name__} returned: {result}")
+            name = filter_instance.__class__.__name__
+            with metrics.stage(f"filter:{name}"), tracer.span(f"filter:{name}") as span:
+                result = filter_instance.apply(comment)
+                span.set(result=int(result))
+            if log_filters:
+                logger.info("🔍 Filter %s returned: %s", name, result, extra={'filter': name})
 
             if MODERATION_PRIORITY[int(result)] > MODERATION_PRIORITY[highest_result]:
                 highest_result = int(result)
 
-        transformed_comment = self.vectorizer.transform([comment])  # Transform the input comment
-
         # Human review option
         if self.human_review:
             feedback = self.ask_for_human_review(comment)
             if feedback in [0, 1]:
                 self._log_comment(feedback, comment)
                 action = "approved" if feedback == 0 else "flagged for moderation"
-                logger.info(f'Comment "{comment}" {action} based on human review.')
+                logger.info('Comment "%.80s" %s based on human review.', comment, action)
                 return ModerationResult(ModerationResult.ACCEPT if feedback == 0 else ModerationResult.HIDE)
             else:
                 logger.warning("Invalid human review input. Please try again.")
                 return self.moderate_comment(comment)
 
+        # Under load the model sees fewer comments; the results it did not confirm are not training data
+        if not runs_model(highest_result, model_policy):
+            metrics.counter("haspde_model_skipped_total", "Comments moderated without the model under load",
+                            policy=model_policy).inc()
+            return self.report(comment, shed_result(highest_result, model_policy), 0, telemetry=False)
+
         # Model prediction
-        input_data = self.vectorizer.transform([comment])
+        with metrics.stage("vectorize"), tracer.span("vectorize"):
+            input_data = self.vectorizer.transform([comment])
         most_probable_class, percent = get_most_probable_class_and_percent(self.model, input_data)    
 
         model_result = ModerationResult.HIDE if most_probable_class == 1 else ModerationResult.ACCEPT
-        logger.info(f'🤖 Model moderation result: {model_result} with certainty {percent:.2f}%')
+        logger.debug('🤖 Model moderation result: %s with certainty %.2f%%', model_result, percent)
 
         # Check confidence level and adjust the result based on certainty
         if percent >= self.certainty_needed:
@@ -224,15 +264,101 @@ class ModerationModel:
 
         highest_result = self.feedback(interactive, highest_result, percent, model_result)
 
+        return self.report(comment, highest_result, percent)
+
+    def report(self, comment, result, percent, telemetry=True):
+        """Logs a final moderation result and sends its telemetry, also for verdicts from an InferencePool."""
         # If the result is still human review, and interactive mode is enabled
-        if highest_result == ModerationResult.HUMAN_REVIEW:
+        if result == ModerationResult.HUMAN_REVIEW:
             logger.warning("🤷‍♀️ Uncertain about comment, requesting human review.")
-        
+
         # Log the final moderation result
-        self._log_comment(self._01_label(highest_result), highest_result, comment)
-        logger.info(f'🎉 Comment "{comment}" received final moderation result: {highest_result}')
-        
-        return highest_result
+        if telemetry:
+            self._log_comment(self._01_label(result), result, comment)
+        logger.info('🎉 Comment "%.80s" received final moderation result: %s', comment, result,
+                    extra={'result': int(result), 'certainty': round(float(percent), 2)})
+
+        return result
+
+    def custom_filters(self, config):
+        """
+        Returns the owner's custom filters for moderate_batch.
+
+        A filter is reused for CUSTOM_FILTER_TTL seconds and then created again, which
+        checks its word list version; the least recently used are dropped past
+        CUSTOM_FILTER_CACHE_SIZE filters.
+        """
+        now = time.monotonic()
+        filters = []
+        for spec in (config or {}).get("filters", []):
+            key = (spec.get("name"), spec.get("0_action", None), spec.get("1_action", None))
+            cached = self._custom_filters.get(key)
+            if cached is None or now - cached[1] >= self.CUSTOM_FILTER_TTL:
+                cached = self._custom_filters[key] = (CustomFilter(*key), now)
+            self._custom_filters.move_to_end(key)
+            filters.append(cached[0])
+        while len(self._custom_filters) > self.CUSTOM_FILTER_CACHE_SIZE:
+            self._custom_filters.popitem(last=False)
+        return filters
+
+    def moderate_batch(self, comments, configs=None, model_policy=MODEL_FULL):
+        """
+        Moderates a batch of comments the way moderate_comment does, for offline jobs.
+
+        The filters run per comment, the vectorizer and the model once for the
+        whole batch, and are timed as the same stages. There is no telemetry,
+        human review or per-comment logging.
+
+        Args:
+            comments (list): Comment texts.
+            configs (list, optional): The owner configuration of each comment, or None.
+            model_policy (str): MODEL_FULL, or MODEL_GATED or MODEL_OFF to run the model for fewer comments.
+
+        Returns:
+            list: A dict per comment with the final 'result', the 'model_result', the model's
+                'certainty' in percent and 'filters', the results of the filters that did not accept it.
+                'model_result' is None and 'certainty' 0 for comments the model did not see.
+        """
+        if not comments:
+            return []
+
+        filter_results = []
+        for index, comment in enumerate(comments):
+            highest_result = ModerationResult.ACCEPT
+            hits = {}
+            config = configs[index] if configs else None
+            for filter_instance in self.custom_filters(config) + self.filters:
+                with metrics.stage(f"filter:{filter_instance.__class__.__name__}"):
+                    result = int(filter_instance.apply(comment))
+                if result != ModerationResult.ACCEPT:
+                    hits[filter_instance.filter_type] = result
+                if MODERATION_PRIORITY[result] > MODERATION_PRIORITY[highest_result]:
+                    highest_result = result
+            filter_results.append((highest_result, hits))
+
+        modeled = [index for index, (result, _) in enumerate(filter_results) if runs_model(result, model_policy)]
+        if modeled:
+            with metrics.stage("vectorize"):
+                input_data = self.vectorizer.transform([comments[i] for i in modeled])
+            with metrics.stage("predict"):
+                probabilities = self.model.predict_proba(input_data)
+            most_probable = np.argmax(probabilities, axis=1)
+        rows = {index: row for row, index in enumerate(modeled)}
+
+        verdicts = []
+        for index, (highest_result, hits) in enumerate(filter_results):
+            if index not in rows:
+                verdicts.append({'result': shed_result(highest_result, model_policy), 'model_result': None,
+                                 'certainty': 0.0, 'filters': hits})
+                continue
+            row = rows[index]
+            percent = float(probabilities[row, most_probable[row]] * 100)
+            model_result = ModerationResult.HIDE if most_probable[row] == 1 else ModerationResult.ACCEPT
+
+            verdicts.append({'result': final_result(highest_result, model_result, percent, self.certainty_needed),
+                             'model_result': model_result,
+                             'certainty': round(percent, 2), 'filters': hits})
+        return verdicts
 
     def feedback(self, interactive, highest_result, percent, model_result):
         if interactive:
@@ -263,10 +389,12 @@ class ModerationModel:
         return highest_result
 
 
-    @performance_tracker
+    @timed("telemetry")
+    @traced("telemetry")
     def _log_comment(self, label, action_type, comment):
-        if self.learns:
-            api_url = "https://updates.haspde.luova.club/comments"
+        if self.learns and self.defer_telemetry:
+            self._deferred_telemetry.append((label, action_type, comment))
+        elif self.learns:
             action_mapping = {
                 "ACCEPT": 0,
                 "HIDE": 1,
@@ -285,16 +413,32 @@ class ModerationModel:
                 }
                 
                 try:
-                    response = requests.post(api_url, json=payload)
+                    response = requests.post(self.telemetry_url, json=payload)
                     response.raise_for_status()
-                    logger.info(f"🌍 Comment '{comment}' logged with label {label} and action type {action_numeric}.")
+                    logger.debug("🌍 Comment '%.80s' logged with label %s and action type %s.", comment, label, action_numeric)
                 except requests.exceptions.RequestException as e:
-                    logger.error(f"🌩️ Failed to log comment '{comment}': {e}")
+                    logger.error("🌩️ Failed to log comment '%.80s': %s", comment, e)
             else:
-                logger.error(f"Invalid action type: {action_type}")
+                logger.error("Invalid action type: %s", action_type)
         else:
             logger.debug("Learning disabled by config. Not adding to training data.")
 
+    def send_deferred_telemetry(self):
+        """Sends the telemetry deferred under load, oldest first, until it is deferred again. Returns the number sent."""
+        sent = 0
+        while not self.defer_telemetry:
+            try:
+                label, action_type, comment = self._deferred_telemetry.popleft()
+            except IndexError:
+                break
+            self._log_comment(label, action_type, comment)
+            sent += 1
+        return sent
+
+    def deferred_telemetry(self):
+        """Returns the number of telemetry records waiting to be sent."""
+        return len(self._deferred_telemetry)
+
     def ask_for_human_review(self, comment):
         while True:
             try:
@@ -0,0 +1,185 @@
+import threading
+import time
+
+from pymongo import errors
+
+from log import logger
+
+
+class PageTokenStore:
+    """
+    In-memory map of Facebook page IDs to page access tokens.
+
+    All tokens are loaded from the users collection in one query and kept in a
+    dict, so resolving a token on the hot path costs no MongoDB round trip. The
+    map is reloaded in the background when it is older than `ttl`, or
+    synchronously when an unknown page is requested. When change streams are
+    available, a change to a user's `managed_pages` reloads only that user's
+    pages. Loads are started at most once per
+    `min_reload_interval` by lookups, also after a failed load, and one load
+    runs at a time: callers arriving during a load wait for it instead of
+    starting another.
+    """
+
+    PROJECTION = {'managed_pages.page_id': 1, 'managed_pages.page_access_token': 1}
+    # Change stream events that can change a user's pages: inserts with pages, replacements, deletes,
+    # and updates that set, remove or truncate a managed_pages field
+    WATCH_PIPELINE = [{'$match': {'$or': [
+        {'operationType': 'insert', 'fullDocument.managed_pages': {'$exists': True}},
+        {'operationType': {'$in': ['replace', 'delete']}},
+        {'updateDescription.removedFields': {'$regex': '^managed_pages(\\.|$)'}},
+        {'updateDescription.truncatedArrays.field': {'$regex': '^managed_pages(\\.|$)'}},
+        {'$expr': {'$gt': [{'$size': {'$filter': {
+            'input': {'$objectToArray': {'$ifNull': ['$updateDescription.updatedFields', {}]}},
+            'cond': {'$regexMatch': {'input': '$$this.k', 'regex': '^managed_pages(\\.|$)'}}
+        }}}, 0]}}
+    ]}}]
+
+    def __init__(self, collection, ttl=300, min_reload_interval=30, watch=True):
+        """
+        Initializes the store and loads all page tokens.
+
+        Args:
+            collection: The MongoDB users collection holding `managed_pages`.
+            ttl (float): Seconds after which the map is reloaded.
+            min_reload_interval (float): Minimum seconds between reloads caused by misses.
+            watch (bool): Whether to reload a user's pages on change stream events when available.
+        """
+        self.collection = collection
+        self.ttl = ttl
+        self.min_reload_interval = min_reload_interval
+        self._tokens = {}
+        self._user_pages = {}  # user _id -> IDs of the pages it manages, as last loaded
+        self._loaded_at = 0.0
+        self._started_at = 0.0  # When the last load started
+        self._attempted_at = 0.0  # When the last load, successful or not, ended
+        self._reloading = False
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+        try:
+            self.collection.create_index("managed_pages.page_id")
+        except Exception as e:
+            logger.warning("Could not create page token index: %s", e)
+
+        self.reload()
+
+        if watch:
+            threading.Thread(target=self._watch_changes, name="page-token-watch", daemon=True).start()
+
+    def get(self, page_id):
+        """
+        Returns the access token for a page, or None if the page is unknown.
+        """
+        token = self._tokens.get(page_id)
+        now = time.monotonic()
+        can_reload = now - self._attempted_at > self.min_reload_interval
+
+        if token is not None:
+            if now - self._loaded_at > self.ttl and can_reload:
+                self._reload_in_background()
+            return token
+
+        # Unknown page: it may have been connected after the last load
+        if can_reload:
+            self._reload_once()
+            token = self._tokens.get(page_id)
+        return token
+
+    def invalidate(self):
+        """Forces the next lookup to reload the tokens."""
+        self._loaded_at = self._attempted_at = 0.0
+
+    def reload(self):
+        """
+        Loads every page token from the database and swaps the map in one step.
+
+        Waits for a load that is running, and does not load again if another one started
+        after this call.
+        """
+        called_at = time.monotonic()
+        with self._reload_lock:
+            if self._started_at < called_at:
+                self._load()
+
+    def _reload_once(self):
+        """Loads the tokens, or only waits if a load is already running."""
+        if self._reload_lock.acquire(blocking=False):
+            try:
+                self._load()
+            finally:
+                self._reload_lock.release()
+        else:
+            with self._reload_lock:
+                pass
+
+    def _load(self):
+        """Loads the tokens. The caller must hold the reload lock."""
+        self._started_at = time.monotonic()
+        tokens = {}
+        user_pages = {}
+        try:
+            for user in self.collection.find({'managed_pages.page_id': {'$exists': True}}, self.PROJECTION):
+                pages = self._pages_of(user)
+                tokens.update(pages)
+                user_pages[user['_id']] = set(pages)
+        except Exception as e:
+            logger.error("Error loading page access tokens: %s", e)
+            self._attempted_at = time.monotonic()
+            return
+
+        with self._lock:
+            self._tokens = tokens
+            self._user_pages = user_pages
+            self._loaded_at = self._attempted_at = time.monotonic()
+        logger.info("Loaded access tokens for %d pages.", len(tokens))
+
+    def _load_user(self, user_id):
+        """Replaces the tokens of one user's pages. The caller must hold the reload lock."""
+        try:
+            user = self.collection.find_one({'_id': user_id}, self.PROJECTION)
+        except Exception as e:
+            logger.error("Error loading page access tokens of user %s: %s", user_id, e)
+            return
+
+        pages = self._pages_of(user) if user else {}
+        with self._lock:
+            # A page another user also manages is loaded again on its next miss
+            tokens = dict(self._tokens)
+            for page_id in self._user_pages.pop(user_id, ()):
+                tokens.pop(page_id, None)
+            tokens.update(pages)
+            if pages:
+                self._user_pages[user_id] = set(pages)
+            self._tokens = tokens
+
+    @staticmethod
+    def _pages_of(user):
+        """Returns {page ID: access token} of the pages of a user document that have both."""
+        return {page['page_id']: page['page_access_token'] for page in user.get('managed_pages', [])
+                if page.get('page_id') and page.get('page_access_token')}
+
+    def _reload_in_background(self):
+        with self._lock:
+            if self._reloading:
+                return
+            self._reloading = True
+
+        def run():
+            try:
+                self._reload_once()
+            finally:
+                self._reloading = False
+
+        threading.Thread(target=run, name="page-token-reload", daemon=True).start()
+
+    def _watch_changes(self):
+        """Reloads a user's pages whenever its managed_pages change."""
+        try:
+            with self.collection.watch(self.WATCH_PIPELINE) as stream:
+                for change in stream:
+                    with self._reload_lock:
+                        self._load_user(change['documentKey']['_id'])
+        except errors.PyMongoError as e:
+            # Change streams need a replica set; fall back to TTL-based refreshes
+            logger.info("Page token change stream unavailable, using TTL refresh only: %s", e)
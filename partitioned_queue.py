@@ -0,0 +1,170 @@
+"""
+Work queue partitioned by key, processed in order per partition by a pool of workers.
+
+The webhook hands each comment to the queue under its owner ID. Owners are
+hashed to a fixed number of partitions, and partitions are spread over the
+worker threads with a consistent hash ring, so an owner's comments are always
+handled by the same worker (keeping its caches warm) and changing the number
+of workers moves only about 1/N of the partitions.
+
+Items of one partition are handled one at a time in arrival order: a
+partition is taken by a single worker while one of its items runs. A worker
+cycles through its own non-empty partitions, so a hot owner with a backlog
+does not hold back the others, and a worker with nothing of its own to do
+takes the most lagging idle partition of another worker.
+
+    comments = PartitionedQueue(workers=8, partitions=64)
+    comments.put(owner_id, handle_comment, comment_data, owner_id)
+"""
+import bisect
+import hashlib
+import queue
+import threading
+import time
+from collections import deque
+
+from log import logger
+
+
+def stable_hash(value):
+    """A hash of `value` that is the same in every process, unlike hash() of a string."""
+    return int.from_bytes(hashlib.md5(str(value).encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring mapping keys to nodes through `virtual_nodes` points per node."""
+
+    def __init__(self, nodes, virtual_nodes=64):
+        self._points = sorted((stable_hash(f"{node}#{index}"), node)
+                              for node in nodes for index in range(virtual_nodes))
+        self._hashes = [point for point, _ in self._points]
+
+    def node_for(self, key):
+        """Returns the node owning the first point at or after the key's hash, wrapping around."""
+        index = bisect.bisect(self._hashes, stable_hash(key)) % len(self._points)
+        return self._points[index][1]
+
+
+class _Partition:
+    __slots__ = ("index", "owner", "items", "busy")
+
+    def __init__(self, index, owner):
+        self.index = index
+        self.owner = owner
+        self.items = deque()  # (monotonic time queued, func, args)
+        self.busy = False
+
+
+class PartitionedQueue:
+    """Runs queued calls on worker threads, in order per key."""
+
+    def __init__(self, workers=4, partitions=64, virtual_nodes=64, max_items=10000, name="comments"):
+        """
+        Starts the worker threads.
+
+        Args:
+            workers (int): Number of worker threads.
+            partitions (int): Number of partitions the keys are hashed to.
+            virtual_nodes (int): Points per worker on the hash ring.
+            max_items (int): Items that can be queued before put() raises queue.Full.
+            name (str): Prefix of the worker thread names.
+        """
+        self.max_items = max_items
+        self.stolen = 0
+        ring = HashRing(range(workers), virtual_nodes)
+        self._partitions = [_Partition(index, ring.node_for(f"partition-{index}")) for index in range(partitions)]
+        self._owned = [[p for p in self._partitions if p.owner == worker] for worker in range(workers)]
+        self._cursors = [0] * workers
+        self._size = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = [threading.Thread(target=self._run, args=(worker,), name=f"{name}-{worker}", daemon=True)
+                         for worker in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def partition_of(self, key):
+        """Returns the partition index of a key."""
+        return stable_hash(key) % len(self._partitions)
+
+    def put(self, key, func, *args):
+        """
+        Queues `func(*args)` behind the earlier items of the key's partition.
+
+        Raises:
+            queue.Full: If `max_items` items are queued.
+        """
+        partition = self._partitions[self.partition_of(key)]
+        with self._cond:
+            if self._size >= self.max_items:
+                raise queue.Full(f"{self._size} items queued")
+            partition.items.append((time.monotonic(), func, args))
+            self._size += 1
+            self._cond.notify()
+
+    def _take(self, worker):
+        """Returns the next partition for `worker` to run an item of, or None. Called with the lock held."""
+        owned = self._owned[worker]
+        for offset in range(len(owned)):
+            partition = owned[(self._cursors[worker] + offset) % len(owned)]
+            if partition.items and not partition.busy:
+                self._cursors[worker] = (self._cursors[worker] + offset + 1) % len(owned)
+                return partition
+
+        # Nothing of its own to do: help the partition that has waited longest
+        idle = [p for p in self._partitions if p.items and not p.busy]
+        if idle:
+            self.stolen += 1
+            return min(idle, key=lambda p: p.items[0][0])
+        return None
+
+    def _run(self, worker):
+        while True:
+            with self._cond:
+                partition = self._take(worker)
+                while partition is None:
+                    if self._stopped:
+                        return
+                    self._cond.wait()
+                    partition = self._take(worker)
+                partition.busy = True
+                _, func, args = partition.items.popleft()
+                self._size -= 1
+
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error("Error handling an item of partition %d: %s", partition.index, e)
+            finally:
+                with self._cond:
+                    partition.busy = False
+                    if partition.items:
+                        self._cond.notify()
+
+    def size(self):
+        """Returns the number of queued items."""
+        return self._size
+
+    def lag(self, index):
+        """Returns how long the oldest queued item of a partition has waited, in seconds."""
+        items = self._partitions[index].items
+        try:
+            return time.monotonic() - items[0][0]
+        except IndexError:
+            return 0.0
+
+    def depth(self, index):
+        """Returns the number of queued items of a partition."""
+        return len(self._partitions[index].items)
+
+    def max_lag(self):
+        """Returns the lag of the most lagging partition, in seconds."""
+        return max(self.lag(index) for index in range(len(self._partitions)))
+
+    def stop(self):
+        """Stops the workers once the queued items are handled."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,276 @@
+"""
+On-demand CPU and memory profiling of the running service.
+
+Nothing here runs until an admin asks for it: the CPU profiler starts a
+sampling thread only for the length of one profile, tracemalloc is started
+and stopped explicitly, and object counts are taken only when requested.
+
+The routes are registered by `ProfilingAdmin(app, token, watched)` and need
+the admin token in an ``Authorization: Bearer <token>`` header. Without a
+configured token they are not registered at all.
+
+    POST /admin/profile/cpu?seconds=10&interval=0.005   collapsed stacks for flamegraph.pl / speedscope
+    POST /admin/profile/memory/start?frames=25          start tracemalloc
+    POST /admin/profile/memory/snapshot                 take a snapshot, returns its ID and top allocations
+    GET  /admin/profile/memory/diff?from=0&to=1         compare two snapshots (default: the first and latest)
+    POST /admin/profile/memory/stop                     stop tracemalloc and drop the snapshots
+    GET  /admin/profile/objects?reset=1                 live objects per type, growth since the last reset
+"""
+import gc
+import hmac
+import itertools
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from flask import Response, jsonify, request
+
+from log import logger
+
+
+class SamplingProfiler:
+    """
+    Statistical CPU profiler sampling the stacks of all threads.
+
+    Every `interval` seconds the current frame of each thread is read with
+    `sys._current_frames()` and its stack is counted. The result is in the
+    collapsed-stack format (``thread;outer;...;inner count``) that
+    flamegraph.pl, speedscope and similar tools read.
+    """
+
+    MAX_SECONDS = 60
+    MIN_INTERVAL = 0.001
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+    def profile(self, seconds=10, interval=0.005):
+        """
+        Samples all threads for `seconds` and returns the collapsed stacks.
+
+        Raises:
+            RuntimeError: If another profile is already running.
+        """
+        seconds = min(max(seconds, 0.1), self.MAX_SECONDS)
+        interval = max(interval, self.MIN_INTERVAL)
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A CPU profile is already running.")
+
+        try:
+            stacks = Counter()
+            me = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            samples = 0
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._frame_name(frame))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    stacks[";".join(reversed(stack))] += 1
+                samples += 1
+                time.sleep(interval)
+        finally:
+            self._lock.release()
+
+        logger.info("CPU profile finished: %d samples over %.1fs, %d distinct stacks.", samples, seconds, len(stacks))
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class MemoryProfiler:
+    """Starts tracemalloc on request and compares the snapshots taken while it runs."""
+
+    MAX_SNAPSHOTS = 10
+
+    def __init__(self):
+        self.snapshots = {}  # ID -> snapshot, oldest first
+        self._ids = itertools.count()  # IDs are never reused, so a dropped snapshot's ID stays unknown
+        self._lock = threading.Lock()
+
+    def start(self, frames=25):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        return {'tracing': True, 'frames': tracemalloc.get_traceback_limit()}
+
+    def stop(self):
+        with self._lock:
+            self.snapshots = {}
+        tracemalloc.stop()
+        return {'tracing': False}
+
+    def snapshot(self, limit=20):
+        """Takes a snapshot. Returns its ID, the traced memory and the top allocating lines."""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc is not running, start it first.")
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        with self._lock:
+            number = next(self._ids)
+            self.snapshots[number] = snapshot
+            # Keep the first snapshot as a baseline and the most recent ones
+            if len(self.snapshots) > self.MAX_SNAPSHOTS:
+                del self.snapshots[list(self.snapshots)[1]]
+
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'snapshot': number,
+            'traced_bytes': current,
+            'peak_bytes': peak,
+            'top': [self._stat(stat) for stat in snapshot.statistics('lineno')[:limit]],
+        }
+
+    def diff(self, first=None, second=None, limit=30, key_type='lineno'):
+        """
+        Returns the allocations that grew most between two snapshots, by default the first and the latest.
+
+        Raises:
+            KeyError: If a snapshot with that ID was never taken or has been dropped.
+        """
+        with self._lock:
+            ids = list(self.snapshots)
+            if not ids:
+                raise KeyError("No snapshots")
+            older = self.snapshots[ids[0] if first is None else first]
+            newer = self.snapshots[ids[-1] if second is None else second]
+        return [self._stat(stat) for stat in newer.compare_to(older, key_type)[:limit]]
+
+    @staticmethod
+    def _stat(stat):
+        frame = stat.traceback[0]
+        result = {'where': f"{frame.filename}:{frame.lineno}", 'size_bytes': stat.size, 'count': stat.count}
+        if hasattr(stat, 'size_diff'):
+            result['size_diff_bytes'] = stat.size_diff
+            result['count_diff'] = stat.count_diff
+        return result
+
+
+class ObjectCensus:
+    """Counts live objects per type and the size of watched containers, and reports growth."""
+
+    def __init__(self, watched=None):
+        """
+        Args:
+            watched (dict, optional): Name -> callable returning the current size of something
+                worth watching, e.g. ``{'processed_comments': lambda: len(processed_comments)}``.
+        """
+        self.watched = watched or {}
+        self._baseline = None
+        self._lock = threading.Lock()
+
+    def count(self):
+        counts = Counter(type(obj).__qualname__ for obj in gc.get_objects())
+        sizes = {}
+        for name, size in self.watched.items():
+            try:
+                sizes[name] = size()
+            except Exception as e:
+                sizes[name] = f"error: {e}"
+        return counts, sizes
+
+    def report(self, limit=30, reset=False):
+        """Returns the most common types and the growth since the baseline, which is set on first use or `reset`."""
+        counts, sizes = self.count()
+        with self._lock:
+            baseline = self._baseline
+            if baseline is None or reset:
+                self._baseline = (counts, sizes)
+
+        report = {
+            'objects': sum(counts.values()),
+            'top_types': dict(counts.most_common(limit)),
+            'watched': sizes,
+        }
+        if baseline is not None:
+            base_counts, base_sizes = baseline
+            growth = Counter(counts)
+            growth.subtract(base_counts)
+            report['type_growth'] = {name: n for name, n in growth.most_common(limit) if n > 0}
+            report['watched_growth'] = {
+                name: size - base_sizes[name] for name, size in sizes.items()
+                if isinstance(size, int) and isinstance(base_sizes.get(name), int)
+            }
+        return report
+
+
+class ProfilingAdmin:
+    """Registers the token-protected profiling routes on a Flask app."""
+
+    def __init__(self, app, token, watched=None):
+        """
+        Args:
+            app (Flask): The application.
+            token (str): Admin token; the routes are not registered when empty.
+            watched (dict, optional): Watched container sizes, see ObjectCensus.
+        """
+        self.token = token
+        self.cpu = SamplingProfiler()
+        self.memory = MemoryProfiler()
+        self.objects = ObjectCensus(watched)
+
+        if not token:
+            return
+
+        routes = [
+            ('/admin/profile/cpu', self.cpu_profile, ['POST']),
+            ('/admin/profile/memory/start', self.memory_start, ['POST']),
+            ('/admin/profile/memory/snapshot', self.memory_snapshot, ['POST']),
+            ('/admin/profile/memory/diff', self.memory_diff, ['GET']),
+            ('/admin/profile/memory/stop', self.memory_stop, ['POST']),
+            ('/admin/profile/objects', self.object_report, ['GET']),
+        ]
+        for rule, view, methods in routes:
+            app.add_url_rule(rule, f"admin_{view.__name__}", self._authenticated(view), methods=methods)
+
+    def _authenticated(self, view):
+        def wrapper(*args, **kwargs):
+            supplied = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(supplied.encode(), f"Bearer {self.token}".encode()):
+                return jsonify({'error': 'Unauthorized'}), 401
+            try:
+                return view(*args, **kwargs)
+            except RuntimeError as e:
+                return jsonify({'error': str(e)}), 409
+        return wrapper
+
+    def cpu_profile(self):
+        seconds = request.args.get('seconds', 10, type=float)
+        interval = request.args.get('interval', 0.005, type=float)
+        return Response(self.cpu.profile(seconds, interval), mimetype='text/plain')
+
+    def memory_start(self):
+        return jsonify(self.memory.start(request.args.get('frames', 25, type=int)))
+
+    def memory_snapshot(self):
+        return jsonify(self.memory.snapshot(request.args.get('limit', 20, type=int)))
+
+    def memory_diff(self):
+        group = request.args.get('group', 'lineno')
+        if group not in ('lineno', 'filename', 'traceback'):
+            return jsonify({'error': 'group must be lineno, filename or traceback'}), 400
+        try:
+            diff = self.memory.diff(request.args.get('from', type=int), request.args.get('to', type=int),
+                                    request.args.get('limit', 30, type=int), group)
+        except KeyError:
+            return jsonify({'error': 'No such snapshot'}), 404
+        return jsonify({'diff': diff})
+
+    def memory_stop(self):
+        return jsonify(self.memory.stop())
+
+    def object_report(self):
+        reset = request.args.get('reset', '0') in ('1', 'true')
+        return jsonify(self.objects.report(request.args.get('limit', 30, type=int), reset))
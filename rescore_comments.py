@@ -0,0 +1,293 @@
+"""
+Re-moderates stored comments after a new model or word list version.
+
+Comments are read in `_id` order in projected batches, scored on a process
+pool through ModerationModel.moderate_batch, and every comment whose verdict
+differs from its previous one gets the new verdict in a `rescore` field,
+written with one bulk_write per batch. A checkpoint file records the last
+`_id` written, so an interrupted run continues where it stopped when run
+again with the same `--version`. Memory use is bounded by the batch size and
+the number of batches in flight, not by the size of the collection.
+
+With `--apply`, comments the service moderated by itself (PENDING, HIDDEN)
+whose verdict now calls for another action have that action queued for the
+running service: it is recorded like a failed action due now, and the
+service's retry sweeper sends it on its next run. Comments decided by a
+reviewer are rescored but never actioned.
+
+Usage:
+    python rescore_comments.py --version model-2024-06 --processes 8
+    python rescore_comments.py --version model-2024-06 --apply --unhide
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, UpdateOne
+
+from log import logger
+from results import ModerationResult
+from retry_sweeper import RetrySweeper
+
+PROJECTION = {'_id': 1, 'id': 1, 'text': 1, 'status': 1, 'platform': 1, 'owner_id': 1,
+              'retry_status': 1, 'rescore.result': 1}
+
+# The verdict a comment's status stands for, for comments not rescored before
+STATUS_RESULTS = {
+    'PENDING': ModerationResult.ACCEPT,
+    'APPROVED': ModerationResult.ACCEPT,
+    'HIDDEN': ModerationResult.HIDE,
+    'PENDING_REVIEW': ModerationResult.HUMAN_REVIEW,
+    'IN_REVIEW': ModerationResult.HUMAN_REVIEW,
+    'REMOVED': ModerationResult.REMOVE,
+}
+
+# Statuses set by the service on its own; others are reviewer decisions or failures
+ACTIONABLE = ('PENDING', 'HIDDEN')
+
+
+def previous_result(comment):
+    rescore = comment.get('rescore') or {}
+    if 'result' in rescore:
+        return rescore['result']
+    return STATUS_RESULTS.get(comment.get('status'))
+
+
+def decide_action(comment, result, mode="full", unhide=False):
+    """
+    Returns the (action, log, new status) a verdict calls for on a comment, or None.
+
+    Mirrors handle_comment: HIDE hides, HUMAN_REVIEW queues for review hidden, and
+    REMOVE and BAN remove in "full" mode and go to review otherwise.
+    """
+    status = comment.get('status')
+    if status not in ACTIONABLE or comment.get('retry_status'):
+        return None
+
+    review = ('hide', False, 'PENDING_REVIEW')
+    if result in (ModerationResult.REMOVE, ModerationResult.BAN):
+        return ('remove', True, None) if mode == "full" else review
+    if status == 'HIDDEN':
+        if unhide and result == ModerationResult.ACCEPT:
+            return 'unhide', True, None
+        return None
+    if result == ModerationResult.HIDE:
+        return 'hide', True, None
+    if result == ModerationResult.HUMAN_REVIEW:
+        return review
+    return None
+
+
+class CommentRescorer:
+    """Streams the comments collection through the moderation model and writes back changed verdicts."""
+
+    def __init__(self, collection, pool, version, owner_configs=None, counters=None, batch_size=500,
+                 statuses=None, mode="full", apply=False, unhide=False, checkpoint=None, rate=0,
+                 progress_interval=10):
+        """
+        Args:
+            collection: The comments collection.
+            pool (ScoringPool): Pool scoring the batches.
+            version (str): Name of the model/word list version, stored with every verdict.
+            owner_configs: Collection of owner configurations, for owners' custom filters.
+            counters (ModerationCounters, optional): Kept in step with status changes.
+            batch_size (int): Comments read, scored and written per batch.
+            statuses (list, optional): Only rescore comments with these statuses.
+            mode (str): The service's "mode"; decides whether REMOVE and BAN remove or go to review.
+            apply (bool): Queue the Graph actions that changed.
+            unhide (bool): With `apply`, also unhide hidden comments that are now accepted.
+            checkpoint (str, optional): File the progress is saved to and resumed from.
+            rate (float): Maximum comments per second, 0 for no limit.
+            progress_interval (float): Seconds between progress reports.
+        """
+        self.collection = collection
+        self.pool = pool
+        self.version = version
+        self.owner_configs = owner_configs
+        self.counters = counters
+        self.batch_size = batch_size
+        self.statuses = statuses
+        self.mode = mode
+        self.apply = apply
+        self.unhide = unhide
+        self.checkpoint = checkpoint
+        self.rate = rate
+        self.progress_interval = progress_interval
+        self.state = {'version': version, 'last_id': None, 'scored': 0, 'changed': 0, 'queued': 0}
+        self._configs = {}
+
+    def load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        if state.get('version') != self.version:
+            logger.warning("Checkpoint %s is for version %s, starting over for %s.",
+                           self.checkpoint, state.get('version'), self.version)
+            return
+        self.state = state
+        logger.info("Resuming after %s, %d comments already rescored.", state['last_id'], state['scored'])
+
+    def save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        temporary = self.checkpoint + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.state, f)
+        os.replace(temporary, self.checkpoint)
+
+    def query(self, after=None):
+        query = {}
+        if self.statuses:
+            query['status'] = {'$in': self.statuses}
+        if after is not None:
+            query['_id'] = {'$gt': after}
+        return query
+
+    def owner_config(self, owner_ids):
+        """Returns the custom filter configuration of each owner, loading unknown owners in one query."""
+        missing = [owner_id for owner_id in set(owner_ids) if owner_id not in self._configs]
+        if missing and self.owner_configs is not None:
+            for doc in self.owner_configs.find({'owner_id': {'$in': missing}}, {'owner_id': 1, 'filters': 1}):
+                self._configs[doc['owner_id']] = {'filters': doc.get('filters', [])} if doc.get('filters') else None
+        for owner_id in missing:
+            self._configs.setdefault(owner_id, None)
+        return [self._configs[owner_id] for owner_id in owner_ids]
+
+    def batches(self):
+        """Yields (texts, owner configs, comments) in `_id` order, from the checkpoint on."""
+        last_id = ObjectId(self.state['last_id']) if self.state['last_id'] else None
+        while True:
+            comments = list(self.collection.find(self.query(last_id), PROJECTION)
+                            .sort('_id', ASCENDING).limit(self.batch_size))
+            if not comments:
+                return
+            last_id = comments[-1]['_id']
+            configs = self.owner_config([comment.get('owner_id') for comment in comments])
+            yield [comment.get('text') or "" for comment in comments], configs, comments
+
+    def write(self, comments, verdicts):
+        """Writes the changed verdicts of one batch and queues their actions. Returns (changed, queued)."""
+        now = datetime.utcnow()
+        operations = []
+        reviews = []
+        queued = 0
+        for comment, verdict in zip(comments, verdicts):
+            if verdict['result'] == previous_result(comment):
+                continue
+            to_set = {'rescore': dict(verdict, version=self.version, at=now)}
+
+            action = decide_action(comment, verdict['result'], self.mode, self.unhide) if self.apply else None
+            if action:
+                name, log, status = action
+                to_set.update(RetrySweeper.schedule(name, log, now))
+                queued += 1
+                if status:
+                    to_set['hidden'] = '1'
+                    reviews.append((comment, to_set))
+                    continue
+
+            # Only if no reviewer or the service changed the comment since it was read
+            operations.append(UpdateOne({'_id': comment['_id'], 'status': comment.get('status')}, {'$set': to_set}))
+
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+        for comment, to_set in reviews:
+            match = {'_id': comment['_id'], 'status': comment.get('status')}
+            if self.counters is not None:
+                self.counters.transition(match, 'PENDING_REVIEW', {'$set': to_set})
+            else:
+                self.collection.update_one(match, {'$set': dict(to_set, status='PENDING_REVIEW')})
+        return len(operations) + len(reviews), queued
+
+    def run(self):
+        """
+        Rescores every matching comment after the checkpoint.
+
+        Returns:
+            dict: The final state: last `_id`, comments scored, verdicts changed and actions queued.
+        """
+        self.load_checkpoint()
+        after = ObjectId(self.state['last_id']) if self.state['last_id'] else None
+        query = self.query(after)
+        # Counting tens of millions of documents is slow, the estimate comes from metadata
+        remaining = self.collection.count_documents(query) if query else self.collection.estimated_document_count()
+        total = self.state['scored'] + remaining
+        logger.info("Rescoring %d comments as version %s.", total, self.version)
+
+        started = time.monotonic()
+        scored_at_start = self.state['scored']
+        reported = started
+        for (texts, configs, comments), verdicts in self.pool.imap(self.batches()):
+            changed, queued = self.write(comments, verdicts)
+            self.state['last_id'] = str(comments[-1]['_id'])
+            self.state['scored'] += len(comments)
+            self.state['changed'] += changed
+            self.state['queued'] += queued
+            self.save_checkpoint()
+
+            now = time.monotonic()
+            done = self.state['scored'] - scored_at_start
+            if now - reported >= self.progress_interval:
+                reported = now
+                rate = done / (now - started)
+                eta = (total - self.state['scored']) / rate if rate else 0
+                logger.info("Rescored %d/%d comments (%.1f%%), %.0f/s, ETA %dm%02ds, %d changed, %d actions queued.",
+                            self.state['scored'], total, 100 * self.state['scored'] / max(total, 1), rate,
+                            eta // 60, eta % 60, self.state['changed'], self.state['queued'])
+
+            # Throttle to `rate` comments per second to leave headroom for the live service
+            if self.rate:
+                ahead = done / self.rate - (now - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        return self.state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-moderate stored comments with the current model and word lists.")
+    parser.add_argument("--version", required=True, help="Name of the model/word list version, e.g. model-2024-06")
+    parser.add_argument("--processes", type=int, default=None, help="Scoring processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--status", action="append", help="Only rescore comments with this status (repeatable)")
+    parser.add_argument("--apply", action="store_true", help="Queue the Graph actions that changed")
+    parser.add_argument("--unhide", action="store_true", help="With --apply, unhide hidden comments now accepted")
+    parser.add_argument("--certainty", type=float, help="Model certainty needed (default: certainty_needed)")
+    parser.add_argument("--checkpoint", default="rescore.checkpoint", help="Progress file, resumed from when it exists")
+    parser.add_argument("--rate", type=float, default=0, help="Maximum comments per second, 0 for no limit")
+    args = parser.parse_args()
+
+    from config import Config
+    from database_manager import DatabaseManager
+    from moderation_counters import ModerationCounters
+    from moderation_model import ModerationModel
+    from scoring_pool import ScoringPool
+
+    config = Config()
+    client = DatabaseManager().get_instance()
+    db = client.get_db()
+    comments = db['comments']
+
+    certainty = args.certainty if args.certainty is not None else config.CERTAINTY_NEEDED
+    model = ModerationModel(learns=False, certainty_needed=certainty, updates_url=config.UPDATES_URL)
+    with ScoringPool(model, args.processes,
+                     model_options={'certainty_needed': certainty, 'updates_url': config.UPDATES_URL}) as pool:
+        rescorer = CommentRescorer(
+            comments, pool, args.version,
+            owner_configs=client.get_db("HaSpDeDash").owner_configs,
+            counters=ModerationCounters(db['moderation_counters'], comments),
+            batch_size=args.batch_size, statuses=args.status, mode=config.MODE,
+            apply=args.apply, unhide=args.unhide, checkpoint=args.checkpoint, rate=args.rate
+        )
+        state = rescorer.run()
+
+    print(f"Rescored {state['scored']} comments: {state['changed']} verdicts changed, "
+          f"{state['queued']} actions queued.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import functools
+import random
+import threading
+import time
+from concurrent.futures import wait
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING
+
+from log import logger
+
+
+class RetrySweeper:
+    """
+    Retries moderation actions that failed on the Graph API.
+
+    A failed hide, unhide or delete is recorded on the comment document with
+    `retry_status`, `retry_action`, `attempts`, `failed_at` and `next_retry_at`.
+    `run_once` is run periodically on the scheduler. It picks the actions that
+    are due through an index, re-dispatches them in bounded concurrent batches
+    and leaves the comment to the action's own result handler. A run stops
+    sending and waiting after `run_timeout`; the actions it did not get to are
+    due again on the next run, and those still in flight are counted when they
+    finish. Actions that
+    keep failing get an exponentially growing delay and are moved to the
+    DEAD_LETTER status after `max_attempts`.
+    """
+
+    RETRYING = "RETRYING"
+    DEAD_LETTER = "DEAD_LETTER"
+    # Fields cleared with $unset once an action succeeds
+    RETRY_FIELDS = {'retry_status': "", 'retry_action': "", 'attempts': "", 'failed_at': "",
+                    'next_retry_at': "", 'last_error': ""}
+
+    def __init__(self, collection, retry_action, max_attempts=8, base_delay=30, max_delay=3600,
+                 batch_size=200, max_in_flight=50, action_timeout=30, run_timeout=45):
+        """
+        Initializes the sweeper.
+
+        Args:
+            collection: The comments collection.
+            retry_action (callable): Called with a comment document, re-dispatches its failed
+                action with `attempts` passed through and returns a Future resolving to
+                (ok, status_code, body).
+            max_attempts (int): Failed attempts after which an action is dead-lettered.
+            base_delay (float): Seconds before the first retry.
+            max_delay (float): Upper bound in seconds for the retry delay.
+            batch_size (int): Maximum number of actions retried in one run.
+            max_in_flight (int): Maximum number of retried actions awaiting a result at once.
+            action_timeout (float): Seconds to wait for the result of one chunk of retries.
+            run_timeout (float): Seconds after which a run stops sending and waiting, shorter than
+                the interval between runs.
+        """
+        self.collection = collection
+        self.retry_action = retry_action
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.action_timeout = action_timeout
+        self.run_timeout = run_timeout
+
+        self._lock = threading.Lock()
+        self._stats = {
+            'runs': 0,
+            'retried': 0,
+            'recovered': 0,
+            'failed_again': 0,
+            'dead_lettered': 0,
+            'backlog': 0,
+            'dead_letter_backlog': 0,
+            'recovery_latency_count': 0,
+            'recovery_latency_sum': 0.0,
+            'recovery_latency_max': 0.0,
+        }
+
+        try:
+            self.collection.create_index(
+                [('retry_status', ASCENDING), ('next_retry_at', ASCENDING)],
+                partialFilterExpression={'retry_status': {'$exists': True}}
+            )
+        except Exception as e:
+            logger.warning("Could not create retry index: %s", e)
+
+    def backoff(self, attempts):
+        """Returns the delay in seconds before retry number `attempts`, with jitter."""
+        return self.retry_delay(attempts, self.base_delay, self.max_delay)
+
+    @staticmethod
+    def retry_delay(attempts, base_delay, max_delay):
+        delay = min(max_delay, base_delay * (2 ** max(attempts - 1, 0)))
+        return delay * random.uniform(0.5, 1.0)
+
+    @classmethod
+    def failure_update(cls, action, error, attempts, log, max_attempts, base_delay, max_delay=3600, now=None):
+        """
+        Returns the update recording a failed action on its comment.
+
+        Also used by asgi_app.py, whose failed actions this sweeper retries.
+
+        Args:
+            attempts (int): Failed attempts, this one included.
+            max_attempts, base_delay, max_delay: As for the sweeper.
+        """
+        now = now or datetime.utcnow()
+        to_set = {
+            'retry_action': {'action': action, 'log': log},
+            'attempts': attempts,
+            'last_error': error,
+        }
+        if attempts >= max_attempts:
+            to_set['retry_status'] = cls.DEAD_LETTER
+            to_set['next_retry_at'] = None
+        else:
+            to_set['retry_status'] = cls.RETRYING
+            to_set['next_retry_at'] = now + timedelta(seconds=cls.retry_delay(attempts, base_delay, max_delay))
+        return {'$set': to_set, '$min': {'failed_at': now}}
+
+    def record_failure(self, comment_id, action, error=None, attempts=0, log=True):
+        """
+        Stores the retry state of a failed action on its comment.
+
+        Args:
+            comment_id (str): The comment the action was for.
+            action (str): "hide", "unhide" or "remove".
+            error (str, optional): Error returned by the Graph API.
+            attempts (int): Failed attempts before this one.
+            log (bool): The `log` flag the action was originally sent with.
+        """
+        attempts += 1
+        update = self.failure_update(action, error, attempts, log, self.max_attempts, self.base_delay, self.max_delay)
+        if update['$set']['retry_status'] == self.DEAD_LETTER:
+            with self._lock:
+                self._stats['dead_lettered'] += 1
+            logger.critical("Giving up on %s of comment %s after %d attempts.", action, comment_id, attempts)
+
+        try:
+            self.collection.update_many({'id': comment_id}, update)
+        except Exception as e:
+            logger.error("Error recording failed %s of comment %s: %s", action, comment_id, e)
+
+    @classmethod
+    def schedule(cls, action, log=True, now=None):
+        """
+        Returns the fields that queue an action on a comment for the next sweep.
+
+        Used to hand actions decided outside the service (e.g. by rescore_comments.py)
+        to the running service, which sends them on its next run_once.
+        """
+        now = now or datetime.utcnow()
+        return {
+            'retry_status': cls.RETRYING,
+            'retry_action': {'action': action, 'log': log},
+            'attempts': 0,
+            'next_retry_at': now,
+            'failed_at': now,
+        }
+
+    def adopt_legacy_failures(self):
+        """Schedules removals that failed before retry state was recorded."""
+        result = self.collection.update_many(
+            {'status': 'REMOVE_FAILED', 'retry_status': {'$exists': False}},
+            {'$set': self.schedule('remove')}
+        )
+        if result.modified_count:
+            logger.info("Scheduled %d earlier failed removals for retry.", result.modified_count)
+
+    def run_once(self):
+        """Retries the actions that are due, for at most `run_timeout` seconds."""
+        deadline = time.monotonic() + self.run_timeout
+        now = datetime.utcnow()
+        try:
+            due = list(self.collection.find(
+                {'retry_status': self.RETRYING, 'next_retry_at': {'$lte': now}},
+                {'id': 1, 'retry_action': 1, 'attempts': 1, 'failed_at': 1, 'next_retry_at': 1}
+            ).sort('next_retry_at', ASCENDING).limit(self.batch_size))
+        except Exception as e:
+            logger.error("Error finding failed actions to retry: %s", e)
+            return
+
+        retried = 0
+        for start in range(0, len(due), self.max_in_flight):
+            if time.monotonic() >= deadline:
+                # Not claimed, so the rest is due again on the next run
+                break
+            chunk = [doc for doc in due[start:start + self.max_in_flight] if self._claim(doc)]
+            futures = {}
+            for doc in chunk:
+                try:
+                    futures[self.retry_action(doc)] = doc
+                except Exception as e:
+                    # The action was claimed but never sent: count it, so it still backs off and dead-letters
+                    logger.error("Error retrying action for comment %s: %s", doc.get('id'), e)
+                    self._fail(doc, str(e))
+            retried += len(futures)
+
+            done, not_done = wait(futures, timeout=max(min(self.action_timeout, deadline - time.monotonic()), 0))
+            for future in done:
+                self._finished(futures[future], future)
+            for future in not_done:
+                # The action's result handler records the outcome when it comes, count it then
+                future.add_done_callback(functools.partial(self._finished, futures[future]))
+
+        self._update_backlog()
+        with self._lock:
+            self._stats['runs'] += 1
+            self._stats['retried'] += retried
+            backlog = self._stats['backlog']
+        if retried or backlog:
+            logger.info("Retried %d failed actions, %d still waiting for retry.", retried, backlog)
+
+    def stats(self):
+        """Returns the sweeper's counters, backlog sizes and recovery latency in seconds."""
+        with self._lock:
+            stats = dict(self._stats)
+        count = stats['recovery_latency_count']
+        stats['recovery_latency_avg'] = stats['recovery_latency_sum'] / count if count else 0.0
+        return stats
+
+    def _claim(self, doc):
+        """Pushes the retry time forward so no other sweeper picks up the same action."""
+        lease = datetime.utcnow() + timedelta(seconds=self.run_timeout + self.action_timeout)
+        result = self.collection.update_one(
+            {'_id': doc['_id'], 'retry_status': self.RETRYING, 'next_retry_at': doc['next_retry_at']},
+            {'$set': {'next_retry_at': lease}}
+        )
+        return result.modified_count == 1
+
+    def _finished(self, doc, future):
+        """Counts a retried action once its Future is done; one that raised never reached its result handler."""
+        try:
+            ok = future.result()[0]
+        except Exception as e:
+            self._fail(doc, str(e))
+            return
+        self._count_result(doc, ok)
+
+    def _fail(self, doc, error):
+        """Records a retry that failed without a Graph API result as a failed attempt."""
+        retry_action = doc.get('retry_action') or {}
+        self.record_failure(doc['id'], retry_action.get('action'), error, doc.get('attempts', 0),
+                            retry_action.get('log', True))
+        self._count_result(doc, False)
+
+    def _count_result(self, doc, ok):
+        with self._lock:
+            if not ok:
+                self._stats['failed_again'] += 1
+                return
+            self._stats['recovered'] += 1
+            failed_at = doc.get('failed_at')
+            if failed_at:
+                latency = (datetime.utcnow() - failed_at).total_seconds()
+                self._stats['recovery_latency_count'] += 1
+                self._stats['recovery_latency_sum'] += latency
+                self._stats['recovery_latency_max'] = max(self._stats['recovery_latency_max'], latency)
+
+    def _update_backlog(self):
+        try:
+            backlog = self.collection.count_documents({'retry_status': self.RETRYING})
+            dead = self.collection.count_documents({'retry_status': self.DEAD_LETTER})
+        except Exception as e:
+            logger.error("Error counting failed actions: %s", e)
+            return
+        with self._lock:
+            self._stats['backlog'] = backlog
+            self._stats['dead_letter_backlog'] = dead
@@ -0,0 +1,199 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+from log import logger
+
+
+class ReviewQueue:
+    """
+    Queue of comments waiting for human review.
+
+    A reviewer claims the oldest PENDING_REVIEW comment with one atomic
+    `find_one_and_update`, which sets it IN_REVIEW with the reviewer's ID and
+    a lease expiry, so two reviewers never get the same comment. Comments whose
+    lease has expired are returned to the queue by `release_expired`, which
+    runs on the scheduler and whenever the queue looks empty.
+    """
+
+    PENDING = 'PENDING_REVIEW'
+    IN_REVIEW = 'IN_REVIEW'
+    LEASE_FIELDS = {'reviewer_id': "", 'lease_expires_at': ""}
+    PROJECTION = {'id': 1, 'text': 1, 'evaluation': 1}
+    # Status set by each review decision, "release" returns a claimed comment to the queue unreviewed
+    DECISIONS = {'approve': 'APPROVED', 'skip': 'SKIPPED', 'remove': 'PENDING_REMOVE', 'release': PENDING}
+    DECISION_PROJECTION = {'id': 1, 'text': 1, 'status': 1, 'platform': 1, 'owner_id': 1, 'reviewer_id': 1}
+    NOT_CLAIMED = 'Comment is not claimed by this reviewer'
+
+    def __init__(self, collection, lease_seconds=300, count_ttl=5):
+        """
+        Initializes the queue and its indexes.
+
+        Args:
+            collection: The comments collection.
+            lease_seconds (float): How long a claimed comment stays with its reviewer.
+            count_ttl (float): Seconds a pending count is reused before it is counted again.
+        """
+        self.collection = collection
+        self.lease_seconds = lease_seconds
+        self.count_ttl = count_ttl
+        self._count = 0
+        self._counted_at = 0.0
+        self._lock = threading.Lock()
+
+        try:
+            self.collection.create_index([('status', ASCENDING), ('_id', ASCENDING)])
+            self.collection.create_index(
+                [('status', ASCENDING), ('lease_expires_at', ASCENDING)],
+                partialFilterExpression={'status': self.IN_REVIEW}
+            )
+        except Exception as e:
+            logger.warning("Could not create review queue indexes: %s", e)
+
+    @classmethod
+    def claim_update(cls, reviewer_id, lease_seconds, now=None):
+        """Returns the update that moves a comment into review under a lease."""
+        now = now or datetime.utcnow()
+        return {'$set': {
+            'status': cls.IN_REVIEW,
+            'reviewer_id': reviewer_id,
+            'lease_expires_at': now + timedelta(seconds=lease_seconds),
+        }}
+
+    @classmethod
+    def expired_filter(cls, now=None):
+        """Returns the filter matching comments whose review lease has expired."""
+        return {'status': cls.IN_REVIEW, 'lease_expires_at': {'$lt': now or datetime.utcnow()}}
+
+    @classmethod
+    def release_update(cls):
+        """Returns the update that puts a comment back in the queue."""
+        return {'$set': {'status': cls.PENDING}, '$unset': cls.LEASE_FIELDS}
+
+    @classmethod
+    def decision_ids(cls, decisions):
+        """Returns the comment IDs of the well-formed decisions in a batch."""
+        return [decision['comment_id'] for decision in decisions if cls._is_valid(decision)]
+
+    @classmethod
+    def plan_decisions(cls, decisions, comments, reviewer_id, now):
+        """
+        Checks a batch of review decisions against the comments they are about.
+
+        Only comments the reviewer still holds can be decided, so a stale
+        decision never undoes a newer one; the returned updates check this
+        again when they are written.
+
+        Args:
+            decisions (list): {"comment_id", "decision"} dicts as posted by the reviewer.
+            comments (dict): The comments by ID, read with DECISION_PROJECTION.
+            reviewer_id (str): The reviewer posting the decisions.
+            now (datetime): Stored as `reviewed_at` by every update.
+
+        Returns:
+            tuple: The UpdateOne operations to write and one result dict per decision.
+        """
+        operations = []
+        results = []
+        for decision in decisions:
+            if not cls._is_valid(decision):
+                results.append({'comment_id': decision.get('comment_id') if isinstance(decision, dict) else None,
+                                'ok': False, 'message': 'Invalid decision'})
+                continue
+            comment_id = decision['comment_id']
+            comment = comments.get(comment_id)
+            if comment is None:
+                results.append({'comment_id': comment_id, 'ok': False, 'message': 'Comment not found'})
+                continue
+            if comment.get('status') != cls.IN_REVIEW or comment.get('reviewer_id') != reviewer_id:
+                results.append({'comment_id': comment_id, 'ok': False, 'message': cls.NOT_CLAIMED})
+                continue
+            operations.append(UpdateOne(
+                {'id': comment_id, 'status': cls.IN_REVIEW, 'reviewer_id': reviewer_id},
+                {'$set': {'status': cls.DECISIONS[decision['decision']], 'reviewed_at': now},
+                 '$unset': cls.LEASE_FIELDS}
+            ))
+            results.append({'comment_id': comment_id, 'ok': True, 'decision': decision['decision']})
+        return operations, results
+
+    @classmethod
+    def keep_written(cls, results, written_ids):
+        """Marks the decisions whose update matched nothing, because the lease expired or was taken over."""
+        for result in results:
+            if result['ok'] and result['comment_id'] not in written_ids:
+                result.update(ok=False, message=cls.NOT_CLAIMED)
+
+    @classmethod
+    def _is_valid(cls, decision):
+        return isinstance(decision, dict) and decision.get('comment_id') and decision.get('decision') in cls.DECISIONS
+
+    def claim(self, reviewer_id):
+        """
+        Claims the oldest comment waiting for review.
+
+        Args:
+            reviewer_id (str): Identifies the reviewer holding the lease.
+
+        Returns:
+            dict | None: The claimed comment (id, text, evaluation), or None if the queue is empty.
+        """
+        comment = self._claim_one(reviewer_id)
+        if comment is None and self.release_expired():
+            comment = self._claim_one(reviewer_id)
+        return comment
+
+    def claim_many(self, reviewer_id, count):
+        """
+        Claims up to `count` of the oldest comments waiting for review.
+
+        Each claim is atomic on its own, so concurrent reviewers never share a comment.
+
+        Returns:
+            list: The claimed comments, oldest first.
+        """
+        comments = []
+        while len(comments) < count:
+            comment = self.claim(reviewer_id)
+            if comment is None:
+                break
+            comments.append(comment)
+        return comments
+
+    def _claim_one(self, reviewer_id):
+        comment = self.collection.find_one_and_update(
+            {'status': self.PENDING},
+            self.claim_update(reviewer_id, self.lease_seconds),
+            sort=[('_id', ASCENDING)],
+            projection=self.PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+        if comment is not None:
+            with self._lock:
+                self._count = max(self._count - 1, 0)
+        return comment
+
+    def pending_count(self):
+        """Returns the number of comments waiting for review, counted at most every `count_ttl` seconds."""
+        now = time.monotonic()
+        if now - self._counted_at >= self.count_ttl:
+            count = self.collection.count_documents({'status': self.PENDING})
+            with self._lock:
+                self._count = count
+                self._counted_at = now
+        return self._count
+
+    def release_expired(self):
+        """Returns comments with expired leases to the queue. Returns the number released."""
+        try:
+            result = self.collection.update_many(self.expired_filter(), self.release_update())
+        except Exception as e:
+            logger.error("Error releasing expired review leases: %s", e)
+            return 0
+
+        if result.modified_count:
+            logger.info("Returned %d comments with expired review leases to the queue.", result.modified_count)
+            with self._lock:
+                self._counted_at = 0.0
+        return result.modified_count
@@ -0,0 +1,133 @@
+"""
+Scores comment files with the moderation model, without the service.
+
+Reads plain text (one comment per line) or JSON lines (the comment in a
+"text" or "message" field) from files or stdin as a stream, scores them in
+batches on a process pool that shares the loaded model, and writes one JSON
+verdict per comment, in input order:
+
+    {"line": 1, "id": "1784...", "result": "HIDE", "result_code": 1, "model_result": "HIDE",
+     "certainty": 93.2, "filters": {"swearing": "HUMAN_REVIEW"}}
+
+`filters` lists the filters that did not accept the comment. Telemetry is
+off, nothing is sent to the updates server. Used for audits and for
+pre-screening imported comment archives.
+
+Usage:
+    python score_comments.py comments.jsonl > verdicts.jsonl
+    zcat archive.jsonl.gz | python score_comments.py --processes 8 --output verdicts.jsonl
+"""
+import argparse
+import fileinput
+import json
+import sys
+import time
+from collections import Counter
+
+from results import ModerationResult
+
+TEXT_FIELDS = ("text", "message")
+
+
+def read_comments(lines, text_field=None):
+    """
+    Yields (line number, comment ID or None, text, error) for every non-empty input line.
+
+    Lines starting with "{" are JSON; any other line is the comment text itself.
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            continue
+        if not line.lstrip().startswith("{"):
+            yield number, None, line, None
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield number, None, None, f"Invalid JSON: {e}"
+            continue
+        fields = (text_field,) if text_field else TEXT_FIELDS
+        text = next((record[field] for field in fields if isinstance(record.get(field), str)), None)
+        comment_id = record.get('id') or record.get('comment_id')
+        if text is None:
+            yield number, comment_id, None, "No comment text"
+        else:
+            yield number, comment_id, text, None
+
+
+def batches(comments, batch_size):
+    """Groups the comments into (texts, configs, comments) batches. Unreadable lines stay in place, without text."""
+    batch = []
+    for comment in comments:
+        batch.append(comment)
+        if len(batch) >= batch_size:
+            yield [text for _, _, text, error in batch if error is None], None, batch
+            batch = []
+    if batch:
+        yield [text for _, _, text, error in batch if error is None], None, batch
+
+
+def verdict_record(number, comment_id, verdict):
+    record = {'line': number}
+    if comment_id is not None:
+        record['id'] = comment_id
+    record.update({
+        'result': ModerationResult.RESULT_MAPPING.get(verdict['result'], 'UNKNOWN'),
+        'result_code': verdict['result'],
+        'model_result': ModerationResult.RESULT_MAPPING.get(verdict['model_result'], 'UNKNOWN'),
+        'certainty': verdict['certainty'],
+        'filters': {name: ModerationResult.RESULT_MAPPING.get(result, 'UNKNOWN')
+                    for name, result in verdict['filters'].items()},
+    })
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score comments from JSON lines or plain text files, or stdin.")
+    parser.add_argument("files", nargs="*", help="Input files, stdin when none or '-'")
+    parser.add_argument("--output", help="Output file (default: stdout)")
+    parser.add_argument("--text-field", help="JSON field holding the comment (default: text, then message)")
+    parser.add_argument("--processes", type=int, default=None, help="Scoring processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--certainty", type=float, default=80, help="Model certainty needed, in percent")
+    parser.add_argument("--model", default="moderation_model.joblib")
+    parser.add_argument("--vectorizer", default="tfidf_vectorizer.joblib")
+    args = parser.parse_args()
+
+    from moderation_model import ModerationModel
+    from scoring_pool import ScoringPool
+
+    options = {'certainty_needed': args.certainty, 'model_file': args.model, 'vectorizer_file': args.vectorizer}
+    model = ModerationModel(learns=False, **options)
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    counts = Counter()
+    started = time.monotonic()
+    try:
+        with fileinput.input(args.files or ("-",), openhook=fileinput.hook_encoded("utf-8")) as lines, \
+                ScoringPool(model, args.processes, model_options=options) as pool:
+            for (texts, _, comments), verdicts in pool.imap(batches(read_comments(lines, args.text_field),
+                                                                     args.batch_size)):
+                verdicts = iter(verdicts)
+                for number, comment_id, text, error in comments:
+                    if error is not None:
+                        record = {'line': number, 'error': error}
+                        counts['ERROR'] += 1
+                    else:
+                        record = verdict_record(number, comment_id, next(verdicts))
+                        counts[record['result']] += 1
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    elapsed = time.monotonic() - started
+    total = sum(counts.values())
+    print(f"Scored {total} comments in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f}/s): "
+          + ", ".join(f"{name} {count}" for name, count in counts.most_common()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Process pool scoring batches of comments with ModerationModel.moderate_batch.
+
+The model is loaded once in the parent. Where the platform supports the
+"fork" start method the workers inherit it, loaded, so starting the pool
+costs no model load per worker; elsewhere each worker loads its own.
+At most `window` batches are in flight at a time, so a producer streaming
+millions of comments never holds more than that in memory.
+
+    with ScoringPool(model, processes=8) as pool:
+        for batch, verdicts in pool.imap(batches):
+            ...
+"""
+import multiprocessing
+import os
+from collections import deque
+
+import log
+
+_model = None
+
+
+def _load_model(options):
+    global _model
+    from moderation_model import ModerationModel
+    _model = ModerationModel(learns=False, **options)
+
+
+def _score(comments, configs):
+    return _model.moderate_batch(comments, configs)
+
+
+class ScoringPool:
+    """Scores batches across worker processes, returning results in submission order."""
+
+    def __init__(self, model, processes=None, window=None, model_options=None):
+        """
+        Args:
+            model (ModerationModel): The loaded model, inherited by the workers.
+            processes (int, optional): Worker processes, the number of CPUs by default. 0 scores
+                in this process.
+            window (int, optional): Maximum batches in flight, twice the number of workers by default.
+            model_options (dict, optional): ModerationModel arguments for workers that load their own
+                model, when "fork" is unavailable.
+        """
+        global _model
+        _model = model
+        self.processes = os.cpu_count() if processes is None else processes
+        self.window = window or max(1, self.processes) * 2
+        self._pool = None
+
+        if self.processes:
+            if "fork" in multiprocessing.get_all_start_methods():
+                # Forked workers have no log listener thread, they write their records themselves
+                self._pool = multiprocessing.get_context("fork").Pool(self.processes, initializer=log.log_directly)
+            else:
+                self._pool = multiprocessing.Pool(self.processes, initializer=_load_model,
+                                                  initargs=(model_options or {},))
+
+    def imap(self, batches):
+        """
+        Scores an iterable of (comments, configs) or (comments, configs, item) batches.
+
+        Yields:
+            tuple: (batch, verdicts) for every batch, in the order the batches were given.
+        """
+        if self._pool is None:
+            for batch in batches:
+                yield batch, _score(batch[0], batch[1])
+            return
+
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, self._pool.apply_async(_score, batch[:2])))
+            if len(pending) >= self.window:
+                done, result = pending.popleft()
+                yield done, result.get()
+        while pending:
+            done, result = pending.popleft()
+            yield done, result.get()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        else:
+            self.close()
@@ -0,0 +1,90 @@
+import threading
+import unittest
+
+from fake_graph_server import FakeGraphServer
+from graph_client import GraphClient
+from media_owner_cache import MediaOwnerCache
+
+
+class MemoryCollection:
+    """The part of a MongoDB collection MediaOwnerCache uses, kept in a dict."""
+
+    def __init__(self, owners=None):
+        self.owners = dict(owners or {})
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def find(self, query, projection=None):
+        return [{'media_id': media_id, 'owner_id': self.owners[media_id]}
+                for media_id in query['media_id']['$in'] if media_id in self.owners]
+
+    def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            self.owners[operation._filter['media_id']] = operation._doc['$set']['owner_id']
+
+
+class MediaOwnerCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = FakeGraphServer(missing={"bad"}).start()
+        self.addCleanup(self.graph.stop)
+        self.collection = MemoryCollection()
+        self.cache = self.new_cache()
+
+    def new_cache(self, batch_window=0.005):
+        client = GraphClient("v20.0", base_url=self.graph.url, app_rate=1000, page_rate=1000)
+        return MediaOwnerCache(self.collection, client, "token", batch_window=batch_window)
+
+    def test_batches_lookups_with_ids(self):
+        media_ids = [f"m{n}" for n in range(120)]
+
+        owners = self.cache.get_many(media_ids)
+
+        self.assertEqual(owners, {media_id: self.graph.owner_of(media_id) for media_id in media_ids})
+        self.assertEqual([len(lookup) for lookup in self.graph.lookups], [50, 50, 20])
+
+    def test_concurrent_lookups_share_requests(self):
+        cache = self.new_cache(batch_window=0.2)
+        results = {}
+        start = threading.Barrier(20)
+
+        def lookup(media_id):
+            start.wait()
+            results[media_id] = cache.get(media_id)
+
+        threads = [threading.Thread(target=lookup, args=(f"m{n % 10}",)) for n in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {f"m{n}": self.graph.owner_of(f"m{n}") for n in range(10)})
+        self.assertEqual(len(self.graph.lookups), 1)
+        self.assertCountEqual(self.graph.lookups[0], results)
+
+    def test_known_owners_come_from_mongo(self):
+        self.collection.owners["m1"] = "owner-1"
+
+        self.assertEqual(self.cache.get_many(["m1", "m2"]), {"m1": "owner-1", "m2": self.graph.owner_of("m2")})
+        self.assertEqual(self.graph.lookups, [["m2"]])
+
+    def test_resolved_owners_are_stored_in_mongo(self):
+        self.cache.get("m1")
+
+        self.assertEqual(self.collection.owners, {"m1": self.graph.owner_of("m1")})
+        self.assertEqual(self.new_cache().get("m1"), self.graph.owner_of("m1"))
+        self.assertEqual(len(self.graph.lookups), 1)
+
+    def test_invalid_id_does_not_fail_its_batch(self):
+        media_ids = [f"m{n}" for n in range(49)] + ["bad"]
+
+        owners = self.cache.get_many(media_ids)
+
+        self.assertIsNone(owners["bad"])
+        self.assertEqual({media_id: owner for media_id, owner in owners.items() if media_id != "bad"},
+                         {f"m{n}": self.graph.owner_of(f"m{n}") for n in range(49)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,274 @@
+"""
+Span-based tracing of a webhook request through moderation and the Graph API.
+
+A trace starts at the webhook and is head-sampled there: unsampled requests
+get a shared no-op span, and every nested `tracer.span(...)` then costs one
+context variable lookup. The current span lives in a `contextvars` variable,
+so work handed to another thread keeps its trace when it is wrapped with
+`tracer.wrap`. Finished spans are queued and written by a background thread
+as JSON lines in the OTLP span format, and optionally posted to an
+OTLP/HTTP collector.
+
+    with tracer.start_trace("webhook", traceparent=request.headers.get('traceparent')):
+        with tracer.span("moderate", comment_id=comment_id):
+            ...
+"""
+import contextvars
+import functools
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+from log import logger
+
+_current_span = contextvars.ContextVar("haspde_span", default=None)
+
+
+class Span:
+    """One timed operation of a sampled trace. Entering it makes it the current span."""
+
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns",
+                 "attributes", "error", "_token")
+
+    def __init__(self, tracer, trace_id, parent_id, name, attributes):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.tracer.exporter.export(self)
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.error = repr(exc)
+        _current_span.reset(self._token)
+        self.end()
+        return False
+
+    def to_otlp(self):
+        """Returns the span as an OTLP JSON span."""
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+class _NoopSpan:
+    """Stands in for every span of an unsampled trace."""
+
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class SpanExporter:
+    """
+    Writes finished spans from a background thread, so request threads never wait on I/O.
+
+    Spans are appended to `path` as one OTLP JSON span per line and, when
+    `otlp_endpoint` is set, posted to it as OTLP/HTTP JSON batches. Spans are
+    dropped, and counted, when the queue is full.
+    """
+
+    def __init__(self, path=None, otlp_endpoint=None, service_name="haspde-some", flush_interval=1.0,
+                 max_queue=10000, batch_size=512):
+        self.path = path
+        self.otlp_endpoint = otlp_endpoint
+        self.service_name = service_name
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.write([span.to_otlp() for span in batch])
+            except Exception as e:
+                logger.error(f"Error exporting {len(batch)} spans: {e}")
+
+    def write(self, spans):
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write("".join(json.dumps(span) + "\n" for span in spans))
+        if self.otlp_endpoint:
+            import requests
+            payload = {'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+                'scopeSpans': [{'scope': {'name': 'haspde'}, 'spans': spans}],
+            }]}
+            requests.post(self.otlp_endpoint, json=payload, timeout=5)
+
+
+class Tracer:
+    """Starts head-sampled traces and the spans nested in them."""
+
+    def __init__(self, sample_rate=0.0, exporter=None):
+        self.sample_rate = sample_rate
+        self.exporter = exporter or SpanExporter()
+
+    def configure(self, sample_rate, path=None, otlp_endpoint=None, service_name="haspde-some"):
+        """
+        Args:
+            sample_rate (float): Fraction of traces recorded, 0 turns tracing off.
+            path (str, optional): File the spans are appended to as JSON lines.
+            otlp_endpoint (str, optional): OTLP/HTTP traces endpoint, e.g. http://localhost:4318/v1/traces.
+        """
+        self.sample_rate = sample_rate
+        self.exporter = SpanExporter(path, otlp_endpoint, service_name)
+
+    def start_trace(self, name, traceparent=None, **attributes):
+        """
+        Starts the root span of a trace, or returns the no-op span when the trace is not sampled.
+
+        Args:
+            traceparent (str, optional): W3C `traceparent` header; while tracing is on, its
+                trace ID and sampled flag are used instead of starting a new trace.
+        """
+        if self.sample_rate <= 0:
+            return NOOP_SPAN
+
+        trace_id = parent_id = None
+        parts = traceparent.split("-") if traceparent else ()
+        if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16 and len(parts[3]) == 2:
+            try:
+                sampled = int(parts[3], 16) & 1
+            except ValueError:
+                sampled = None
+            if sampled == 0:
+                return NOOP_SPAN
+            if sampled:
+                trace_id, parent_id = parts[1], parts[2]
+
+        if trace_id is None:
+            if random.random() >= self.sample_rate:
+                return NOOP_SPAN
+            trace_id = f"{random.getrandbits(128):032x}"
+        return Span(self, trace_id, parent_id, name, attributes)
+
+    def span(self, name, **attributes):
+        """Returns a child of the current span, or the no-op span outside a sampled trace."""
+        parent = _current_span.get()
+        if parent is None:
+            return NOOP_SPAN
+        return Span(self, parent.trace_id, parent.span_id, name, attributes)
+
+    @staticmethod
+    def active():
+        """Returns True inside a sampled trace."""
+        return _current_span.get() is not None
+
+    @staticmethod
+    def current():
+        """Returns the current span, or the no-op span."""
+        return _current_span.get() or NOOP_SPAN
+
+    @staticmethod
+    def context():
+        """Returns a copy of the current context when inside a sampled trace, otherwise None."""
+        return contextvars.copy_context() if _current_span.get() is not None else None
+
+    @staticmethod
+    def wrap(func):
+        """Binds `func` to the current trace so it can run on another thread."""
+        if _current_span.get() is None:
+            return func
+        context = contextvars.copy_context()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return context.copy().run(func, *args, **kwargs)
+        return wrapper
+
+
+# The tracer shared by the whole process, configured by the service at startup
+tracer = Tracer()
+
+
+def traced(name):
+    """Decorator running every call of a function in a span of the current trace."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator